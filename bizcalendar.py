@@ -0,0 +1,104 @@
+from bisect import bisect_left
+from datetime import datetime, timedelta
+from plant.dbengine import transactional
+from plant.model import Calendar
+
+# how long a loaded calendar is used before it's read again
+MAX_AGE = timedelta(hours=1)
+
+
+def as_date(d):
+    if isinstance(d, datetime):
+        return d.date()
+    if isinstance(d, (str, unicode)):
+        return datetime.strptime(d[:10], '%Y-%m-%d').date()
+    return d
+
+
+class BusinessCalendar(object):
+    '''The calendar table as prefix sums of business days, so the number of
+    business days between two dates is a subtraction.
+
+    Days are indexed from the first calendar date.  business[k] is the
+    number of business days and rows[k] the number of calendar rows among
+    the first k days; days missing from the table count as neither.'''
+
+    def __init__(self):
+        self.first = None
+        self.business = [0]
+        self.rows = [0]
+        self.loaded = None
+
+    @transactional
+    def load(self, session):
+        days = session.query(Calendar.calendar_date,
+                             Calendar.is_business_day)\
+               .order_by(Calendar.calendar_date).all()
+        self.first = days and as_date(days[0][0]) or None
+        self.business = [0]
+        self.rows = [0]
+        for day, is_business_day in days:
+            n = (as_date(day) - self.first).days
+            while len(self.rows) <= n:     # fill gaps
+                self.business.append(self.business[-1])
+                self.rows.append(self.rows[-1])
+            self.business.append(self.business[-1] + (is_business_day and 1
+                                                      or 0))
+            self.rows.append(self.rows[-1] + 1)
+        self.loaded = datetime.now()
+        return self
+
+    def _span(self, start, end):
+        ' Prefix indexes of [start, end] clamped to the calendar '
+        size = len(self.rows) - 1
+        if self.first is None:
+            return 0, 0
+        lo = min(max((as_date(start) - self.first).days, 0), size)
+        hi = min((as_date(end) - self.first).days + 1, size)
+        return lo, max(lo, hi)
+
+    def businessDays(self, start, end):
+        '''Return the number of business days from start to end, both
+        included.'''
+        lo, hi = self._span(start, end)
+        return self.business[hi] - self.business[lo]
+
+    def covers(self, start, end):
+        '''Return whether the calendar has any of the days from start to
+        end.'''
+        lo, hi = self._span(start, end)
+        return self.rows[hi] > self.rows[lo]
+
+    def isBusinessDay(self, day):
+        return self.businessDays(day, day) == 1
+
+    def addBusinessDays(self, day, n):
+        '''Return the date n business days after the given day, or None
+        when that's past the end of the calendar.'''
+        if n <= 0:
+            return as_date(day)
+        lo, hi = self._span(day, day)
+        # the first prefix reaching n more business days ends on the day
+        k = bisect_left(self.business, self.business[hi] + n, hi)
+        if k >= len(self.business):
+            return None
+        return self.first + timedelta(k - 1)
+
+    def turnaround(self, order_date, ship_date, cap=7):
+        '''Business days from ordering to shipping, counting both days and
+        capped at cap.  None when not shipped or outside the calendar.'''
+        if order_date is None or ship_date is None or \
+           not self.covers(order_date, ship_date):
+            return None
+        return min(self.businessDays(order_date, ship_date), cap)
+
+
+_calendar = None
+
+def getCalendar():
+    '''Return the shared calendar, reloading it once it's older than
+    MAX_AGE.'''
+    global _calendar
+    if _calendar is None or _calendar.loaded < datetime.now() - MAX_AGE:
+        _calendar = BusinessCalendar().load()
+    return _calendar
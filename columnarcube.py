@@ -0,0 +1,318 @@
+import operator
+from decimal import Decimal
+from datetime import date, datetime
+import numpy
+from sqlalchemy import func
+from plant.odict import odict
+from plant.dbengine import transactional
+from plant import modelaliases
+from plant.modelaliases import o, oi
+from datacube import DIMENSIONS, MEASURES, COUNTED, JOIN_CLAUSES, JOIN_ORDER, \
+                     LOCAL_MEASURES, columnTables, joinClosure, rowClass
+from rollup import ROLLUP_DIMENSIONS
+from cubefilter import FilterError, parseFilter
+
+# Dimensions loaded by default.  Every dimension loaded must have at most one
+# value per order item, otherwise the outer joins would repeat fact rows.
+DEFAULT_DIMENSIONS = ['order_date'] + ROLLUP_DIMENSIONS + ['activity', 'state',
+                                                         'theme']
+# Table columns loaded by default for the filters used in reports.yml and
+# OrderSummaryProc.getFilters.
+DEFAULT_COLUMNS = ['o.order_date', 'o.state_id', 'wi.state_id', 'a.country',
+                   'cc.code', 'cm.code', 'oi.gross', 'oi.qty', 'p.code',
+                   'p.product_id', 'par.name', 'pt.code', 'sc.code']
+# Sums of money measures are held as integers in units of 1/SCALE, which is
+# the precision MySQL gives the quotient of a money column and a rate.
+SCALE = 10 ** 6
+
+
+def encode(values):
+    '''Dictionary encode a sequence.  Return (codes, labels).'''
+    index = {}
+    codes = numpy.fromiter((index.setdefault(v, len(index)) for v in values),
+                           numpy.int64, len(values))
+    labels = [None] * len(index)
+    for v, n in index.items():
+        labels[n] = v
+    return codes, labels
+
+
+def parse_datetime(s):
+    for fmt in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d'):
+        try:
+            return datetime.strptime(s.strip(), fmt)
+        except ValueError:
+            pass
+    raise ValueError('Unrecognized date: %s' % s)
+
+
+class EncodedColumn(object):
+    '''A dictionary encoded column that evaluates the comparisons used in
+    cube filters against its distinct values once, then broadcasts the
+    result to the rows through the codes.  NULLs never match, as in SQL.'''
+
+    def __init__(self, codes, labels, present):
+        self.codes = codes
+        self.labels = labels
+        self.present = present
+
+    def _coerce(self, value):
+        ' Convert date strings to the type of the column values '
+        sample = [l for l in self.labels if l is not None][:1]
+        if sample and isinstance(value, (str, unicode)) and \
+           isinstance(sample[0], date):
+            dt = parse_datetime(value)
+            if isinstance(sample[0], datetime):
+                return dt
+            return dt.date()
+        return value
+
+    def _mask(self, test):
+        table = numpy.fromiter((l is not None and test(l)
+                                for l in self.labels), bool, len(self.labels))
+        return table[self.codes] & self.present
+
+    def _compare(self, op, value):
+        value = self._coerce(value)
+        return self._mask(lambda l: op(l, value))
+
+    def __eq__(self, value): return self._compare(operator.eq, value)
+    def __ne__(self, value): return self._compare(operator.ne, value)
+    def __lt__(self, value): return self._compare(operator.lt, value)
+    def __le__(self, value): return self._compare(operator.le, value)
+    def __gt__(self, value): return self._compare(operator.gt, value)
+    def __ge__(self, value): return self._compare(operator.ge, value)
+
+    def in_(self, values):
+        values = set(self._coerce(v) for v in values)
+        return self._mask(lambda l: l in values)
+
+
+class ColumnarCube(object):
+    '''In-process cube over the order item rows of a date window.
+
+    load() fetches the window once, with dimensions and filter columns
+    dictionary encoded as integer codes and measures held as NumPy arrays.
+    getData() then takes the same facts, dimensions and filter strings as
+    DataCube.getData and answers them with a vectorized group by, without
+    going back to the database.
+
+    The window is fetched with outer joins.  Each table's presence is kept
+    so a request only sees the order items the live cube's inner joins
+    would give it.
+
+    With rates, money is loaded in each order's currency and converted to
+    dollars from the in-memory rate series, as for DataCube(rates=True).'''
+
+    def __init__(self, dimensions=None, facts=None, columns=None,
+                 rates=False):
+        self.rates = rates
+        self.measure_exprs = dict(MEASURES)
+        if rates:
+            self.measure_exprs.update(LOCAL_MEASURES)
+        self.dimension_names = dimensions or DEFAULT_DIMENSIONS
+        self.fact_names = facts or sorted(MEASURES)
+        self.column_names = columns or DEFAULT_COLUMNS
+        for d in self.dimension_names:
+            if d not in DIMENSIONS:
+                raise ValueError('Unknown dimension: %s' % d)
+        for f in self.fact_names:
+            if f not in MEASURES:
+                raise ValueError('Unknown fact: %s' % f)
+        self.size = 0
+
+    def _column(self, name):
+        alias, attr = name.split('.')
+        return getattr(getattr(modelaliases, alias), attr)
+
+    @transactional
+    def load(self, session, start_date, end_date, date_column='o.order_date'):
+        '''Load the order item rows with date_column in [start_date,
+        end_date).'''
+        exprs = [DIMENSIONS[d] for d in self.dimension_names]
+        exprs += [self.measure_exprs[f].label(f) for f in self.fact_names]
+        exprs += [self._column(c).label(c.replace('.', '__'))
+                  for c in self.column_names]
+        rate_keys = []
+        if self.rates:
+            rate_keys = [o.currency_id.label('rate_currency_id'),
+                         func.date(o.order_date).label('rate_date')]
+        date_col = self._column(date_column)
+        needed = joinClosure(columnTables(exprs + rate_keys + [date_col]))
+        tables = [t for t in JOIN_ORDER if t in needed]
+        j = oi.__table__
+        for t in tables:
+            j = j.outerjoin(t, JOIN_CLAUSES[t])
+        flags = [list(t.primary_key)[0].label('has_%s' % t.name)
+                 for t in tables]
+        q = session.query(*(exprs + flags + rate_keys)).select_from(j)\
+            .filter((date_col >= start_date) & (date_col < end_date))
+        rows = q.all()
+        self.size = n = len(rows)
+        cols = zip(*rows) or [()] * (len(exprs) + len(flags) +
+                                     len(rate_keys))
+        ndims, nfacts = len(self.dimension_names), len(self.fact_names)
+        ncols = len(self.column_names)
+
+        # table presence
+        self.present = {oi.__table__: numpy.ones(n, bool)}
+        for t, values in zip(tables, cols[ndims + nfacts + ncols:]):
+            self.present[t] = numpy.fromiter((v is not None for v in values),
+                                             bool, n)
+        # dimensions and filter columns
+        self.dimensions = odict()
+        for d, values in zip(self.dimension_names, cols):
+            codes, labels = encode(values)
+            self.dimensions[d] = EncodedColumn(
+                codes, labels, self._presence(columnTables(DIMENSIONS[d])))
+        self.columns = {}
+        for c, values in zip(self.column_names, cols[ndims + nfacts:]):
+            codes, labels = encode(values)
+            alias, attr = c.split('.')
+            self.columns.setdefault(alias, odict())[attr] = EncodedColumn(
+                codes, labels, self._presence(columnTables(self._column(c))))
+        # measures, with money scaled to integers
+        if self.rates:
+            rates = self._rowRates(*cols[len(exprs) + len(flags):])
+        self.measures = {}
+        for f, values in zip(self.fact_names, cols[ndims:]):
+            notnull = numpy.fromiter((v is not None for v in values), bool, n)
+            if f in COUNTED:
+                self.measures[f] = (notnull.astype(numpy.int64), notnull,
+                                    None)
+                continue
+            money = [v for v in values if isinstance(v, (Decimal, float))][:1]
+            scale = money and SCALE or 1
+            vals = numpy.fromiter((int(round((v or 0) * scale))
+                                   for v in values), numpy.int64, n)
+            if self.rates and f in LOCAL_MEASURES:
+                # rows of currencies without rates count as NULL
+                notnull &= ~numpy.isnan(rates)
+                vals = numpy.round(vals / numpy.where(notnull, rates, 1))
+                vals = numpy.where(notnull, vals, 0).astype(numpy.int64)
+            self.measures[f] = (vals, notnull, scale)
+        self.mtables = dict((f, columnTables(self.measure_exprs[f]))
+                            for f in self.fact_names)
+
+    def _rowRates(self, currency_ids, days):
+        '''Return an array of the dollar rate of each row, NaN where the
+        currency has none.  Each currency and day is looked up once.'''
+        from exchangerates import getRateSeries
+        series = getRateSeries()
+        codes, labels = encode(zip(currency_ids, days))
+        rates = numpy.array([float(series.rate(c, d) or 'nan')
+                             for c, d in labels] or [0.0])
+        return rates[codes]
+
+    def _presence(self, tables):
+        mask = numpy.ones(self.size, bool)
+        for t in joinClosure(tables):
+            mask &= self.present[t]
+        return mask
+
+    def _filterMask(self, f):
+        '''Evaluate a filter string against the loaded columns.'''
+        parsed = parseFilter(f)
+        namespace = dict(self.columns)
+        namespace['dc'] = self.dimensions
+        try:
+            mask = parsed.evaluate(namespace)
+        except FilterError, e:
+            raise ValueError('Filter needs columns not loaded: %s (%s)' %
+                             (f, e))
+        # a negated comparison is true for rows missing the table, which
+        # the live cube's inner joins would have dropped
+        tables = set()
+        for alias, attr in parsed.refs():
+            if alias == 'dc' and attr in self.dimensions:
+                tables |= columnTables(DIMENSIONS[attr])
+            elif alias in self.columns:
+                tables |= columnTables(self._column('%s.%s' % (alias, attr)))
+        return mask & self._presence(tables)
+
+    def _groups(self, codes, cards, mask):
+        '''Return (keys, inverse) for the distinct combinations of codes in
+        the masked rows.'''
+        if not codes:
+            return (numpy.zeros(1, numpy.int64),
+                    numpy.zeros(mask.sum(), numpy.int64))
+        if numpy.prod([float(c) for c in cards]) < 2 ** 62:
+            packed = numpy.zeros(mask.sum(), numpy.int64)
+            for c, card in zip(codes, cards):
+                packed = packed * card + c[mask]
+            return numpy.unique(packed, return_inverse=True)
+        stacked = numpy.ascontiguousarray(numpy.column_stack(
+            [c[mask] for c in codes]))
+        rows = stacked.view(numpy.dtype((numpy.void, stacked.dtype.itemsize *
+                                         stacked.shape[1]))).ravel()
+        keys, first, inverse = numpy.unique(rows, return_index=True,
+                                            return_inverse=True)
+        return stacked[first], inverse
+
+    def _unpack(self, key, cards):
+        if not isinstance(key, (int, long, numpy.integer)):
+            return list(key)
+        codes = []
+        for card in reversed(cards):
+            key, c = divmod(int(key), card)
+            codes.append(c)
+        return codes[::-1]
+
+    def getData(self, session, facts, dimensions, filters=[]):
+        '''Same as DataCube.getData but answered from the loaded rows.  The
+        session is accepted for compatibility and isn't used.'''
+        for f in facts:
+            if f not in self.measures:
+                raise ValueError('Fact not loaded: %s' % f)
+        for d in dimensions:
+            if d not in self.dimensions:
+                raise ValueError('Dimension not loaded: %s' % d)
+        tables = set()
+        for d in dimensions:
+            tables |= columnTables(DIMENSIONS[d])
+        for f in facts:
+            tables |= self.mtables[f]
+        mask = self._presence(tables)
+        for f in filters:
+            if isinstance(f, (str, unicode)):
+                if f.strip():
+                    mask &= self._filterMask(f)
+            else:
+                raise ValueError('Filters must be strings: %r' % (f,))
+        Row = rowClass(list(dimensions) + list(facts))
+        dims = [self.dimensions[d] for d in dimensions]
+        if not facts:   # detail rows
+            return [Row(*[d.labels[d.codes[n]] for d in dims])
+                    for n in numpy.flatnonzero(mask)]
+        cards = [len(d.labels) for d in dims]
+        keys, inverse = self._groups([d.codes for d in dims], cards, mask)
+        if not len(inverse):
+            if dims:
+                return []
+            # an aggregate without a group by always gives one row
+            return [Row(*[f in COUNTED and 0 or None for f in facts])]
+        ngroups = len(keys)
+        totals = []
+        for f in facts:
+            vals, notnull, scale = self.measures[f]
+            sums = numpy.bincount(inverse, weights=vals[mask],
+                                  minlength=ngroups)
+            counts = numpy.bincount(inverse, weights=notnull[mask],
+                                    minlength=ngroups)
+            totals.append((sums, counts, scale))
+        rows = []
+        for g in range(ngroups):
+            codes = self._unpack(keys[g], cards)
+            row = [d.labels[c] for d, c in zip(dims, codes)]
+            for sums, counts, scale in totals:
+                total = int(round(sums[g]))
+                if scale is None:
+                    row.append(total)
+                elif not counts[g]:
+                    row.append(None)
+                elif scale == 1:
+                    row.append(Decimal(total))
+                else:
+                    row.append(Decimal(total) / scale)
+            rows.append(Row(*row))
+        return rows
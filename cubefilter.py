@@ -0,0 +1,399 @@
+'''Parser for the cube filter language.
+
+Filters reach the cubes as strings like
+
+    o.state_id <= 500
+    dc.product == 'Photo Book'
+    p.product_id.in_(range(1, 5))
+    (oi.gross > 1000) | ((oi.qty > 20) & (pt.code <> 'card'))
+
+They used to be eval'd on every request.  parseFilter() compiles them once
+into a small tree that can build the sqlalchemy clause, list the tables it
+refers to and be evaluated against the in-process cubes' columns.  Parsed
+filters are cached by their text.
+
+Grammar (& binds tighter than |, comparisons tighter than both):
+
+    expr    := term ('|' term)*
+    term    := factor ('&' factor)*
+    factor  := '~' factor | operand [op operand]
+    operand := '(' expr ')' | ref ['.in_' '(' values ')'] | literal
+    ref     := alias '.' name
+    values  := '[' literals ']' | '(' literals ')' | 'range(' n [',' n] ')'
+'''
+
+import re
+import operator
+from lrucache import LRUCache
+
+OPERATORS = {'==': operator.eq, '!=': operator.ne, '<>': operator.ne,
+             '<': operator.lt, '<=': operator.le, '>': operator.gt,
+             '>=': operator.ge}
+
+TOKEN_RE = re.compile(r"""
+    \s*(?:
+      (?P<string>'(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*")
+    | (?P<number>-?\d+(?:\.\d+)?)
+    | (?P<name>[A-Za-z_]\w*)
+    | (?P<op>==|!=|<>|<=|>=|[<>&|~()\[\],.])
+    )""", re.VERBOSE)
+
+_cache = LRUCache(2000)
+
+
+class FilterError(ValueError):
+    pass
+
+
+def tokenize(text):
+    tokens = []
+    pos = 0
+    text = text.rstrip()
+    while pos < len(text):
+        m = TOKEN_RE.match(text, pos)
+        if not m:
+            raise FilterError('Bad filter syntax at %r: %s' %
+                              (text[pos:pos + 10], text))
+        kind = m.lastgroup
+        value = m.group(kind)
+        if kind == 'string':
+            value = value[1:-1].decode('string_escape')
+        elif kind == 'number':
+            value = '.' in value and float(value) or int(value)
+        tokens.append((kind, value))
+        pos = m.end()
+    return tokens
+
+
+class Node(object):
+
+    def refs(self):
+        ' Generate the (alias, name) references in the filter '
+        for child in self.children:
+            for r in child.refs():
+                yield r
+
+    def tables(self):
+        ' Return the set of tables the filter refers to '
+        tables = set()
+        for child in self.children:
+            tables |= child.tables()
+        return tables
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, self)
+
+
+class Ref(Node):
+
+    children = ()
+
+    def __init__(self, alias, name):
+        self.alias = alias
+        self.name = name
+
+    def refs(self):
+        yield self.alias, self.name
+
+    def column(self):
+        if self.alias == 'dc':
+            from datacube import DIMENSIONS
+            try:
+                return DIMENSIONS[self.name]
+            except KeyError:
+                raise FilterError('Unknown dimension: %s' % self.name)
+        from plant import modelaliases
+        cls = getattr(modelaliases, self.alias, None)
+        if not hasattr(cls, '__table__'):
+            raise FilterError('Unknown table alias: %s' % self.alias)
+        col = getattr(cls, self.name, None)
+        if not hasattr(getattr(col, 'property', None), 'columns'):
+            raise FilterError('Unknown column: %s.%s' % (self.alias,
+                                                         self.name))
+        return col
+
+    def tables(self):
+        from datacube import columnTables
+        return columnTables(self.column())
+
+    def clause(self):
+        return self.column()
+
+    def evaluate(self, namespace):
+        try:
+            return namespace[self.alias][self.name]
+        except KeyError:
+            raise FilterError('Column not loaded: %s' % self)
+
+    def __str__(self):
+        return '%s.%s' % (self.alias, self.name)
+
+
+class Literal(Node):
+
+    children = ()
+
+    def __init__(self, value):
+        self.value = value
+
+    def tables(self):
+        return set()
+
+    def clause(self):
+        return self.value
+
+    def evaluate(self, namespace):
+        return self.value
+
+    def __str__(self):
+        return repr(self.value)
+
+
+class Compare(Node):
+
+    def __init__(self, op, left, right):
+        self.op = op == '<>' and '!=' or op
+        self.children = (left, right)
+
+    left = property(lambda self: self.children[0])
+    right = property(lambda self: self.children[1])
+
+    def clause(self):
+        return OPERATORS[self.op](self.left.clause(), self.right.clause())
+
+    def evaluate(self, namespace):
+        return OPERATORS[self.op](self.left.evaluate(namespace),
+                                  self.right.evaluate(namespace))
+
+    def __str__(self):
+        return '%s %s %s' % (self.left, self.op, self.right)
+
+
+class In(Node):
+
+    def __init__(self, ref, values):
+        self.children = (ref,)
+        self.values = values
+
+    ref = property(lambda self: self.children[0])
+
+    def clause(self):
+        return self.ref.clause().in_(self.values)
+
+    def evaluate(self, namespace):
+        return self.ref.evaluate(namespace).in_(self.values)
+
+    def __str__(self):
+        return '%s.in_([%s])' % (self.ref,
+                                 ', '.join(repr(v) for v in self.values))
+
+
+class And(Node):
+
+    symbol = '&'
+    combine = operator.and_
+
+    def __init__(self, children):
+        self.children = tuple(children)
+
+    def clause(self):
+        clause = self.children[0].clause()
+        for child in self.children[1:]:
+            clause = self.combine(clause, child.clause())
+        return clause
+
+    def evaluate(self, namespace):
+        result = self.children[0].evaluate(namespace)
+        for child in self.children[1:]:
+            result = self.combine(result, child.evaluate(namespace))
+        return result
+
+    def __str__(self):
+        return (' %s ' % self.symbol).join('(%s)' % c
+                                            for c in self.children)
+
+
+class Or(And):
+
+    symbol = '|'
+    combine = operator.or_
+
+
+class Not(Node):
+
+    def __init__(self, child):
+        self.children = (child,)
+
+    def clause(self):
+        return ~self.children[0].clause()
+
+    def evaluate(self, namespace):
+        return ~self.children[0].evaluate(namespace)
+
+    def __str__(self):
+        return '~(%s)' % self.children[0]
+
+
+class Parser(object):
+
+    def __init__(self, text):
+        self.text = text
+        self.tokens = tokenize(text)
+        self.pos = 0
+
+    def error(self, msg):
+        raise FilterError('%s in filter: %s' % (msg, self.text))
+
+    def peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+        return (None, None)
+
+    def next(self):
+        token = self.peek()
+        if token[0] is None:
+            self.error('Unexpected end')
+        self.pos += 1
+        return token
+
+    def accept(self, value):
+        if self.peek() == ('op', value):
+            self.pos += 1
+            return True
+        return False
+
+    def expect(self, value):
+        if not self.accept(value):
+            self.error('Expected %r' % value)
+
+    def parse(self):
+        node = self.expr()
+        if self.pos < len(self.tokens):
+            self.error('Unexpected %r' % (self.peek()[1],))
+        return node
+
+    def expr(self):
+        nodes = [self.term()]
+        while self.accept('|'):
+            nodes.append(self.term())
+        return len(nodes) > 1 and Or(nodes) or nodes[0]
+
+    def term(self):
+        nodes = [self.factor()]
+        while self.accept('&'):
+            nodes.append(self.factor())
+        return len(nodes) > 1 and And(nodes) or nodes[0]
+
+    def factor(self):
+        if self.accept('~'):
+            return Not(self.factor())
+        left = self.operand()
+        kind, value = self.peek()
+        if kind == 'op' and value in OPERATORS:
+            self.pos += 1
+            return Compare(value, left, self.operand())
+        return left
+
+    def operand(self):
+        if self.accept('('):
+            node = self.expr()
+            self.expect(')')
+            return node
+        kind, value = self.next()
+        if kind in ('string', 'number'):
+            return Literal(value)
+        if kind != 'name':
+            self.error('Unexpected %r' % (value,))
+        if value == 'None':
+            return Literal(None)
+        self.expect('.')
+        kind, name = self.next()
+        if kind != 'name':
+            self.error('Expected a column name after %s.' % value)
+        ref = Ref(value, name)
+        if self.accept('.'):
+            if self.next() != ('name', 'in_'):
+                self.error('Only in_() may be called')
+            self.expect('(')
+            values = self.values()
+            self.expect(')')
+            return In(ref, values)
+        return ref
+
+    def literal(self):
+        kind, value = self.next()
+        if kind in ('string', 'number'):
+            return value
+        if (kind, value) == ('name', 'None'):
+            return None
+        self.error('Expected a literal, got %r' % (value,))
+
+    def values(self):
+        if self.peek() == ('name', 'range'):
+            self.pos += 1
+            self.expect('(')
+            args = [self.literal()]
+            if self.accept(','):
+                args.append(self.literal())
+            self.expect(')')
+            for arg in args:
+                if not isinstance(arg, (int, long)):
+                    self.error('range() takes integers')
+            return range(*args)
+        if self.accept('['):
+            close = ']'
+        else:
+            self.expect('(')
+            close = ')'
+        values = []
+        while not self.accept(close):
+            values.append(self.literal())
+            if not self.accept(','):
+                self.expect(close)
+                break
+        return values
+
+
+class Filter(object):
+    '''A parsed filter.  The clause and tables are worked out on first use
+    and kept with the filter in the cache.'''
+
+    def __init__(self, text):
+        self.text = text
+        self.node = Parser(text).parse()
+
+    @property
+    def clause(self):
+        try:
+            return self._clause
+        except AttributeError:
+            self._clause = self.node.clause()
+            return self._clause
+
+    @property
+    def tables(self):
+        try:
+            return self._tables
+        except AttributeError:
+            self._tables = frozenset(self.node.tables())
+            return self._tables
+
+    def refs(self):
+        return list(self.node.refs())
+
+    def evaluate(self, namespace):
+        return self.node.evaluate(namespace)
+
+    def __str__(self):
+        ' Canonical text, the same for filters differing only in layout '
+        return str(self.node)
+
+
+def parseFilter(text):
+    '''Return the parsed Filter for the text, from the cache when it has been
+    seen before.'''
+    text = text.strip()
+    f = _cache.get(text)
+    if f is None:
+        f = _cache[text] = Filter(text)
+    return f
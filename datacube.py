@@ -1,22 +1,65 @@
 
+from collections import namedtuple
+from datetime import date
 from sqlalchemy import func, Column
-from sqlalchemy.sql import and_, select
+from sqlalchemy.sql import and_, case, select
 from plant.utils import all_in
-from plant.odict import odict
 from plant.dbengine import transactional
+from tracing import traced, inTrace
 from plant.modelaliases import *
+from cubefilter import Compare, Literal, Ref, parseFilter
+from rollup import RollupStore
+from hyperloglog import HyperLogLog, INDEX_DIGITS, RANK_BITS, RANK_DIGITS
 
-FACTS = {'gross': func.sum(oi.gross / er.rate), 
-         'orders': func.count(oi.order_item_id),
-         'active_orders': func.count(wi.order_item_id),
-         'net': func.sum(oi.net / er.rate), 
-         'pages': func.sum(pi.num_pages),
-         'revenue': func.sum((oi.net + oi.shipping) / er.rate),
-         'shipping_cost': func.sum(i.shipping_cost), 
-         'shipping': func.sum(oi.shipping / er.rate), 
-         'tax': func.sum(oi.tax / er.rate), 
-         'units': func.sum(oi.qty)}
-for f in FACTS: FACTS[f] = FACTS[f].label(f)
+# Row level measures and the aggregate each is summarized with.  FACTS are
+# built from these; the in-process cubes load the measures directly.
+MEASURES = {'gross': oi.gross / er.rate, 
+            'orders': oi.order_item_id,
+            'active_orders': wi.order_item_id,
+            'net': oi.net / er.rate, 
+            'pages': pi.num_pages,
+            'revenue': (oi.net + oi.shipping) / er.rate,
+            'shipping_cost': i.shipping_cost, 
+            'shipping': oi.shipping / er.rate, 
+            'tax': oi.tax / er.rate, 
+            'units': oi.qty}
+COUNTED = ('orders', 'active_orders')
+FACTS = {}
+for f in MEASURES:
+    if f in COUNTED:
+        FACTS[f] = func.count(MEASURES[f]).label(f)
+    else:
+        FACTS[f] = func.sum(MEASURES[f]).label(f)
+
+# Money measures in the order's own currency, for cubes converting to
+# dollars afterwards with the in-memory rate series (DataCube(rates=True))
+# instead of joining the exchange rates.
+LOCAL_MEASURES = {'gross': oi.gross,
+                  'net': oi.net,
+                  'revenue': oi.net + oi.shipping,
+                  'shipping': oi.shipping,
+                  'tax': oi.tax}
+LOCAL_FACTS = dict(FACTS)
+for f in LOCAL_MEASURES:
+    LOCAL_FACTS[f] = func.sum(LOCAL_MEASURES[f]).label(f)
+
+# Distinct counts estimated with HyperLogLog sketches (see hyperloglog for
+# the error bounds).  Instead of a COUNT(DISTINCT) over the join, the
+# registers of each sketch are queried as the highest rank by register,
+# and the sketches merge across shards and rollup partitions.  Rows carry
+# the sketches until the request is answered, when they're replaced by
+# their counts (countSketches).
+SKETCHES = {'books_approx': pi.product_item_id,
+            'customers_approx': o.customer_id,
+            'emails_approx': o.email_id}
+
+def sketchColumns(column):
+    """Return sql expressions for the register index and rank of a column,
+    hashed as hyperloglog.hashValue does."""
+    h = func.md5(column)
+    index = func.conv(func.substr(h, 1, INDEX_DIGITS), 16, 10)
+    bits = func.conv(func.substr(h, INDEX_DIGITS + 1, RANK_DIGITS), 16, 2)
+    return index, RANK_BITS + 1 - func.length(bits)
 
 DIMENSIONS = {'activity': act.name,
               'activity_code': act.code,
@@ -33,6 +76,7 @@ DIMENSIONS = {'activity': act.name,
               'cover_color': cc.name,
               'cover_material': cm.name,
               'currency': cur.code,
+              'currency_id': o.currency_id,
               'customer_name': 
                 func.concat_ws(' ', cus.first_name, cus.last_name),
               'destination': func.concat_ws(', ', a.city, a.state, a.country),
@@ -67,6 +111,7 @@ DIMENSIONS = {'activity': act.name,
               'rework_reason': rr.name,
               'ship_country': c.name,
               'ship_date': i.ship_date,
+              'ship_day': func.date(i.ship_date),
               'ship_method': sm.name,
               'state': s.name,
               'theme': t.name,
@@ -76,6 +121,15 @@ DIMENSIONS = {'activity': act.name,
                        (cal.calendar_date <= i.ship_date))}
 for d in DIMENSIONS: DIMENSIONS[d] = DIMENSIONS[d].label(d)
 
+def _turnaround(order_date, ship_day):
+    from bizcalendar import getCalendar
+    return getCalendar().turnaround(order_date, ship_day)
+
+# Dimensions computed in Python from other dimensions of the query rows,
+# name -> (source dimensions, function of their values).  Their entries in
+# DIMENSIONS are only used to filter on them.
+DERIVED = {'turnaround': (('order_date', 'ship_day'), _turnaround)}
+
 JOINS = {a:   a.address_id == o.shipping_address_id,
          act: wi.activity_id == act.activity_id,
          c:   a.country == c.country_code,
@@ -113,63 +167,695 @@ JOINS = {a:   a.address_id == o.shipping_address_id,
          t:   t.theme_id == pi.theme_id,
          wi:  wi.order_item_id == oi.order_item_id}
 
+
+def columnTables(expr, tables=None):
+    """Return the set of tables with columns referenced in the expression."""
+    if tables is None:
+        tables = set()
+    if isinstance(expr, (list, tuple)):
+        for e in expr:
+            columnTables(e, tables)
+    elif hasattr(expr, "get_children"):
+        for child in expr.get_children():
+            if isinstance(child, Column):
+                tables.add(child.table)
+            else:
+                columnTables(child, tables)
+    return tables
+
+# Table dependency graph of the JOINS: each joinable table maps to the other
+# joinable tables its join condition refers to.  JOIN_ORDER lists the tables
+# with dependencies ahead of the tables depending on them.
+JOIN_CLAUSES = dict((cls.__table__, clause) for cls, clause in JOINS.items())
+JOIN_DEPS = dict((t, set(d for d in columnTables(clause)
+                         if d in JOIN_CLAUSES and d is not t))
+                 for t, clause in JOIN_CLAUSES.items())
+
+def _joinOrder():
+    order = []
+    def visit(t):
+        if t not in order:
+            for d in sorted(JOIN_DEPS[t], key=lambda d: d.name):
+                visit(d)
+            order.append(t)
+    for t in sorted(JOIN_DEPS, key=lambda t: t.name):
+        visit(t)
+    return order
+JOIN_ORDER = _joinOrder()
+
+# Tables with at most one row per order item.  Groupings whose joins differ
+# only in these can be answered from one scan (see getGroupedData).
+SINGLE_VALUED = set(cls.__table__ for cls in (a, act, c, cc, cm, cur, cus,
+                                              dwn, e, er, i, o, oif, p, par,
+                                              pct, pi, pt, s, sc, sm, sv, t,
+                                              wi))
+
+def joinClosure(tables):
+    """Return the set of joinable tables needed to reach the given tables
+    from the order items."""
+    needed = set()
+    stack = [t for t in tables if t in JOIN_CLAUSES]
+    while stack:
+        t = stack.pop()
+        if t not in needed:
+            needed.add(t)
+            stack.extend(JOIN_DEPS[t])
+    return needed
+
+def planJoins(tables):
+    """Return the ordered list of join conditions needed to reach the given
+    tables from the order items."""
+    needed = joinClosure(tables)
+    return [JOIN_CLAUSES[t] for t in JOIN_ORDER if t in needed]
+
+_row_classes = {}
+def rowClass(names):
+    """Return a tuple class giving attribute access to the named columns, for
+    building rows that look like query results."""
+    names = tuple(names)
+    try:
+        return _row_classes[names]
+    except KeyError:
+        cls = _row_classes[names] = namedtuple('CubeRow', names)
+        return cls
+
+def freezeRows(rows):
+    """Return query rows as (names, tuples), which can be pickled."""
+    if not rows:
+        return None, []
+    names = getattr(rows[0], '_fields', None) or rows[0].keys()
+    return tuple(names), [tuple(r) for r in rows]
+
+def thawRows(frozen):
+    names, values = frozen
+    if names is None:
+        return []
+    Row = rowClass(names)
+    return [Row(*v) for v in values]
+
+def unique(names):
+    """Return the names without repeats, in order."""
+    seen = set()
+    return [n for n in names if not (n in seen or seen.add(n))]
+
+def regroup(rows, dimensions, facts):
+    """Sum the facts of rows grouped on more dimensions up to the given
+    dimensions.  As with SQL's SUM, a group whose values are all NULL sums
+    to None.  Return the rows sorted on the dimensions."""
+    Row = rowClass(list(dimensions) + list(facts))
+    groups = {}
+    for row in rows:
+        key = tuple(getattr(row, d) for d in dimensions)
+        totals = groups.get(key)
+        if totals is None:
+            totals = groups[key] = [None] * len(facts)
+        for n, f in enumerate(facts):
+            v = getattr(row, f)
+            if totals[n] is None:
+                totals[n] = v
+            elif v is not None:
+                totals[n] += v
+    if not groups and not dimensions:
+        # an aggregate without a group by always gives one row
+        groups[()] = [f in COUNTED and 0 or None for f in facts]
+    return [Row(*(key + tuple(groups[key]))) for key in sorted(groups)]
+
+def countSketches(rows, facts):
+    """Replace the sketches in rows built by the cube with their counts."""
+    sketched = [f for f in facts if f in SKETCHES]
+    if not sketched:
+        return rows
+    counted = []
+    for r in rows:
+        values = {}
+        for f in sketched:
+            sketch = getattr(r, f)
+            values[f] = sketch is not None and sketch.count() or 0
+        counted.append(r._replace(**values))
+    return counted
+
+def dateShards(filters, months=3, min_months=12):
+    """Split the date range of a request into shards of whole calendar
+    months, every months months.  Return a list with the filters of each
+    shard, or None when the filters don't bound one column on both sides or
+    the range spans fewer than min_months months."""
+    from resultcache import parse_date
+    bounds = {}
+    for n, f in enumerate(filters):
+        if not isinstance(f, (str, unicode)) or not f.strip():
+            continue
+        node = parseFilter(f).node
+        if not (isinstance(node, Compare) and isinstance(node.left, Ref) and
+                isinstance(node.right, Literal)):
+            continue
+        if node.op in ('>', '>='):
+            side = 0
+        elif node.op in ('<', '<='):
+            side = 1
+        else:
+            continue
+        day = parse_date(node.right.value)
+        if day:
+            bounds.setdefault(str(node.left), ([], []))[side].append((n, day))
+    for ref, (lower, upper) in sorted(bounds.items()):
+        if len(lower) == 1 and len(upper) == 1:
+            break
+    else:
+        return None
+    (lo_n, start), (hi_n, end) = lower[0], upper[0]
+    first = start.year * 12 + start.month     # index of the next month
+    if end.year * 12 + end.month - first + 1 < min_months:
+        return None
+    cuts = []
+    k = first
+    while True:
+        cut = date(k // 12, k % 12 + 1, 1)
+        if cut >= end:
+            break
+        cuts.append(cut)
+        k += months
+    if not cuts:
+        return None
+    shards = []
+    for lo, hi in zip([None] + cuts, cuts + [None]):
+        shard = list(filters)
+        if lo is not None:
+            shard[lo_n] = "%s >= '%s'" % (ref, lo.isoformat())
+        if hi is not None:
+            shard[hi_n] = "%s < '%s'" % (ref, hi.isoformat())
+        shards.append(shard)
+    return shards
+
 class DataCube(object):
+
+    # resolved join plans by (rates, facts, dimensions, filter tables)
+    # signature
+    join_plans = {}
+
+    def __init__(self, rollups=True, rates=False, cache=True, shards=True):
+        """With rates, money facts are summed in each order's currency and
+        converted to dollars from the in-memory rate series afterwards, so
+        the exchange rates aren't joined.  Orders on days without a rate
+        then use the last rate before, rather than being left out.
+
+        Summaries are cached in the configured result cache (see
+        resultcache) unless cache is False, or in the given ResultCache.
+
+        Queries over long date ranges are split into shards of a few months
+        run in parallel, each in its own session, and their partial sums
+        added up.  Sharding is configured with
+
+            reports:
+                shards:
+                    enabled: true
+                    workers: 4      # shards queried at once
+                    months: 3       # months per shard
+                    min_months: 12  # shorter ranges are one query
+
+        or given as a dict like that; shards=False turns it off."""
+        self.rollups = rollups and RollupStore() or None
+        self.rates = rates
+        self.facts = rates and LOCAL_FACTS or FACTS
+        if cache is True:
+            from resultcache import getCache
+            cache = getCache()
+        self.cache = cache or None
+        if shards is True:
+            from plant.resources import res
+            shards = res.conf.reports.get('shards') or {}
+            if not shards.get('enabled'):
+                shards = None
+        self.shards = shards or None
         
+    @traced
     @transactional
-    def getData(self, session, facts, dimensions, filters=[]):
+    def getData(self, session, facts, dimensions, filters=[], rollup=True):
         """General purpose summary data generator.
+
+        Answers from the daily rollups when possible unless rollup is False.
         """
 
-        for n, f in enumerate(filters):
-            dc = odict(DIMENSIONS)
+        if self.cache and facts:
+            groupings = [(facts, dimensions)]
+            return thawRows(self.cache.get(
+                self._cacheKey('data', groupings, filters, rollup),
+                self._cacheTags(groupings, filters),
+                lambda: freezeRows(self._computeData(session, facts,
+                                                     dimensions, filters,
+                                                     rollup))))
+        return self._computeData(session, facts, dimensions, filters, rollup)
+
+    def _computeData(self, session, facts, dimensions, filters, rollup):
+        if self._needsPost(facts, dimensions):
+            rows = self._getData(session, facts,
+                                 self._expand(facts, dimensions), filters,
+                                 rollup)
+            rows = self._derive(rows, facts, dimensions)
+        else:
+            rows = self._getData(session, facts, dimensions, filters, rollup)
+        return countSketches(rows, facts)
+
+    def _getData(self, session, facts, dimensions, filters, rollup):
+        if rollup and self.rollups:
+            rows = self.rollups.getData(session, facts, dimensions, filters)
+            if rows is not None:
+                return rows
+
+        if [f for f in facts if f in SKETCHES]:
+            return self._getSketchData(session, facts, dimensions, filters,
+                                       rollup)
+        shards = facts and self._dateShards(filters)
+        if shards:
+            parts = self._runShards(self._queryShard, shards, facts,
+                                    dimensions)
+            return regroup([r for rows in parts for r in rows],
+                           unique(dimensions), unique(facts))
+        return self._queryShard(session, facts, dimensions, filters)
+
+    @traced
+    @transactional
+    def _queryShard(self, session, facts, dimensions, filters):
+        filters, tables = self._compileFilters(filters)
+        return self._query(session, facts, dimensions, filters, tables).all()
+
+    def _getSketchData(self, session, facts, dimensions, filters, rollup):
+        """Answer a request with sketch facts: the other facts from the cube
+        query and each sketch from a query of its registers, matched up on
+        the dimensions."""
+        dimensions, facts = unique(dimensions), unique(facts)
+        additive = [f for f in facts if f not in SKETCHES]
+        values = {}
+        if additive:
+            for r in self._getData(session, additive, dimensions, filters,
+                                   rollup):
+                values[tuple(getattr(r, d) for d in dimensions)] = r
+        sketches = {}
+        for f in facts:
+            if f in SKETCHES:
+                sketches[f] = self._sketch(session, f, dimensions, filters)
+        if not dimensions:
+            keys = [()]
+        elif additive:
+            keys = values.keys()
+        else:
+            keys = set(k for by_key in sketches.values() for k in by_key)
+        Row = rowClass(dimensions + facts)
+        rows = []
+        for key in sorted(keys):
+            row = list(key)
+            for f in facts:
+                if f in sketches:
+                    row.append(sketches[f].get(key))
+                else:
+                    row.append(getattr(values.get(key), f, None))
+            rows.append(Row(*row))
+        return rows
+
+    def _sketch(self, session, fact, dimensions, filters):
+        """Return the sketches of a sketch fact by dimension values."""
+        shards = self._dateShards(filters)
+        if shards:
+            parts = self._runShards(self._sketchShard, shards, fact,
+                                    dimensions)
+        else:
+            parts = [self._sketchShard(session, fact, dimensions, filters)]
+        sketches = {}
+        for part in parts:
+            for key, sketch in part.items():
+                if key in sketches:
+                    sketches[key].merge(sketch)
+                else:
+                    sketches[key] = sketch
+        return sketches
+
+    @traced
+    @transactional
+    def _sketchShard(self, session, fact, dimensions, filters):
+        clauses, tables = self._compileFilters(filters)
+        index, rank = sketchColumns(SKETCHES[fact])
+        groups = [DIMENSIONS[d] for d in dimensions] + [index]
+        tables = columnTables(groups, set(tables))
+        q = session.query(*(groups + [func.max(rank)]))\
+            .filter(and_(*(planJoins(tables) + clauses)))\
+            .group_by(*groups)
+        n = len(dimensions)
+        sketches = {}
+        for row in q:
+            row = tuple(row)
+            if row[n] is None:      # null ids aren't counted
+                continue
+            sketch = sketches.get(row[:n])
+            if sketch is None:
+                sketch = sketches[row[:n]] = HyperLogLog()
+            sketch.setRegister(row[n], row[n + 1])
+        return sketches
+
+    @traced
+    @transactional
+    def getGroupedData(self, session, groupings, filters=[], rollup=True):
+        """Answer several (facts, dimensions) requests sharing the same
+        filters, as for the tables of a summary report.  Return a list with
+        the rows getData would give for each grouping.
+
+        MySQL has no GROUPING SETS and its WITH ROLLUP only gives the
+        hierarchical subtotals, so the groupings are answered from one scan
+        grouped on all their dimensions and summed back up to each grouping
+        in Python.  The tables only some groupings need are outer joined
+        and flagged, so each grouping sees just the order items its own
+        inner joins would give it.  Groupings needing different tables with
+        more than one row per order item can't share a scan, since the join
+        would repeat the other groupings' rows; one scan is made for each
+        such set of tables.
+        """
+        if self.cache and [f for f, d in groupings if f]:
+            results = self.cache.get(
+                self._cacheKey('grouped', groupings, filters, rollup),
+                self._cacheTags(groupings, filters),
+                lambda: [freezeRows(rows) for rows in
+                         self._computeGroupedData(session, groupings,
+                                                  filters, rollup)])
+            return [thawRows(rows) for rows in results]
+        return self._computeGroupedData(session, groupings, filters, rollup)
+
+    def _computeGroupedData(self, session, groupings, filters, rollup):
+        if any(self._needsPost(facts, dims) for facts, dims in groupings):
+            expanded = [(facts, self._expand(facts, dims))
+                        for facts, dims in groupings]
+            results = self._getGroupedData(session, expanded, filters,
+                                           rollup)
+            results = [self._derive(rows, facts, dims)
+                       for rows, (facts, dims) in zip(results, groupings)]
+        else:
+            results = self._getGroupedData(session, groupings, filters,
+                                           rollup)
+        return [countSketches(rows, facts)
+                for rows, (facts, dims) in zip(results, groupings)]
+
+    def _getGroupedData(self, session, groupings, filters, rollup):
+        results = [None] * len(groupings)
+        if rollup and self.rollups:
+            for n, (facts, dimensions) in enumerate(groupings):
+                results[n] = self.rollups.getData(session, facts, dimensions,
+                                                  filters)
+        clauses, filter_tables = self._compileFilters(filters)
+        base = joinClosure(filter_tables)
+        scans = {}
+        for n, (facts, dimensions) in enumerate(groupings):
+            if results[n] is not None:
+                continue
+            if [f for f in facts if f in SKETCHES]:
+                results[n] = self._getSketchData(session, facts, dimensions,
+                                                 filters, rollup)
+                continue
+            if not facts:   # detail rows
+                results[n] = self._query(session, facts, dimensions,
+                                         clauses, filter_tables).all()
+                continue
+            self._checkNames(facts, dimensions)
+            tables = columnTables([self.facts[f] for f in facts] +
+                                  [DIMENSIONS[d] for d in dimensions])
+            needed = joinClosure(tables) | base
+            multi = frozenset(needed - SINGLE_VALUED)
+            scans.setdefault(multi, []).append((n, needed))
+        shards = scans and self._dateShards(filters)
+        for members in scans.values():
+            scan_groupings = [groupings[n] for n, needed in members]
+            scan_needed = [needed for n, needed in members]
+            if shards:
+                parts = self._runShards(self._scanShard, shards,
+                                        scan_groupings, scan_needed)
+                rows = [r for rows, flags in parts for r in rows]
+                flags = parts[0][1]
+            else:
+                rows, flags = self._scan(session, scan_groupings,
+                                         scan_needed, clauses)
+            for n, needed in members:
+                facts, dimensions = groupings[n]
+                required = [flags[t] for t in needed if t in flags]
+                kept = [r for r in rows
+                        if all(getattr(r, f) for f in required)]
+                results[n] = regroup(kept, unique(dimensions), unique(facts))
+        return results
+
+    def _scan(self, session, groupings, needed, filters):
+        """Run one query grouped on all the groupings' dimensions.  Tables
+        needed by every grouping are inner joined, the others outer joined
+        with a flag column telling whether each row found the table.
+        Return the rows and the flag column names by table."""
+        common = reduce(set.intersection, needed)
+        extra = reduce(set.union, needed) - common
+        j = oi.__table__
+        flags = {}
+        flag_cols = []
+        for t in JOIN_ORDER:
+            if t in common:
+                j = j.join(t, JOIN_CLAUSES[t])
+            elif t in extra:
+                j = j.outerjoin(t, JOIN_CLAUSES[t])
+                flags[t] = 'has_%s' % t.name
+                flag_cols.append(case([(list(t.primary_key)[0] == None, 0)],
+                                      else_=1).label(flags[t]))
+        dimensions = unique(d for facts, dims in groupings for d in dims)
+        facts = unique(f for fs, dims in groupings for f in fs)
+        groups = [DIMENSIONS[d] for d in dimensions] + flag_cols
+        q = session.query(*(groups + [self.facts[f] for f in facts]))\
+            .select_from(j).filter(and_(*filters)).group_by(*groups)
+        return q.all(), flags
+
+    @traced
+    @transactional
+    def _scanShard(self, session, groupings, needed, filters):
+        clauses, tables = self._compileFilters(filters)
+        return self._scan(session, groupings, needed, clauses)
+
+    def _dateShards(self, filters):
+        if not self.shards:
+            return None
+        return dateShards(filters, self.shards.get('months', 3),
+                          self.shards.get('min_months', 12))
+
+    def _runShards(self, work, shards, *args):
+        """Call work(*args + (filters,)) for each shard's filters on a
+        thread pool, each call opening its own session.  The database does
+        the work, so threads are enough to keep several queries running.
+        The calls are traced as part of the call running the shards.
+        Return the results in shard order."""
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(min(self.shards.get('workers', 4), len(shards)))
+        try:
+            return pool.map(inTrace(lambda filters:
+                                    work(*(args + (filters,)))), shards)
+        finally:
+            pool.close()
+            pool.join()
+
+    @traced
+    def iterData(self, session, facts, dimensions, filters=[],
+                 chunk_size=1000):
+        """Generate the rows getData would return a chunk at a time.
+
+        Detail rows (no facts) are fetched in pages keyed on the order item
+        id rather than through a server side cursor, so memory stays bounded
+        and the consumer is free to run its own queries on the session
+        between rows.  The session must stay open while iterating.
+        """
+        if facts:   # summaries are small
+            for row in self.getData(session, facts, dimensions, filters):
+                yield row
+            return
+        if self._hasDerived(dimensions):
+            Row = rowClass(dimensions)
+            for row in self.iterData(session, facts,
+                                     self._expand(facts, dimensions),
+                                     filters, chunk_size):
+                yield Row(*self._deriveValues(row, dimensions))
+            return
+        filters, tables = self._compileFilters(filters)
+        key = oi.order_item_id.label('order_item_key')
+        Row = rowClass(dimensions)
+        last = None
+        while True:
+            page = filters[:]
+            if last is not None:
+                page.append(oi.order_item_id > last)
+            rows = self._query(session, [], dimensions, page, tables, [key])\
+                   .order_by(oi.order_item_id).limit(chunk_size).all()
+            if not rows:
+                return
+            if len(rows) < chunk_size:
+                for row in rows:
+                    yield Row(*row[:-1])
+                return
+            # the last order item may continue on the next page
+            last_id = rows[-1][-1]
+            rows = [r for r in rows if r[-1] != last_id]
+            if not rows:    # one order item fills the page
+                rows = self._query(session, [], dimensions,
+                                   filters + [oi.order_item_id == last_id],
+                                   tables, [key]).all()
+            for row in rows:
+                yield Row(*row[:-1])
+            last = rows[-1][-1]
+
+    def _cacheKey(self, kind, groupings, filters, rollup):
+        """Key results on the request with the filters normalized: parsed
+        filter text in canonical form, in any order, and on whether the
+        rollups may answer it."""
+        keys = []
+        for f in filters:
+            if isinstance(f, (str, unicode)):
+                if f.strip():
+                    keys.append(str(parseFilter(f)))
+            else:
+                compiled = f.compile()
+                keys.append((str(compiled),
+                             tuple(sorted(compiled.params.items()))))
+        return (kind, bool(self.rates), bool(rollup and self.rollups),
+                tuple((tuple(facts), tuple(dims))
+                      for facts, dims in groupings),
+                tuple(sorted(keys)))
+
+    def _cacheTags(self, groupings, filters):
+        """Return the result cache tags for the request.  Results not
+        touching the tables the workflow changes have none and are only
+        refreshed by their time to live."""
+        from resultcache import WORKFLOW_TABLES, requestTags
+        clauses, tables = self._compileFilters(filters)
+        tables = set(tables)
+        for facts, dims in groupings:
+            columnTables([self.facts[f] for f in facts if f in self.facts] +
+                         [SKETCHES[f] for f in facts if f in SKETCHES] +
+                         [DIMENSIONS[d] for d in dims if d in DIMENSIONS],
+                         tables)
+        if not joinClosure(tables) & WORKFLOW_TABLES:
+            return []
+        return requestTags(filters)
+
+    def _hasDerived(self, dimensions):
+        for d in dimensions:
+            if d in DERIVED:
+                return True
+        return False
+
+    def _converted(self, facts):
+        """Return the facts to convert to dollars after the query."""
+        if not self.rates:
+            return []
+        return [f for f in facts if f in LOCAL_MEASURES]
+
+    def _needsPost(self, facts, dimensions):
+        return self._hasDerived(dimensions) or bool(self._converted(facts))
+
+    def _expand(self, facts, dimensions):
+        """Replace the derived dimensions with their sources, adding the
+        order date and currency when money facts are to be converted."""
+        expanded = []
+        for d in dimensions:
+            expanded.extend(d in DERIVED and DERIVED[d][0] or [d])
+        if self._converted(facts):
+            expanded += ['order_date', 'currency_id']
+        return unique(expanded)
+
+    def _deriveValues(self, row, dimensions):
+        values = []
+        for d in dimensions:
+            if d in DERIVED:
+                sources, fn = DERIVED[d]
+                values.append(fn(*[getattr(row, s) for s in sources]))
+            else:
+                values.append(getattr(row, d))
+        return values
+
+    def _derive(self, rows, facts, dimensions):
+        """Compute the derived dimensions and convert the money facts of
+        rows fetched with the expanded dimensions, summing the facts up to
+        the requested dimensions."""
+        if not self._needsPost(facts, dimensions):
+            return rows
+        if not facts:
+            Row = rowClass(dimensions)
+            return [Row(*self._deriveValues(r, dimensions)) for r in rows]
+        dimensions, facts = unique(dimensions), unique(facts)
+        converted = self._converted(facts)
+        if converted:
+            from exchangerates import getRateSeries
+            series = getRateSeries()
+        Row = rowClass(dimensions + facts)
+        derived = []
+        for r in rows:
+            values = self._deriveValues(r, dimensions)
+            if converted:
+                # each row is one currency and day, so converting its sums
+                # is the same as converting each order item
+                rate = series.rate(r.currency_id, r.order_date)
+            for f in facts:
+                v = getattr(r, f)
+                if f in converted and v is not None:
+                    if rate:
+                        v = v / rate
+                    else:
+                        v = None
+                values.append(v)
+            derived.append(Row(*values))
+        return regroup(derived, dimensions, facts)
+
+    def _compileFilters(self, filters):
+        """Return the filters as sqlalchemy clauses along with the set of
+        tables they refer to.  Filter strings are parsed once and cached
+        (see cubefilter)."""
+        clauses = []
+        tables = set()
+        for f in filters:
             if isinstance(f, (str, unicode)):
-                filters[n] = eval(f)
+                if not f.strip():
+                    continue
+                f = parseFilter(f)
+                clauses.append(f.clause)
+                tables |= f.tables
+            else:
+                clauses.append(f)
+                columnTables(f, tables)
+        return clauses, frozenset(tables)
 
+    def _query(self, session, facts, dimensions, filters, filter_tables,
+               extra=[]):
+        """Build the cube query for the given fact and dimension names, the
+        compiled filters and the tables they need, and any extra columns."""
+        self._checkNames(facts, dimensions)
         fact_aliases = facts[:]
-        facts = []
-        for f in fact_aliases:
-            if f not in FACTS:
-                raise ValueError('Unknown fact: %s' % f)
-            facts.append(FACTS[f])
-            
+        facts = [self.facts[f] for f in fact_aliases]
         dim_aliases = dimensions[:]
-        dimensions = []
-        for d in dim_aliases:
-            if d not in DIMENSIONS:
-                raise ValueError('Unknown dimension: %s' % d)
-            dimensions.append(DIMENSIONS[d])
+        dimensions = [DIMENSIONS[d] for d in dim_aliases]
 
-        cols = dimensions + facts
-        conds = []
-        self._gatherConds(cols + filters, conds)
+        cols = dimensions + facts + list(extra)
+        conds = self._planJoins(fact_aliases, dim_aliases, filter_tables)
         q = session.query(*cols).filter(and_(*(conds + filters)))
         if facts:
             q = q.group_by(dimensions)
         #print q#;return []
-        return q.all()
-
-
-    def _gatherConds(self, attrs, conds):
-        """Gather the conditions required to do the appropriate joins for the
-        selected columns filters requested if any."""
-        # Go through the expression recursively, examining the columns
-        # associated with the given attributes as they are encountered,
-        # checking the conds list as it's being built for the existence of a
-        # model class with the matching table to see whether that associated
-        # join condition is defined, adding it when not.
-        if isinstance(attrs, list):
-            for a in attrs:
-                self._gatherConds(a, conds)
-        elif hasattr(attrs, "get_children"):
-            children = attrs.get_children()
-            for child in children:
-                if isinstance(child, Column):
-                    for cls, clause in JOINS.items():
-                        if cls.__table__ == child.table:
-                            if str(clause) not in map(str, conds):
-                                conds.append(clause)
-                                self._gatherConds(clause, conds)
-                else:                    
-                    self._gatherConds(child, conds)
-        
+        return q
+
+    def _checkNames(self, facts, dimensions):
+        for f in facts:
+            if f not in FACTS:
+                raise ValueError('Unknown fact: %s' % f)
+        for d in dimensions:
+            if d not in DIMENSIONS:
+                raise ValueError('Unknown dimension: %s' % d)
 
+    def _planJoins(self, facts, dimensions, filter_tables):
+        """Return the join conditions required for the selected columns and
+        filter tables, resolving the plan once per request signature."""
+        key = (bool(self.rates), tuple(facts), tuple(dimensions),
+               filter_tables)
+        try:
+            return self.join_plans[key]
+        except KeyError:
+            pass
+        tables = set(filter_tables)
+        for f in facts:
+            columnTables(self.facts[f], tables)
+        for d in dimensions:
+            columnTables(DIMENSIONS[d], tables)
+        plan = self.join_plans[key] = planJoins(tables)
+        return plan
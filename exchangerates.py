@@ -2,6 +2,8 @@
 
 import re
 import sys
+from bisect import bisect_right
+from datetime import datetime, timedelta
 from urllib import urlopen
 from plant.dbengine import transactional
 from plant.smartdate import Date
@@ -61,7 +63,63 @@ class ExchangeRates(object):
         self.updateToday(session)
         return session.query(ExchangeRate).filter_by(rate_date=Date()).all()
 
-       
+
+class RateSeries(object):
+    '''The exchange_rates table as date sorted arrays per currency.
+
+    rate() gives the rate in effect on a day: that day's rate, or the last
+    one before it when the day has no row.  Days before a currency's first
+    rate use its first rate.'''
+
+    # how long a loaded series is used before it's read again
+    MAX_AGE = timedelta(hours=1)
+
+    def __init__(self):
+        self.days = {}
+        self.rates = {}
+        self.loaded = None
+
+    @transactional
+    def load(self, session):
+        self.days, self.rates = {}, {}
+        q = session.query(ExchangeRate.currency_id, ExchangeRate.rate_date,
+                          ExchangeRate.rate)\
+            .filter(ExchangeRate.rate != None)\
+            .order_by(ExchangeRate.currency_id, ExchangeRate.rate_date)
+        for currency_id, day, rate in q:
+            if isinstance(day, datetime):
+                day = day.date()
+            self.days.setdefault(currency_id, []).append(day)
+            self.rates.setdefault(currency_id, []).append(rate)
+        self.loaded = datetime.now()
+        return self
+
+    def rate(self, currency_id, day):
+        '''Return the currency's rate as of the day, or None if the currency
+        has no rates.'''
+        days = self.days.get(currency_id)
+        if not days or day is None:
+            return None
+        if isinstance(day, datetime):
+            day = day.date()
+        n = bisect_right(days, day) - 1
+        return self.rates[currency_id][max(n, 0)]
+
+    def isStale(self):
+        return self.loaded is None or \
+               self.loaded < datetime.now() - self.MAX_AGE
+
+
+_series = None
+
+def getRateSeries():
+    ' Return the shared rate series, reloading it when stale '
+    global _series
+    if _series is None or _series.isStale():
+        _series = RateSeries().load()
+    return _series
+
+
 if __name__ == '__main__':
     res.load()
     #ExchangeRates().updateToday()
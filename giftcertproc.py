@@ -3,6 +3,7 @@
 import re, cgi
 from kid import Template
 from plant.dbengine import transactional
+from tracing import traced
 from plant.odict import odict
 from plant.smartdate import Date
 from plant.model import GCReport, GiftCertificate, OrderItem
@@ -12,6 +13,7 @@ from web.reportutils import HTML
 class GiftCertProc(object):
     '''Provides data for use by the gift certificate report.'''
 
+    @traced
     @transactional
     def getData(self, session, params):
         q = session.query(GCReport)
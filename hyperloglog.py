@@ -0,0 +1,114 @@
+'''HyperLogLog sketches for estimating distinct counts.
+
+Each value is hashed; the first P bits of the hash pick one of M = 2**P
+registers and the register keeps the highest rank (position of the first 1
+bit) seen among the rest.  The distinct count is estimated from the
+harmonic mean of the registers.
+
+Error bounds: the relative standard error is 1.04 / sqrt(M), about 1.6% for
+the P = 12 used here, so roughly 95% of estimates are within 3.3% and
+99.7% within 4.9% of the exact count.  Below 2.5 * M (about 10000) linear
+counting of the empty registers is used instead, which is closer still.
+
+Sketches merge by taking the register maxima: the merge of the sketches of
+two sets is the sketch of their union, so sketches kept for rollup
+partitions or computed for query shards can be added up in any grouping,
+and the overlap between them isn't counted twice.
+
+Values are hashed with MD5 of their string form, which is what MySQL's
+MD5() of an integer id hashes, so the registers can be built by the
+database (see datacube.sketchColumns) and combined with sketches built here.'''
+
+import zlib
+from hashlib import md5
+from math import log, sqrt
+
+P = 12
+M = 1 << P
+INDEX_DIGITS = P / 4        # hex digits of the hash picking the register
+RANK_DIGITS = 13            # hex digits ranked, 52 bits
+RANK_BITS = RANK_DIGITS * 4
+ERROR = 1.04 / sqrt(M)      # relative standard error
+
+
+def rank(w):
+    ' Position of the first 1 bit of the RANK_BITS bit word w '
+    return RANK_BITS - max(w.bit_length(), 1) + 1
+
+def hashValue(value):
+    ' Return the register index and rank for the value '
+    h = md5(str(value)).hexdigest()
+    return (int(h[:INDEX_DIGITS], 16),
+            rank(int(h[INDEX_DIGITS:INDEX_DIGITS + RANK_DIGITS], 16)))
+
+
+class HyperLogLog(object):
+
+    def __init__(self, registers=None):
+        self.registers = registers or bytearray(M)
+
+    def add(self, value):
+        index, r = hashValue(value)
+        if r > self.registers[index]:
+            self.registers[index] = r
+
+    def update(self, values):
+        for v in values:
+            self.add(v)
+
+    def setRegister(self, index, r):
+        ' Raise the register to the rank, as when built from query rows '
+        index = int(index)
+        if r > self.registers[index]:
+            self.registers[index] = r
+
+    def merge(self, other):
+        ' Merge the other sketch into this one '
+        self.registers = bytearray(map(max, self.registers, other.registers))
+        return self
+
+    def __add__(self, other):
+        ' The sketch of the union, leaving both operands unchanged '
+        return HyperLogLog(bytearray(self.registers)).merge(other)
+
+    def count(self):
+        ' Return the estimated number of distinct values added '
+        z = sum([2.0 ** -r for r in self.registers])
+        estimate = 0.7213 / (1 + 1.079 / M) * M * M / z
+        zeros = self.registers.count('\0')
+        if estimate <= 2.5 * M and zeros:
+            estimate = M * log(float(M) / zeros)
+        return int(round(estimate))
+
+    def toBytes(self):
+        ' Return the registers compressed, for storing '
+        return zlib.compress(str(self.registers))
+
+    @classmethod
+    def fromBytes(cls, data):
+        return cls(bytearray(zlib.decompress(data)))
+
+
+def test():
+    # synthetic ids, repeated, in overlapping sets
+    limit = 4 * ERROR
+    for n in (10, 100, 1000, 10000, 100000, 1000000):
+        a, b = HyperLogLog(), HyperLogLog()
+        for i in xrange(n):
+            a.add(i)
+            a.add(i)                # repeats don't count
+            b.add(i + n / 2)        # half of b overlaps a
+        for name, sketch, exact in (('a', a, n), ('a+b', a + b, n + n / 2)):
+            estimate = sketch.count()
+            error = float(estimate - exact) / exact
+            print '%-4s exact %8d estimate %8d error %6.2f%% %s' % (
+                name, exact, estimate, error * 100,
+                abs(error) <= limit and 'ok' or 'OUTSIDE %.1f%%' % (
+                    limit * 100))
+    c = HyperLogLog.fromBytes(a.toBytes())
+    print 'round trip', c.registers == a.registers
+    print 'empty', HyperLogLog().count() == 0
+
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,72 @@
+'''Id lists as ranges, for filtering on lists of ids pasted into reports.
+
+Staff paste ranges of order and book ids covering thousands of ids; as an
+IN list each id is a separate comparison in the statement, where a run of
+consecutive ids is one BETWEEN on the primary key.  idRanges sorts and
+merges the ids into runs and leaves the ids of short runs as a residual
+list, so a filter is a few BETWEENs and a small IN.'''
+
+import random
+import time
+
+# runs shorter than this stay in the IN list
+MIN_RUN = 3
+
+
+def idRanges(ids, min_run=MIN_RUN):
+    '''Return ([(first, last), ...], [id, ...]): the runs of at least
+    min_run consecutive ids, inclusive, and the rest of the ids, both
+    sorted, as integers and without repeats.'''
+    ranges = []
+    singles = []
+    run = None
+    for id in sorted(set(int(id) for id in ids)):
+        if run and id == run[1] + 1:
+            run[1] = id
+            continue
+        if run:
+            _close(run, ranges, singles, min_run)
+        run = [id, id]
+    if run:
+        _close(run, ranges, singles, min_run)
+    return ranges, singles
+
+def _close(run, ranges, singles, min_run):
+    first, last = run
+    if last - first + 1 >= min_run:
+        ranges.append((first, last))
+    else:
+        singles.extend(range(first, last + 1))
+
+
+def test():
+    print idRanges([]) == ([], [])
+    print idRanges(['7', 3, 5, 4, 4, 10, 11, 1]) == ([(3, 5)], [1, 7, 10, 11])
+    print idRanges(range(100, 200) + range(300, 302)) == \
+          ([(100, 199)], [300, 301])
+    print idRanges([1, 2], min_run=2) == ([(1, 2)], [])
+
+
+def bench(sizes=(10, 1000, 100000)):
+    '''Time building the ranges for lists of ids as pasted: a few ranges
+    with some stray ids, and ids scattered at random.'''
+    random.seed(1)
+    for n in sizes:
+        pasted = []
+        start = 1000000
+        while len(pasted) < n:
+            length = random.randint(1, max(1, n / 5))
+            pasted += range(start, start + length)
+            start += length + random.randint(2, 1000)
+        pasted = pasted[:n]
+        scattered = random.sample(xrange(1000000, 1000000 + 20 * n), n)
+        for name, ids in (('pasted', pasted), ('scattered', scattered)):
+            begin = time.time()
+            ranges, singles = idRanges(ids)
+            print '%6d %-9s ids: %5d ranges %6d in list, %.4fs' % (
+                n, name, len(ranges), len(singles), time.time() - begin)
+
+
+if __name__ == '__main__':
+    test()
+    bench()
@@ -6,6 +6,7 @@ from sqlalchemy.orm.exc import NoResultFound
 
 from plant.resources import res
 from plant.dbengine import transactional
+from tracing import traced
 from plant.model import WorkflowItem, User, State
 
 
@@ -72,6 +73,7 @@ class WorkflowInterface(object):
         workitem = self.getWorkflowItem(order_item_id)
         next = self.getNextActivity(session, workitem)
         workitem.activity_id = self.activities.getId(next)
+        self.pipeline.move(session, {}, [workitem])
 
 
     @transactional
@@ -99,6 +101,7 @@ class WorkflowInterface(object):
             raise WorkflowError('No valid entity_ids were provided')
         return entity_name, entity_id
 
+    @traced
     @transactional
     def updateWorkflow(self, session, activity_code, order_item_id=None, 
                        batch_id=None, product_item_id=None, user_id=User.AUTO, 
@@ -125,25 +128,30 @@ class WorkflowInterface(object):
             entity_id = order_item_id or batch_id or product_item_id
             raise WorkflowUpdateError('Not found: %s' % entity_id)
         entity_type = entity_name[:-3]  # strip _id
+        workitems = []
         if entity_name == 'order_item_id':
-            workitem = self.getWorkflowItem(session, entity_id)
-            self._updateWorkflowItem(session, activity_code, workitem, user_id)
+            workitems.append(self.getWorkflowItem(session, entity_id))
         elif entity_name == 'product_item_id':
             orderitems = self.productItems.getProductItem(
                 session, entity_id).order_items
             # loop through all order_items with given product_item_id
             for oi in orderitems:
-                workitem = self.getWorkflowItem(session, oi.order_item_id)
-                self._updateWorkflowItem(session, activity_code, 
-                                         workitem, user_id)
+                workitems.append(self.getWorkflowItem(session,
+                                                      oi.order_item_id))
         elif entity_name == 'batch_id':
             batchitems = self.batches.getBatch(session, entity_id).items
             # loop through all order_items with given batch_id
             for bi in batchitems:
                 if not bi.active: continue
-                workitem = self.getWorkflowItem(session, bi.order_item_id)
-                self._updateWorkflowItem(session, activity_code, 
-                                         workitem, user_id)
+                workitems.append(self.getWorkflowItem(session,
+                                                      bi.order_item_id))
+        states = set(wi.state_id for wi in workitems)
+        before = self.pipeline.snapshot(workitems)
+        for workitem in workitems:
+            self._updateWorkflowItem(session, activity_code, workitem, user_id)
+        states.update(wi.state_id for wi in workitems)
+        self.pipeline.move(session, before, workitems)
+        self._invalidateReports(session, workitems, states)
         # update history
         now = datetime.now()
         self.histories.updateHistory(session, entity_type, entity_id,
@@ -182,6 +190,7 @@ class WorkflowInterface(object):
         return True
 
 
+    @traced
     @transactional
     def errorWorkflow(self, session, order_item_id=None, batch_id=None, 
                       product_item_id=None, user_id=User.AUTO, comments=None):
@@ -201,15 +210,21 @@ class WorkflowInterface(object):
         workitems = self.getWorkItems(session, order_item_id, 
                                       batch_id, product_item_id)
         entity_type = entity_name[:-3]
+        states = set([State.ERROR])
+        before = self.pipeline.snapshot(workitems)
         for wi in workitems:
+            states.add(wi.state_id)
             wi.state_id = State.ERROR
             wi.user_id = user_id
             session.add(wi)
+        self.pipeline.move(session, before, workitems)
+        self._invalidateReports(session, workitems, states)
         # update history
         now = datetime.now()
         self.histories.updateHistory(session, entity_type, entity_id, 'error',
                                      now, user_id, comments)
         
+    @traced
     @transactional
     def setState(self, session, state_id, order_item_id=None, batch_id=None,
                 product_item_id=None):
@@ -221,15 +236,46 @@ class WorkflowInterface(object):
            Return list of order_item_ids altered.
         """
         orders = []
-        for wi in self.getWorkItems(session, order_item_id, 
-                                    batch_id, product_item_id):
-            if batch_id is None and state_id == State.INPROGRESS and \
-               self.activities.get(wi.activity_id)['entity_type'] == 'batch':
-                return self.setState(session, state_id, batch_id=wi.batch_id)
+        workitems = []
+        states = set([state_id])
+        items = self.getWorkItems(session, order_item_id, batch_id,
+                                  product_item_id)
+        # decided before changing any item, so the batch's items are all
+        # counted moving from their states before
+        if batch_id is None and state_id == State.INPROGRESS:
+            for wi in items:
+                if self.activities.get(wi.activity_id)['entity_type'] == \
+                   'batch':
+                    return self.setState(session, state_id,
+                                         batch_id=wi.batch_id)
+        before = self.pipeline.snapshot(items)
+        for wi in items:
+            states.add(wi.state_id)
             wi.state_id = state_id
             orders.append(wi.order_item_id)
+            workitems.append(wi)
             session.add(wi)
+        self.pipeline.move(session, before, workitems)
+        self._invalidateReports(session, workitems, states)
         return orders
+
+    @transactional
+    def _invalidateReports(self, session, workitems, states):
+        """Make the cached report results covering the changed work items
+        stale, by the items' order months and their states before and after
+        the change (see resultcache)."""
+        from resultcache import getCache, changeTags
+        cache = getCache()
+        ids = [wi.order_item_id for wi in workitems if wi.order_item_id]
+        if cache is None or not ids:
+            return
+        from sqlalchemy import func
+        from plant.model import Order, OrderItem
+        q = session.query(func.date_format(Order.order_date, '%Y-%m'))\
+            .filter(Order.order_id == OrderItem.order_id)\
+            .filter(OrderItem.order_item_id.in_(ids))\
+            .distinct()
+        cache.invalidate(changeTags(states, [m for (m,) in q]))
     
     @transactional
     def unError(self, session, order_item_id=None, batch_id=None,
@@ -443,6 +489,12 @@ class WorkflowInterface(object):
             self._batches = Batches()
         return self._batches
 
+    @property
+    def calendar(self):
+        ' Business day calendar for cutoff and ship by dates '
+        from bizcalendar import getCalendar
+        return getCalendar()
+
     @property
     def histories(self):
         if '_histories' not in self.__dict__:
@@ -457,6 +509,14 @@ class WorkflowInterface(object):
             self._orders = Orders()
         return self._orders
 
+    @property
+    def pipeline(self):
+        ' Work item counters for the pipeline charts '
+        if '_pipeline' not in self.__dict__:
+            from pipeline import PipelineCounters
+            self._pipeline = PipelineCounters()
+        return self._pipeline
+
     @property
     def productItems(self):
         if '_productitems' not in self.__dict__:
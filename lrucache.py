@@ -0,0 +1,107 @@
+import threading
+
+
+class LRUCache(object):
+    '''Dictionary-like cache holding at most size items, discarding the least
+    recently used when full.  Safe to share between threads.
+
+    Entries are kept in a circular doubly linked list of [prev, next, key,
+    value] links ordered by use, so lookups, insertions and evictions are
+    all O(1).'''
+
+    def __init__(self, size=1000):
+        self.size = size
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._map = {}
+            self._root = root = []
+            root[:] = [root, root, None, None]
+        finally:
+            self._lock.release()
+
+    def _unlink(self, link):
+        prev, next = link[0], link[1]
+        prev[1] = next
+        next[0] = prev
+
+    def _append(self, link):
+        # most recently used goes just before the root
+        root = self._root
+        last = root[0]
+        link[0], link[1] = last, root
+        last[1] = root[0] = link
+
+    def get(self, key, default=None):
+        self._lock.acquire()
+        try:
+            link = self._map.get(key)
+            if link is None:
+                return default
+            self._unlink(link)
+            self._append(link)
+            return link[3]
+        finally:
+            self._lock.release()
+
+    def __getitem__(self, key):
+        missing = []
+        value = self.get(key, missing)
+        if value is missing:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self._lock.acquire()
+        try:
+            link = self._map.get(key)
+            if link is not None:
+                self._unlink(link)
+                link[3] = value
+            else:
+                if len(self._map) >= self.size:
+                    oldest = self._root[1]
+                    self._unlink(oldest)
+                    del self._map[oldest[2]]
+                link = self._map[key] = [None, None, key, value]
+            self._append(link)
+        finally:
+            self._lock.release()
+
+    def __delitem__(self, key):
+        self._lock.acquire()
+        try:
+            link = self._map.pop(key)
+            self._unlink(link)
+        finally:
+            self._lock.release()
+
+    def pop(self, key, default=None):
+        try:
+            value = self[key]
+            del self[key]
+            return value
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        return key in self._map
+
+    def __len__(self):
+        return len(self._map)
+
+    def keys(self):
+        ' Keys from least to most recently used '
+        self._lock.acquire()
+        try:
+            keys = []
+            link = self._root[1]
+            while link is not self._root:
+                keys.append(link[2])
+                link = link[1]
+            return keys
+        finally:
+            self._lock.release()
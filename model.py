@@ -2,7 +2,8 @@
 
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy import Table, Column as Col, Integer as Int, String, \
-                       Date, DateTime, Numeric, ForeignKey as FK, func
+                       Date, DateTime, Numeric, Binary, ForeignKey as FK, \
+                       func
 from sqlalchemy.orm import relation
 
 # Note: the last_updated, columns don't typically appear in these classes
@@ -265,7 +266,48 @@ class CoverType(Base):
     name = Col(String)
     description = Col(String)
     active = Col(Int)
-    
+
+class CubeRollup(Base):     # daily partitions of additive cube facts
+    __tablename__ = "cube_rollups"
+    cube_rollup_id = Col(Int, primary_key=True)
+    rollup_date = Col(Date)
+    order_state_id = Col(Int)
+    client = Col(String)
+    cover_color = Col(String)
+    cover_material = Col(String)
+    currency = Col(String)
+    partner = Col(String)
+    product = Col(String)
+    product_code = Col(String)
+    product_name = Col(String)
+    product_type = Col(String)
+    ship_country = Col(String)
+    ship_method = Col(String)
+    has_product_item = Col(Int)
+    has_rate = Col(Int)
+    gross = Col(Numeric)
+    net = Col(Numeric)
+    orders = Col(Int)
+    pages = Col(Int)
+    revenue = Col(Numeric)
+    shipping = Col(Numeric)
+    tax = Col(Numeric)
+    units = Col(Int)
+    books_approx = Col(Binary)          # compressed HyperLogLog sketches
+    customers_approx = Col(Binary)
+    emails_approx = Col(Binary)
+
+class CubeRollupPartition(Base):
+    __tablename__ = "cube_rollup_partitions"
+    rollup_date = Col(Date, primary_key=True)
+    num_rows = Col(Int)
+    refreshed = Col(DateTime)
+
+class CubeRollupRefresh(Base):  # one row: when changes were last rolled up
+    __tablename__ = "cube_rollup_refreshes"
+    cube_rollup_refresh_id = Col(Int, primary_key=True)
+    refreshed = Col(DateTime)
+
 class Currency(Base):
     __tablename__ = "currencies"
     USD, GBP, EUR = (1, 2, 3)
@@ -835,6 +877,14 @@ class Permission(Base):
     description = Col(String)
     active = Col(Int)    
     
+class PipelineCount(Base):  # work items by product, activity and state
+    __tablename__ = "pipeline_counts"
+    product_code = Col(String, primary_key=True)
+    activity_id = Col(Int, primary_key=True)
+    state_id = Col(Int, primary_key=True)
+    orders = Col(Int)
+    units = Col(Int)
+
 class Press(Base):
     __tablename__ = "presses"
     press_id = Col(Int, primary_key=True)
@@ -1128,6 +1178,17 @@ class Role(Base):
     description = Col(String)
     active = Col(Int)
     
+class SearchTrigram(Base):  # index of the order search's substring searches
+    __tablename__ = "search_trigrams"
+    field = Col(String, primary_key=True)
+    trigram = Col(String, primary_key=True)
+    id = Col(Int, primary_key=True)
+
+class SearchTrigramRefresh(Base):
+    __tablename__ = "search_trigram_refreshes"
+    field = Col(String, primary_key=True)
+    refreshed = Col(DateTime)
+
 class Sharee(Base):
     __tablename__ = "sharees"
     order_item_id = Col(Int, FK("order_items.order_item_id"), primary_key=True)
@@ -2,6 +2,7 @@
 from sqlalchemy import func, desc
 from sqlalchemy.sql import and_
 from plant.dbengine import transactional
+from tracing import traced
 from plant.smartdate import Date
 from plant.odict import odict
 from plant.utils import in_any
@@ -9,13 +10,17 @@ from plant.model import BatchHistory, BatchItem, OrderItemHistory
 from plant.resources import res
 from web.htmlutil import Encryption
 from datacube import DataCube
+from shipping import ShippingResolver
 
 
 DEFAULT_FIELDS = ['foid', 'reference', 'order_datetime', 'product_name', 
                   'destination', 'qty', 'pages', 'comments']
 
 SPECIAL_FIELDS = ['print_date', 'press', 'operator', 'batch_id', 
-                  'unerror_button']
+                  'unerror_button', 'tracking_numbers', 'shipping_charge']
+
+# special fields read from the carriers' shipments
+SHIPPING_FIELDS = ['tracking_numbers', 'shipping_charge']
 
 
 class OrderDetailsProc(object):
@@ -34,25 +39,62 @@ class OrderDetailsProc(object):
     def getFields(self, rpt):
         return self.predefined.get(rpt, {}).get('fields', DEFAULT_FIELDS)
     
+    @traced
     @transactional
     def getData(self, session, rpt, filters):
         '''Get the order details data based on the given parameters.'''
+        return list(self.iterData(session, rpt, filters))
+
+    @traced
+    @transactional
+    def exportCSV(self, session, rpt, filters, out):
+        '''Write the order details as CSV to the file-like out, holding only
+        a chunk of rows in memory at a time.'''
+        import csv
+        fields = [f for f in self.getFields(rpt) if self.label(f)]
+        writer = csv.writer(out)
+        writer.writerow([self.label(f) for f in fields])
+        for d in self.iterData(session, rpt, filters):
+            row = []
+            for f in fields:
+                v = d.get(f, '')
+                if isinstance(v, unicode):
+                    v = v.encode('utf-8')
+                row.append(v)
+            writer.writerow(row)
 
+    @traced
+    def iterData(self, session, rpt, filters, chunk_size=1000):
+        '''Generate the order details rows a chunk at a time.  The session
+        must stay open while iterating.'''
 
         e = Encryption()
         filters = e.simple_decrypt(filters).split(';')
         fields = self.getFields(rpt)
         cube_fields = [c for c in fields if c not in SPECIAL_FIELDS]
-        data = []
+        # the special fields are found by the order item id, which is
+        # selected last when the report doesn't show it, and left out of
+        # the rows by zip
+        selected = cube_fields
+        if 'foid' not in selected:
+            selected = selected + ['foid']
+        foid_index = selected.index('foid')
 
-        for dc in DataCube().getData(session, [], cube_fields, filters):
+        rows = DataCube().iterData(session, [], selected, filters,
+                                   chunk_size)
+        if [f for f in SHIPPING_FIELDS if f in fields]:
+            rows = self._withShipments(session, rows, foid_index, chunk_size)
+        else:
+            rows = ((dc, None) for dc in rows)
+        for dc, shipments in rows:
             d = odict(zip(cube_fields, dc))
+            foid = dc[foid_index]
             if self.predefined[rpt].get('barcoded'):
                 d.barcoded = True
             rework = 'rework_date' in fields
             if 'print_date' in fields or 'batch_id' in fields:
                 hist_batch_id = session.query(BatchItem.batch_id)\
-                                .filter((BatchItem.order_item_id == d.foid) &
+                                .filter((BatchItem.order_item_id == foid) &
                                         (BatchItem.active == 1))\
                                 .order_by(desc(BatchItem.created))\
                                 .scalar()
@@ -65,7 +107,7 @@ class OrderDetailsProc(object):
                          .scalar()
                 else:
                     dt = session.query(OrderItemHistory.history_date)\
-                         .filter(OrderItemHistory.order_item_id == d.foid)\
+                         .filter(OrderItemHistory.order_item_id == foid)\
                          .order_by(OrderItemHistory.history_date)\
                          .scalar()
                 d.print_date = dt
@@ -79,7 +121,7 @@ class OrderDetailsProc(object):
                 bh = session.query(BatchHistory)\
                      .join((BatchItem, (BatchItem.batch_id ==
                                         BatchHistory.batch_id)))\
-                     .filter((BatchItem.order_item_id == d.foid) &
+                     .filter((BatchItem.order_item_id == foid) &
                              ((BatchItem.removed_date == None) |
                               (BatchItem.removed_date > d.rework_date)) &
                              (BatchHistory.history_date < d.rework_date) &
@@ -91,7 +133,7 @@ class OrderDetailsProc(object):
                     d.operator = bh.user.username
                 else:
                     oh = session.query(OrderItemHistory)\
-                         .filter((OrderItemHistory.order_item_id == d.foid) &
+                         .filter((OrderItemHistory.order_item_id == foid) &
                                  (OrderItemHistory.history_date < 
                                   d.rework_date) &
                                  (OrderItemHistory.activity_id.in_(
@@ -102,6 +144,12 @@ class OrderDetailsProc(object):
                         d.press = oh.comments.split(' ')[-1]
                         d.operator = oh.user.username
                     
+            if shipments is not None:
+                d.tracking_numbers = ', '.join(s.tracking_number
+                                               for s in shipments
+                                               if s.tracking_number)
+                d.shipping_charge = sum([s.charge or 0 for s in shipments])
+
             if 'pdf' in fields:
                 import os.path
                 d.pdfname = os.path.basename(d.pdf)
@@ -109,6 +157,19 @@ class OrderDetailsProc(object):
                 d.log = "http://wcom.mypublisher.com/merc/cutomertransform" \
                         "details.asp?filename=%s" % os.path.basename(d.dime)
 
-            data.append(d)
-            
-        return data
+            yield d
+
+    def _withShipments(self, session, rows, foid, chunk_size):
+        '''Generate (row, shipments) for the cube rows, whose order item id
+        is at index foid, finding the shipments of a chunk of rows at a
+        time.'''
+        from itertools import islice
+        resolver = ShippingResolver()
+        while True:
+            chunk = list(islice(rows, chunk_size))
+            if not chunk:
+                return
+            shipments = resolver.getShipments(session,
+                                              [r[foid] for r in chunk])
+            for r in chunk:
+                yield r, shipments.get(r[foid], [])
@@ -1,150 +1,456 @@
 # -*- coding: utf-8 -*-
 import os
 import re
+import copy
 from math import ceil
-from decimal import Decimal
-from sqlalchemy import desc
-from sqlalchemy.sql import between, or_, alias
-from sqlalchemy.orm import aliased, eagerload
+from decimal import Decimal, ROUND_HALF_EVEN
+from sqlalchemy.sql import between, distinct, func, or_, alias
+from sqlalchemy.orm import aliased, eagerload, eagerload_all
 from plant.dbengine import transactional
+from tracing import traced
 from plant.smartdate import Date
 from datetime import datetime
 from plant.controllers.orders import Orders
-from plant.controllers.batches import Batches
 from plant.controllers.payments import Invoices
-from plant.model import Address, Association, Coupon, Customer, Email, \
+from plant.model import Activity, Address, Association, BatchItem, Coupon, \
+                        Currency, Customer, Email, \
                         ExchangeRate, GiftCertificate, Invoice2, Order, \
-                        OrderDiscount, OrderItem, OrderItemFeature, Payment, \
+                        OrderComment, OrderDiscount, OrderItem, \
+                        OrderItemFeature, Partner, Payment, \
                         PaymentTransaction, Product, ProductItem, ProductType, \
-                        Promotion, Refund, ShippingEndicia, \
-                        ShippingEndiciaHistory, ShippingFedex, ShippingMethod, \
+                        Promotion, Refund, ShippingMethod, \
                         SoftwareVersion, State, WorkflowItem
 from web.reportutils import parseOrderIds
 from reporting import formatDollars, until, FEDEX, USPS, ROYAL, UPS
+from searchindex import SearchIndex
+from idranges import idRanges
+from shipping import ShippingResolver
 
 BillAddress = aliased(Address)
 ShipAddress = aliased(Address)
 
+# The tables a search can join to its order items and orders for the
+# filters, in join order: the table, the join condition, the tables it joins
+# through and how it's joined.  What the results show is loaded by
+# SearchPrefetch from the ids the search finds.
+SEARCH_JOINS = [
+    (Customer, Customer.customer_id == Order.customer_id, (), 'join'),
+    (WorkflowItem, WorkflowItem.order_item_id == OrderItem.order_item_id, (),
+     'outerjoin'),
+    (Association, Association.association_id == Order.association_id, (),
+     'outerjoin'),
+    (OrderItemFeature,
+     OrderItemFeature.order_item_id == OrderItem.order_item_id, (),
+     'outerjoin'),
+    (OrderDiscount, OrderDiscount.order_id == Order.order_id, (),
+     'outerjoin'),
+    (Promotion, Promotion.promotion_id == OrderDiscount.promotion_id,
+     (OrderDiscount,), 'outerjoin'),
+    (Coupon, Coupon.coupon_id == OrderDiscount.coupon_id, (OrderDiscount,),
+     'outerjoin'),
+    (SoftwareVersion,
+     SoftwareVersion.software_version_id == Order.software_version_id, (),
+     'outerjoin'),
+    (Invoice2, Invoice2.order_item_id == OrderItem.order_item_id, (),
+     'outerjoin'),
+    (Payment, Payment.invoice_id == Invoice2.invoice_id, (Invoice2,),
+     'outerjoin'),
+    (PaymentTransaction, PaymentTransaction.payment_id == Payment.payment_id,
+     (Payment,), 'outerjoin'),
+    (BillAddress, Order.billing_address_id == BillAddress.address_id, (),
+     'outerjoin'),
+    (ShipAddress, Order.shipping_address_id == ShipAddress.address_id, (),
+     'outerjoin'),
+    (Email, Order.email_id == Email.email_id, (), 'outerjoin')]
+
+# The columns of the orders the results show, selected rather than loaded
+# as Orders with their many-to-one relations.
+BillTo = Address.__table__.alias('bill_to')
+ShipTo = Address.__table__.alias('ship_to')
+ADDRESS_FIELDS = ['first_name', 'last_name', 'address1', 'address2', 'city',
+                  'state', 'zip_code', 'country', 'phone']
+ORDER_COLUMNS = [
+    Order.order_id, Order.reference_number, Order.order_date,
+    Order.purchase_date, Order.flags, Order.billing_address_id,
+    Order.shipping_address_id, Order.shipping_method_id, Order.email_id,
+    State.name.label('state'), Customer.username,
+    Customer.first_name.label('customer_first_name'),
+    Customer.last_name.label('customer_last_name'), Customer.country_code,
+    Email.email, Partner.name.label('partner'),
+    Association.name.label('association'), Currency.code.label('currency'),
+    ShippingMethod.name.label('shipping_method'),
+    ShippingMethod.description.label('shipping_method_description'),
+    SoftwareVersion.code.label('software_version')] + \
+    [BillTo.c[f].label('bill_' + f) for f in ADDRESS_FIELDS] + \
+    [ShipTo.c[f].label('ship_' + f) for f in ADDRESS_FIELDS]
+ORDER_FROM = Order.__table__\
+    .outerjoin(State.__table__, State.state_id == Order.state_id)\
+    .outerjoin(Customer.__table__, Customer.customer_id == Order.customer_id)\
+    .outerjoin(Email.__table__, Email.email_id == Order.email_id)\
+    .outerjoin(Partner.__table__, Partner.partner_id == Order.partner_id)\
+    .outerjoin(Association.__table__,
+               Association.association_id == Order.association_id)\
+    .outerjoin(Currency.__table__, Currency.currency_id == Order.currency_id)\
+    .outerjoin(ShippingMethod.__table__,
+               ShippingMethod.shipping_method_id == Order.shipping_method_id)\
+    .outerjoin(SoftwareVersion.__table__,
+               SoftwareVersion.software_version_id ==
+               Order.software_version_id)\
+    .outerjoin(BillTo, BillTo.c.address_id == Order.billing_address_id)\
+    .outerjoin(ShipTo, ShipTo.c.address_id == Order.shipping_address_id)
+
+def idCriterion(column, ids):
+    """Return the criterion that column is one of the ids, as a BETWEEN
+    for each run of consecutive ids and an IN of the rest."""
+    ranges, singles = idRanges(ids)
+    criteria = [between(column, first, last) for first, last in ranges]
+    if singles:
+        criteria.append(column.in_(singles))
+    if len(criteria) == 1:
+        return criteria[0]
+    return or_(*criteria)
+
+def joins(*tables):
+    """Declare the tables of SEARCH_JOINS a _filterBy method's criteria use,
+    which the search joins only when the method filters.  The methods
+    return the filtered query, or None when the params don't filter."""
+    def declare(method):
+        method.tables = tables
+        return method
+    return declare
+
+# The fields of an order of the search results, and those of them that are
+# amounts of money, which are kept in cents until read
+SEARCH_FIELDS = (
+    'foid', 'vip', 'book_id', 'batch_id', 'order_number', 'orig_order_num',
+    'order_state', 'batch_state', 'mfg_state', 'show_mfg_state',
+    'show_batch_state', 'before_coupon', 'gross', 'tax', 'discount',
+    'order_total', 'cc_paid', 'order_date', 'date', 'ship_date', 'ship_dates',
+    'partner', 'promo', 'coupon_code', 'assoc', 'shipping', 'fee', 'ship_to',
+    'ship_address', 'ship_city', 'ship_state', 'ship_zip', 'ship_country',
+    'ship_phone', 'method', 'method_link', 'method_title', 'bill_to',
+    'bill_address', 'bill_city', 'bill_state', 'bill_zip', 'bill_country',
+    'bill_phone', 'bill_email', 'product', 'simplex_duplex', 'qty', 'pages',
+    'cover_color', 'leather', 'orientation', 'tracking_number',
+    'tracking_numbers', 'custom_info', 'currency', 'comments', 'verisign',
+    'dc_transaction_number', 'charge_date', 'cover_thumb', 'pdf', 'dime_url',
+    'client', 'payment_processor', 'user_id', 'refunds', 'product_group',
+    'return_address', 'recipient', 'recipient_email', 'redeemed_orders',
+    'gc_code', 'gc_amount', 'gc_amount_redeemed', 'gc_balance', 'gift_certs')
+MONEY_FIELDS = frozenset([
+    'before_coupon', 'gross', 'tax', 'discount', 'order_total', 'cc_paid',
+    'shipping', 'fee', 'gc_amount', 'gc_amount_redeemed', 'gc_balance'])
+
+def cents(amount):
+    """Return the amount as an integer number of cents, rounded half to
+    even in decimal so money never goes through a float."""
+    return int(Decimal(amount).scaleb(2).to_integral_value(ROUND_HALF_EVEN))
+
+def formatCents(amount):
+    """Return cents formatted as "%0.2f" formats the amount."""
+    sign = amount < 0 and "-" or ""
+    return "%s%d.%02d" % (sign, abs(amount) // 100, abs(amount) % 100)
+
+class SearchRow(object):
+    """An order of the search results, with dict-like access to its fields
+    as the report reads them.
+
+    The fields are slots, so the orders share one schema rather than each
+    having a dict of its own, and amounts of money are kept in cents and
+    only formatted when read by key."""
+    __slots__ = SEARCH_FIELDS
+
+    def __init__(self, **fields):
+        for name, value in fields.iteritems():
+            setattr(self, name, value)
+
+    def __getitem__(self, name):
+        try:
+            value = getattr(self, name)
+        except AttributeError:
+            raise KeyError(name)
+        if name in MONEY_FIELDS:
+            return formatCents(value)
+        return value
+
+    def get(self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def __contains__(self, name):
+        return name in SEARCH_FIELDS
+    has_key = __contains__
+
+    def keys(self):
+        return list(SEARCH_FIELDS)
+
+    def __iter__(self):
+        return iter(SEARCH_FIELDS)
+
+    def items(self):
+        return [(name, self[name]) for name in SEARCH_FIELDS]
+
 class RptOrder(object):
     """Place to assign order related data representing an order to the report.
     Useful as opposed to passing nearly a hundred fields around in arg lists."""
     def assignFields(self, order_list):
-        """Assign the fields collected to the order dict expected by the report
-        and append that to the list passed in."""
-        order_list.append(
-            {"foid": self.order.order_id,
-             "vip": self.vip,
-             "book_id": self.product_item_id,
-             "batch_id": self.batch_id,
-             "order_number": self.order_number,
-             "orig_order_num": self.original_order_number,
-             "order_state": self.order_state,
-             "batch_state": self.batch_state,
-             "mfg_state": self.mfg_state,
-             "show_mfg_state": self.show_mfg_state,
-             "show_batch_state": self.show_batch_state,
-             "before_coupon": "%0.2f" % self.gross,
-             "gross": "%0.2f" % self.net, # yes it seems wrong but it's not
-             "tax": "%0.2f" % self.tax,
-             "discount": "%0.2f" % (self.gross - self.net),
-             "order_total": "%0.2f" % self.order_total,
-             "cc_paid": "%0.2f" % self.cc_paid,
-             "order_date": self.order_date,
-             "date": self.date,
-             "ship_date": self.ship_date,
-             "ship_dates": self.ship_dates,
-             "partner": self.partner,
-             "promo": self.promo,
-             "coupon_code": self.coupon_code,
-             "assoc": self.assoc,
-             "shipping": "%0.2f" % self.shipping,
-             "fee": "%0.2f" % self.fee,
-             "ship_to": self.ship_to,
-             "ship_address": self.ship_address,
-             "ship_city": self.ship_city,
-             "ship_state": self.ship_state,
-             "ship_zip": self.ship_zip,
-             "ship_country": self.ship_country,
-             "ship_phone": self.ship_phone,
-             "method": self.method,
-             "method_link": self.method_link,
-             "method_title": self.method_title,
-             "bill_to": self.bill_to,
-             "bill_address": self.bill_address,
-             "bill_city": self.bill_city,
-             "bill_state": self.bill_state,
-             "bill_zip": self.bill_zip,
-             "bill_country": self.bill_country,
-             "bill_phone": self.bill_phone,
-             "bill_email": self.bill_email,
-             "product": self.product, 
-             "simplex_duplex": self.simplex_duplex, 
-             "qty": self.qty, 
-             "pages": self.pages, 
-             "cover_color": until(self.cover_color, "_"),
-             "leather": self.leather,
-             "orientation": self.orientation,
-             "tracking_number": self.tracking_number,
-             "tracking_numbers": self.tracking_numbers,
-             "custom_info": self.theme,
-             "currency": self.currency,
-             "comments": self.comments,
-             "verisign": self.dc_transaction_number,
-             "dc_transaction_number": self.dc_transaction_number,
-             "charge_date": self.charge_date,
-             "cover_thumb": self.cover_thumb,
-             "pdf": self.pdf_url,
-             "dime_url": self.dime_url,
-             "client": self.version,            
-             "payment_processor": self.payment_processor,
-             "user_id": self.order.customer.username,
-             "refunds": self.refunds,
-             "product_group": self.product_group,
-             "return_address": self.return_address,
-             "recipient": self.recipient,
-             "recipient_email": self.recipient_email,
-             "redeemed_orders": self.redeemed_orders,
-             "gc_code": self.gc_code,
-             "gc_amount": "%0.2f" % self.gc_amount,
-             "gc_amount_redeemed": "%0.2f" % self.gc_amount_redeemed,
-             "gc_balance": "%0.2f" % self.gc_balance,
-             "gift_certs": self.gift_certs})
+        """Assign the fields collected to the order row expected by the report
+        and append that to the list passed in.  The row keeps none of the
+        objects the fields came from."""
+        order_list.append(SearchRow(
+            foid=self.order.order_id,
+            vip=self.vip,
+            book_id=self.product_item_id,
+            batch_id=self.batch_id,
+            order_number=self.order_number,
+            orig_order_num=self.original_order_number,
+            order_state=self.order_state,
+            batch_state=self.batch_state,
+            mfg_state=self.mfg_state,
+            show_mfg_state=self.show_mfg_state,
+            show_batch_state=self.show_batch_state,
+            before_coupon=cents(self.gross),
+            gross=cents(self.net), # yes it seems wrong but it's not
+            tax=cents(self.tax),
+            discount=cents(self.gross - self.net),
+            order_total=cents(self.order_total),
+            cc_paid=cents(self.cc_paid),
+            order_date=self.order_date,
+            date=self.date,
+            ship_date=self.ship_date,
+            ship_dates=self.ship_dates,
+            partner=self.partner,
+            promo=self.promo,
+            coupon_code=self.coupon_code,
+            assoc=self.assoc,
+            shipping=cents(self.shipping),
+            fee=cents(self.fee),
+            ship_to=self.ship_to,
+            ship_address=self.ship_address,
+            ship_city=self.ship_city,
+            ship_state=self.ship_state,
+            ship_zip=self.ship_zip,
+            ship_country=self.ship_country,
+            ship_phone=self.ship_phone,
+            method=self.method,
+            method_link=self.method_link,
+            method_title=self.method_title,
+            bill_to=self.bill_to,
+            bill_address=self.bill_address,
+            bill_city=self.bill_city,
+            bill_state=self.bill_state,
+            bill_zip=self.bill_zip,
+            bill_country=self.bill_country,
+            bill_phone=self.bill_phone,
+            bill_email=self.bill_email,
+            product=self.product,
+            simplex_duplex=self.simplex_duplex,
+            qty=self.qty,
+            pages=self.pages,
+            cover_color=until(self.cover_color, "_"),
+            leather=self.leather,
+            orientation=self.orientation,
+            tracking_number=self.tracking_number,
+            tracking_numbers=self.tracking_numbers,
+            custom_info=self.theme,
+            currency=self.currency,
+            comments=self.comments,
+            verisign=self.dc_transaction_number,
+            dc_transaction_number=self.dc_transaction_number,
+            charge_date=self.charge_date,
+            cover_thumb=self.cover_thumb,
+            pdf=self.pdf_url,
+            dime_url=self.dime_url,
+            client=self.version,
+            payment_processor=self.payment_processor,
+            user_id=self.order.username,
+            refunds=self.refunds,
+            product_group=self.product_group,
+            return_address=self.return_address,
+            recipient=self.recipient,
+            recipient_email=self.recipient_email,
+            redeemed_orders=self.redeemed_orders,
+            gc_code=self.gc_code,
+            gc_amount=cents(self.gc_amount),
+            gc_amount_redeemed=cents(self.gc_amount_redeemed),
+            gc_balance=cents(self.gc_balance),
+            gift_certs=self.gift_certs))
+
+# ids per IN list when prefetching
+CHUNK = 500
+# orders per page of search results
+PAGE_SIZE = 50
+# searches the planner expects to examine more rows than this aren't counted
+# by estimate()
+COUNT_LIMIT = 100000
+
+def byKey(rows, key):
+    """Return the rows in lists by key(row), in order."""
+    groups = {}
+    for row in rows:
+        groups.setdefault(key(row), []).append(row)
+    return groups
+
+class SearchPrefetch(object):
+    """What the report reads about the orders and items of a search, given
+    their (order_id, order_item_id), loaded with one query per table (per
+    CHUNK ids) instead of several per order.
+
+    The orders are selected as rows of ORDER_COLUMNS.  The items, in order
+    with their work items, and the objects related to them are loaded into
+    the session, where the relations the _determine methods follow find
+    them without a query, and kept here since the session only holds weak
+    references to them.  The rest is kept in maps by order or order item
+    id."""
+
+    def __init__(self, session, ids):
+        self.session = session
+        self.keep = []
+        item_ids = sorted(set(item_id for order_id, item_id in ids))
+        order_ids = sorted(set(order_id for order_id, item_id in ids))
+
+        # small tables whole, for the many-to-one relations
+        self.keep += session.query(Product)\
+                     .options(eagerload('product_type')).all()
+        self.keep += session.query(State).all()
+        self.keep += session.query(Activity).all()
+
+        # the orders as columns, with their comments and discounts
+        self.orders = dict((row.order_id, row) for row in self._all(
+            session.query(*ORDER_COLUMNS).select_from(ORDER_FROM),
+            Order.order_id, order_ids))
+        self.comments = byKey(self._all(
+            session.query(OrderComment.order_id, OrderComment.txt)
+            .order_by(OrderComment.comment_date),
+            OrderComment.order_id, order_ids), lambda c: c.order_id)
+        self.discounts = byKey(self._all(
+            session.query(OrderDiscount.order_id,
+                          Promotion.code.label('promotion'),
+                          Coupon.code.label('coupon'))
+            .select_from(OrderDiscount.__table__
+                         .outerjoin(Promotion.__table__,
+                                    Promotion.promotion_id ==
+                                    OrderDiscount.promotion_id)
+                         .outerjoin(Coupon.__table__,
+                                    Coupon.coupon_id ==
+                                    OrderDiscount.coupon_id))
+            .order_by(OrderDiscount.order_discount_id),
+            OrderDiscount.order_id, order_ids), lambda d: d.order_id)
+        # the items and their work items, in order, with the items'
+        # one-to-one and one-to-many relations
+        self.items = self._all(
+            session.query(OrderItem, WorkflowItem)
+            .outerjoin((WorkflowItem, WorkflowItem.order_item_id ==
+                                      OrderItem.order_item_id))
+            .options(eagerload_all('feature.page_siding'),
+                     eagerload_all('feature.cover_color'),
+                     eagerload_all('feature.cover_type'),
+                     eagerload_all('feature.cover_material'),
+                     eagerload_all('gift_certificate.recipient_email'),
+                     eagerload('return_address'),
+                     eagerload_all('invoices.invoice.payments.transactions.'
+                                   'transaction_type'),
+                     eagerload_all('invoices.invoice.payments.transactions.'
+                                   'payment_processor')),
+            OrderItem.order_item_id, item_ids)
+        self.items.sort(key=lambda (oi, wi): (oi.order_id, oi.order_item_id))
+        items = [oi for oi, wi in self.items]
+        orig_ids = set(oi.orig_order_item_id for oi in items
+                       if oi.orig_order_item_id) - set(item_ids)
+        self.keep += self._all(session.query(OrderItem)
+                               .options(eagerload('order')),
+                               OrderItem.order_item_id, orig_ids)
+        self.keep += self._all(session.query(ProductItem).options(
+            eagerload('theme'), eagerload('image_basepath'),
+            eagerload('download_path')), ProductItem.product_item_id,
+            set(oi.product_item_id for oi in items if oi.product_item_id))
+
+        self.refunds = byKey(self._all(session.query(Refund).options(
+            eagerload('reason_category'), eagerload('reason_subcategory'),
+            eagerload('user'), eagerload('currency')), Refund.order_id,
+            order_ids), lambda r: r.order_id)
+        self.coupons = byKey(self._all(session.query(Coupon).options(
+            eagerload('reason_category'), eagerload('reason_subcategory'),
+            eagerload('user'), eagerload('currency')), Coupon.orig_order_id,
+            order_ids), lambda c: c.orig_order_id)
+        self.batch_ids = byKey(
+            self._all(session.query(BatchItem.order_item_id,
+                                    BatchItem.batch_id)
+                      .filter(BatchItem.active == 1)
+                      .order_by(BatchItem.batch_id),
+                      BatchItem.order_item_id, item_ids),
+            lambda b: b.order_item_id)
+        # gift certificates redeemed on the items
+        self.gift_certs = byKey(self._all(
+            session.query(Invoice2.order_item_id, OrderItem, Payment)
+            .filter(Payment.invoice_id == Invoice2.invoice_id)
+            .filter(OrderItem.order_item_id == Payment.gc_order_item_id)
+            .options(eagerload('gift_certificate'))
+            .order_by(Payment.payment_id),
+            Invoice2.order_item_id, item_ids), lambda g: g[0])
+
+        # shipping is found from all the items of the orders, whether or
+        # not they matched the search
+        order_of = dict(self._all(session.query(OrderItem.order_item_id,
+                                                OrderItem.order_id),
+                                  OrderItem.order_id, order_ids))
+        shipments = ShippingResolver().getShipments(session, order_of)
+        self.shipments = {}
+        for item_id, rows in shipments.iteritems():
+            self.shipments.setdefault(order_of[item_id], []).extend(rows)
+        for rows in self.shipments.values():
+            rows.sort(key=lambda s: s.ship_date)
+
+    def _all(self, q, column, ids):
+        rows = []
+        ids = list(ids)
+        for n in range(0, len(ids), CHUNK):
+            rows += q.filter(column.in_(ids[n:n + CHUNK])).all()
+        return rows
+
 
 class OrderSearchProc(object):
     """Provides order search data."""
 
     def __init__(self):
         self.orders = Orders()
-        self.batches = Batches()
         self.invoices = Invoices()
+        self.search_index = SearchIndex()
         
-    def _filterByDate(self, q, start_date, end_date, params):
+    def _filterByDate(self, q, column, start_date, end_date):
         if start_date and end_date:
             s_date = Date(start_date)
             e_date = Date(end_date) + 1
-            if params.date_type == "order_date":
-                q = q.filter((Order.order_date >= s_date) &
-                             (Order.order_date < e_date))
-            else:
-                q = q.filter((Invoice2.ship_date >= s_date) &
-                             (Invoice2.ship_date < e_date))
+            q = q.filter((column >= s_date) & (column < e_date))
         elif start_date:
             s_date = Date(start_date)            
-            if params.data_type == "order_date":
-                q = q.filter(Order.order_date >= s_date) 
-            else:
-                q = q.filter(Invoice2.ship_date >= s_date) 
+            q = q.filter(column >= s_date) 
         elif end_date:
             e_date = Date(end_date)            
-            if params.data_type == "order_date":
-                q = q.filter(Order.order_date < e_date)
-            else:
-                q = q.filter(Invoice2.ship_date < e_date)                 
+            q = q.filter(column < e_date)
+        else:
+            return None
         return q
+
+    def _filterByOrderDate(self, q, start_date, end_date, params):
+        if params.date_type == "order_date":
+            return self._filterByDate(q, Order.order_date, start_date,
+                                      end_date)
+        return None
+
+    @joins(Invoice2)
+    def _filterByShipDate(self, q, start_date, end_date, params):
+        if params.date_type != "order_date":
+            return self._filterByDate(q, Invoice2.ship_date, start_date,
+                                      end_date)
+        return None
     
+    @joins(ShipAddress)
     def _filterByShipCountry(self, q, params):                        
         if not params.ship_country:
-            return q
+            return None
 
         ship_country = params.ship_country
 
@@ -160,8 +466,11 @@ class OrderSearchProc(object):
             q = q.filter(ShipAddress.country.in_(ship_country))
         elif "*" in params.ship_country:
             q = q.filter(~ShipAddress.country.in_(["US", "CA"]))
+        else:
+            return None
         return q
 
+    @joins(OrderItemFeature)
     def _filterByProduct(self, q, params):
         if hasattr(params.skus, '__iter__'):
             skus = []
@@ -235,18 +544,19 @@ class OrderSearchProc(object):
                 "APPLE_SMSOFT_IC_D" in skus):
                 criteria.append(OrderItem.product_id.between(4, 7))
         
-            q = q.filter(or_(*criteria))
-                         
-        return q
+            if criteria:
+                return q.filter(or_(*criteria))
+        return None
 
+    @joins(WorkflowItem)
     def _filterByWorkflowState(self, q, params):
         if params.order_state:
             if hasattr(params.order_state, '__iter__'):
                 params.order_state = str(params.order_state)[1:-1]
             else:
                 params.order_state = "%s" % params.order_state
-            q = q.filter(WorkflowItem.state_id.in_(params.order_state))
-        return q
+            return q.filter(WorkflowItem.state_id.in_(params.order_state))
+        return None
 
     def _getOrderIDs(self, params):
         if params.order_ids.strip():
@@ -254,10 +564,10 @@ class OrderSearchProc(object):
         order_ids = []
         if params.foids.strip():
             if params.foids in ("111", "222"):
-                order_ids = [params.foids]
+                order_ids = [int(params.foids)]
             else:
                 try:
-                    order_ids = map(str, parseOrderIds(params.foids))
+                    order_ids = map(int, parseOrderIds(params.foids))
                 except (ValueError, TypeError):
                     pass
         return order_ids
@@ -266,7 +576,7 @@ class OrderSearchProc(object):
         product_item_ids = []
         if params.book_ids.strip():
             try:
-                product_item_ids = map(str, parseOrderIds(params.book_ids))
+                product_item_ids = map(int, parseOrderIds(params.book_ids))
             except (ValueError, TypeError):
                 pass
         return product_item_ids
@@ -284,28 +594,19 @@ class OrderSearchProc(object):
         product_item_ids = self._getProductItemIDs(params)
         reference_numbers = self._getRefNums(params)
         
+        # ids as integers, so the indexes are used, and in ranges
+        criteria = []
         if order_ids:
-            order_criteria = Order.order_id.in_(order_ids)
-        else:
-            order_criteria = None
-            
+            criteria.append(idCriterion(Order.order_id, order_ids))
         if product_item_ids:
-            product_item_criteria = ProductItem.product_item_id.in_(
-                product_item_ids)
-        else:
-            product_item_criteria = None
-
+            criteria.append(idCriterion(OrderItem.product_item_id,
+                                        product_item_ids))
         if reference_numbers:
-            reference_number_criteria = Order.reference_number.in_(
-                reference_numbers)
-        else:
-            reference_number_criteria = None
+            criteria.append(Order.reference_number.in_(reference_numbers))
 
-        if (order_criteria or product_item_criteria or
-            reference_number_criteria):
-            q = q.filter(or_(order_criteria, product_item_criteria,
-                             reference_number_criteria))
-        return q
+        if criteria:
+            return q.filter(or_(*criteria))
+        return None
 
     def _filterByStartEnd(self, q, params):
         if params.startfoid and params.endfoid:                
@@ -315,56 +616,89 @@ class OrderSearchProc(object):
             q = q.filter(Order.order_id > params.startfoid)
         elif params.endfoid:
             q = q.filter(Order.order_id < params.endfoid)
+        else:
+            return None
         return q
     
-    def _filterByFirstName(self, q, params):
-        if params.first_name:
-            q = q.filter(Customer.first_name.like("%" + params.first_name +
-                                                  "%"))
+    def _filterByIndex(self, q, session, field, term, column):
+        """Restrict column to the ids of the rows the search index finds
+        may contain the term, and those changed since it was refreshed, if
+        it can, so the LIKE that follows only checks those rows rather
+        than every one."""
+        criterion = self.search_index.criterion(session, field, term,
+                                                column)
+        if criterion is not None:
+            q = q.filter(criterion)
         return q
 
-    def _filterByLastName(self, q, params):
+    @joins(Customer)
+    def _filterByFirstName(self, q, session, params):
+        if params.first_name:
+            q = self._filterByIndex(q, session, 'first_name',
+                                    params.first_name, Order.customer_id)
+            return q.filter(Customer.first_name.like("%" + params.first_name +
+                                                     "%"))
+        return None
+
+    @joins(Customer)
+    def _filterByLastName(self, q, session, params):
         if params.last_name:
-            q = q.filter(Customer.last_name.like("%" + params.last_name + "%"))
-        return q
+            q = self._filterByIndex(q, session, 'last_name',
+                                    params.last_name, Order.customer_id)
+            return q.filter(Customer.last_name.like("%" + params.last_name +
+                                                    "%"))
+        return None
 
+    @joins(ShipAddress, BillAddress)
     def _filterByZip(self, q, params):            
-        if params.zip:
-            zip_codes = [x.strip() for x in params.zip.split(",")
-                        if x.strip()]
-            for zip_code in zip_codes:
-                q = q.filter((ShipAddress.zip_code == zip_code) |
-                             (BillAddress.zip_code == zip_code))
+        zip_codes = [x.strip() for x in (params.zip or "").split(",")
+                     if x.strip()]
+        if not zip_codes:
+            return None
+        for zip_code in zip_codes:
+            q = q.filter((ShipAddress.zip_code == zip_code) |
+                         (BillAddress.zip_code == zip_code))
         return q
 
+    @joins(Email)
     def _filterByEmail(self, q, params):
         if params.email:
-            q = q.filter(Email.email == params.email.strip())
-        return q
+            return q.filter(Email.email == params.email.strip())
+        return None
 
-    def _filterByPromo(self, q, params):
+    @joins(Promotion)
+    def _filterByPromo(self, q, session, params):
         if params.promo:
-            q = q.filter(Promotion.code.like("%" + params.promo.strip() + "%"))
-        return q
-
-    def _filterByAssoc(self, q, params):
+            q = self._filterByIndex(q, session, 'promo', params.promo,
+                                    OrderDiscount.promotion_id)
+            return q.filter(Promotion.code.like("%" + params.promo.strip() +
+                                                "%"))
+        return None
+
+    @joins(Association)
+    def _filterByAssoc(self, q, session, params):
         if params.assoc:
-            q = q.filter(Association.code.like("%" + params.assoc + "%"))
-        return q
+            q = self._filterByIndex(q, session, 'assoc', params.assoc,
+                                    Order.association_id)
+            return q.filter(Association.code.like("%" + params.assoc + "%"))
+        return None
 
+    @joins(Customer)
     def _filterByUserID(self, q, params):
         if params.user_id:
-            q = q.filter(Customer.username == params.user_id.strip())
-        return q
+            return q.filter(Customer.username == params.user_id.strip())
+        return None
 
+    @joins(Coupon)
     def _filterByCoupons(self, q, params):
         if params.coupon_codes.strip():
             coupon_codes = [x for x in re.split("[^\w-]+", params.coupon_codes)
                             if x <> ""]
-            q = q.filter(Coupon.code.in_(coupon_codes))
-        return q
+            return q.filter(Coupon.code.in_(coupon_codes))
+        return None
 
-    def _filterByVersions(self, q, params):
+    @joins(SoftwareVersion)
+    def _filterByVersions(self, q, session, params):
         if params.client:
             if hasattr(params.client, '__iter__'):
                 versions = params.client
@@ -373,8 +707,11 @@ class OrderSearchProc(object):
             for version in versions:
                 version = version.replace("bookmaker-mac", "bmm")\
                           .replace("bookmaker", "bm")                
+                q = self._filterByIndex(q, session, 'version', version,
+                                        Order.software_version_id)
                 q = q.filter(SoftwareVersion.code.like("%" + version + "%"))
-        return q
+            return q
+        return None
 
     def _filterByGiftCerts(self, q, session, params):
         # XXX This is a problem - how is gift certificate usage
@@ -402,58 +739,51 @@ class OrderSearchProc(object):
             for res in results:
                 ids += res
             if ids:
-                q = q.filter(Order.order_id.in_(ids))
-        return q
+                return q.filter(Order.order_id.in_(ids))
+        return None
 
+    @joins(PaymentTransaction)
     def _filterByTransactionNumbers(self, q, params):
         if params.dc_transaction_numbers.strip():
             sep_re = re.compile(r"\W+", re.DOTALL)
             nums = [x for x in sep_re.split(params.dc_transaction_numbers)
                     if x <> '']            
-            q = q.filter(PaymentTransaction.transaction_id.in_(nums))
-        return q
+            return q.filter(PaymentTransaction.transaction_id.in_(nums))
+        return None
             
     # -------------------------------------------------------------------------
 
-    def _determineOriginal(self, order_item):
+    def _determineOriginal(self, order, order_item):
         if order_item.orig_order_item_id:
-            orig_order = order_item.orig_order_item.order
-        else:
-            orig_order = order_item.order
-        return orig_order.reference_number
+            return order_item.orig_order_item.order.reference_number
+        return order.reference_number
             
-    def _determineCurrency(self, obj):
-        if obj.currency_id:
-            if obj.currency.code == "USD":
-                currency = u"$"
-            elif obj.currency.code == "GBP":
-                currency = u"£"
-            elif obj.currency.code == "EUR":
-                currency = u"€"
-            else:
-                currency = ""
+    def _determineCurrency(self, code):
+        if code == "USD":
+            currency = u"$"
+        elif code == "GBP":
+            currency = u"£"
+        elif code == "EUR":
+            currency = u"€"
         else:
             currency = ""
         return currency
 
-    def _determineCouponCode(self, order):
+    def _determineCouponCode(self, discounts):
         coupon_code = promo = ""
-        if order.discounts:
-            for disc in order.discounts:
-                if disc.promotion_id:
-                    promo += disc.promotion.code + ", "
-                elif disc.coupon_id:
-                    coupon_code += disc.coupon.code + ", "
+        if discounts:
+            for disc in discounts:
+                if disc.promotion:
+                    promo += disc.promotion + ", "
+                elif disc.coupon:
+                    coupon_code += disc.coupon + ", "
             promo = promo[:-2]
             coupon_code = coupon_code[:-2]
         return coupon_code, promo
 
     def _determineAssociation(self, order):
-        if order.association_id:
-            assoc = order.association.name
-            if assoc == "n/a":
-                assoc = ""
-        else:
+        assoc = order.association or ""
+        if assoc == "n/a":
             assoc = ""
         return assoc
 
@@ -467,7 +797,7 @@ class OrderSearchProc(object):
 
     def _determineShippingMethod(self, order, tracking_number):
         if order.shipping_method_id:
-            method = order.shipping_method.name
+            method = order.shipping_method
         else:
             method = ""
         method_link = ""
@@ -487,7 +817,7 @@ class OrderSearchProc(object):
             method_link = ""
             
         if method:
-            method_title = order.shipping_method.description
+            method_title = order.shipping_method_description
         else:
             method_title = ""
             
@@ -548,7 +878,7 @@ class OrderSearchProc(object):
                 simplex_duplex, cover_color, theme)
 
     def _determineStateInfo(self, session, order, order_item, workflow_item):
-        order_state = order.state.name
+        order_state = order.state
         show_mfg_state = order_item.state_id < 500
 
         # XXX assigning everything to order_state and leaving order_item_state
@@ -566,23 +896,18 @@ class OrderSearchProc(object):
             order_state = order_item.state.name
         return order_state, show_mfg_state, order_item_state
 
-    def _determineCreditCoupon(self, session, order):
+    def _determineCreditCoupon(self, prefetch, order):
         # get coupon/credit history of order
         # XXX How is the refund amount distributed across the
         # various items in an order?
         refunds = []
-        creds = session.query(Refund)\
-                .filter_by(order_id = order.order_id)\
-                .options(eagerload("reason_category"),
-                         eagerload("reason_subcategory")).all()
-        coups = session.query(Coupon)\
-                .filter_by(orig_order_id = order.order_id)\
-               .options(eagerload("reason_category"),
-                        eagerload("reason_subcategory")).all()
+        creds = prefetch.refunds.get(order.order_id, [])
+        coups = prefetch.coupons.get(order.order_id, [])
         for refs, kind in((creds, "credit"), (coups, "coupon")):
             for ref in refs:
                 date = str(Date(ref.created))
-                total = formatDollars(ref.amount, self._determineCurrency(ref))
+                total = formatDollars(ref.amount, self._determineCurrency(
+                    ref.currency_id and ref.currency.code))
                 refunds.append("%s %s issued a %s %s (%s)" % 
                                (date, ref.user.username, total, kind,
                                 ref.comments or
@@ -590,12 +915,11 @@ class OrderSearchProc(object):
                                 ref.reason_category))
         return refunds
 
-    def _determineBatchInfo(self, order_item, workflow_item):
+    def _determineBatchInfo(self, prefetch, order_item, workflow_item):
         # get Batch info, if applicable.
         batch_state = ""
         show_batch_state = False
-        batches = self.batches.getBatchesForOrderItem(order_item.order_item_id,
-                                                      active=1)
+        batches = prefetch.batch_ids.get(order_item.order_item_id)
         if batches:
             batch_id = batches[-1].batch_id
         else:
@@ -640,11 +964,11 @@ class OrderSearchProc(object):
             redeemed_orders = self.invoices.getRedeemed(order_item)
         return redeemed_orders
 
-    def _findGiftCertsForOrder(self, order_item):
+    def _findGiftCertsForOrder(self, prefetch, order_item):
         """Find gift certificates redeemed on this order."""
-        gc_data = self.invoices.getGiftCertificateData(order_item)
+        gc_data = prefetch.gift_certs.get(order_item.order_item_id, [])
         gift_certs = []
-        for order_item, payment in gc_data:
+        for id, order_item, payment in gc_data:
             if order_item.state_id in (State.CANCEL, State.COMMERCE_CANCEL):
                 amount = "0.00"
             else:
@@ -686,16 +1010,17 @@ class OrderSearchProc(object):
 
     def _determineShipTo(self, order):
         if order.shipping_address_id:
-            sa = order.shipping_address        
-            ship_to = "%s %s" % (sa.first_name or "", sa.last_name or "")
+            ship_to = "%s %s" % (order.ship_first_name or "",
+                                 order.ship_last_name or "")
             ship_to = ship_to.replace("\t", "").replace("  ", " ")\
                       .replace("  ", " ")
-            ship_address = "%s %s" % (sa.address1, sa.address2)
-            ship_city = sa.city
-            ship_state = sa.state
-            ship_zip = sa.zip_code
-            ship_country = sa.country
-            ship_phone = sa.phone
+            ship_address = "%s %s" % (order.ship_address1,
+                                      order.ship_address2)
+            ship_city = order.ship_city
+            ship_state = order.ship_state
+            ship_zip = order.ship_zip_code
+            ship_country = order.ship_country
+            ship_phone = order.ship_phone
         else:
             ship_to = ship_address = ship_city = ship_state = ship_zip = \
                       ship_country = ship_phone = ""
@@ -704,66 +1029,48 @@ class OrderSearchProc(object):
 
     def _determineBillTo(self, order):
         if order.billing_address_id:
-            ba = order.billing_address
-            bill_to = "%s %s" % (ba.first_name or "", ba.last_name or "")
+            bill_to = "%s %s" % (order.bill_first_name or "",
+                                 order.bill_last_name or "")
             bill_to = bill_to.replace("\t", "").replace("  ", " ")\
                       .replace("  ", " ")
-            bill_address = "%s %s" % (ba.address1, ba.address2)
-            bill_city = ba.city
-            bill_state = ba.state
-            bill_zip = ba.zip_code
-            bill_country = ba.country
-            bill_phone = ba.phone
-            bill_email = order.email.email
+            bill_address = "%s %s" % (order.bill_address1,
+                                      order.bill_address2)
+            bill_city = order.bill_city
+            bill_state = order.bill_state
+            bill_zip = order.bill_zip_code
+            bill_country = order.bill_country
+            bill_phone = order.bill_phone
+            bill_email = order.email
         else:
-            c = order.customer
-            bill_to = "%s %s" % (c.first_name or "", c.last_name or "")
+            bill_to = "%s %s" % (order.customer_first_name or "",
+                                 order.customer_last_name or "")
             bill_address = bill_city = bill_state = bill_zip = bill_phone = ""
-            bill_country = c.country_code
+            bill_country = order.country_code
             if order.email_id:
-                bill_email = order.email.email
+                bill_email = order.email
             else:
                 bill_email = ""
         return (bill_to, bill_address, bill_city, bill_state, bill_zip,
                 bill_country, bill_phone, bill_email)
 
-    def _determineMultiFedExShippingInfo(self, session, order):
+    def _determineMultiFedExShippingInfo(self, prefetch, order):
         # Get multiple fedex shipping info if necessary:
         ship_dates = []
         tracking_numbers = []
         if order.shipping_method_id:
-            if "fedex" in order.shipping_method.name.lower():
-                # need to coerce order_item_id to str for mysql index usage
-                q = session.query(ShippingFedex)\
-                    .filter(ShippingFedex.reference_number.in_(
-                    [str(oi.order_item_id) for oi in order.items]))\
-                    .filter(ShippingFedex.void_date == None)\
-                    .order_by(ShippingFedex.ship_date)
-                rows = q.all()
-                ship_dates = [Date(row.ship_date).format("%B %d, %Y")
-                              for row in rows]
-                tracking_numbers = [row.tracking_number for row in rows]
+            shipments = prefetch.shipments.get(order.order_id, [])
+            if "fedex" in order.shipping_method.lower():
+                rows = [s for s in shipments if s.source == 'fedex']
             else:
-                q1 = session.query(ShippingEndicia.postmark_date,
-                                   ShippingEndicia.tracking_number)\
-                     .filter(ShippingEndicia.order_item_id.in_(
-                     [str(oi.order_item_id) for oi in order.items]))\
-                     .filter(ShippingEndicia.postmark_date != None)
-                q2 = session.query(ShippingEndiciaHistory.postmark_date,
-                                   ShippingEndiciaHistory.tracking_number)\
-                     .filter(ShippingEndiciaHistory.order_item_id.in_(
-                     [str(oi.order_item_id) for oi in order.items]))\
-                     .filter(ShippingEndiciaHistory.postmark_date != None)
-                q = q1.union_all(q2)\
-                    .order_by(1)
-                rows = q.all()
-                ship_dates = [Date(row.postmark_date).format("%B %d, %Y")
-                              for row in rows]
-                tracking_numbers = [row.tracking_number for row in rows]
+                rows = [s for s in shipments if s.source != 'fedex'
+                        and s.ship_date is not None]
+            ship_dates = [Date(row.ship_date).format("%B %d, %Y")
+                          for row in rows]
+            tracking_numbers = [row.tracking_number for row in rows]
                 
         return ship_dates, tracking_numbers
 
-    def _determineLatestShippingInfo(self, session, order, tracking_numbers,
+    def _determineLatestShippingInfo(self, prefetch, order, tracking_numbers,
                                      ship_dates):
         if tracking_numbers:
             tracking_number = tracking_numbers[-1]
@@ -774,29 +1081,16 @@ class OrderSearchProc(object):
             ship_date = ship_dates[-1]
             # XXX Not quite making sense here for multiple order items. We are
             #     just getting data on whichever one was last shipped.
-            # Check Fedex shipping first
-            shipping = session.query(ShippingFedex.net_charge)\
-                       .filter(ShippingFedex.reference_number.in_(
-                                [str(oi.order_item_id) for oi in order.items]))\
-                       .filter(ShippingFedex.void_date == None)\
-                       .order_by(desc(ShippingFedex.ship_date)).first()
-            if not shipping:
-                # ok check endicia
-                shipping = session.query(ShippingEndicia.postage_amount)\
-                           .filter(ShippingEndicia.order_item_id.in_(
-                           [str(oi.order_item_id) for oi in order.items]))\
-                           .order_by(desc(ShippingEndicia.postmark_date))\
-                           .first()
-                if not shipping:
-                    # check endicia history
-                    shipping = session.query(
-                        ShippingEndiciaHistory.postage_amount)\
-                        .filter(ShippingEndiciaHistory.order_item_id.in_(
-                        [str(oi.order_item_id) for oi in order.items]))\
-                        .order_by(desc(ShippingEndiciaHistory.postmark_date))\
-                        .first()
-                    if not shipping:
-                        shipping = Decimal(0)
+            # Check Fedex shipping first, then endicia, then its history;
+            # the shipments are in date order so the last is the latest
+            shipments = prefetch.shipments.get(order.order_id, [])
+            for source in ('fedex', 'endicia', 'endicia_history'):
+                rows = [s for s in shipments if s.source == source]
+                if rows:
+                    shipping = rows[-1].charge or Decimal(0)
+                    break
+            else:
+                shipping = Decimal(0)
         else:
             ship_date = ""            
             shipping = Decimal(0)
@@ -825,26 +1119,25 @@ class OrderSearchProc(object):
             payment_processors = payment_processors[:-2]
         return payment_processors
 
-    def _gatherComments(self, order):
+    def _gatherComments(self, order_comments):
         # concatenate the comments into a string - str(list)[1:-1] no good here
         comments = ""
-        for comment in order.comments:
+        for comment in order_comments:
             comments += comment.txt + "\n"
         return comments
         
-    def _assignOrderLevelItems(self, r, session, order_item, workflow_item):
+    def _assignOrderLevelItems(self, r, session, prefetch, order_item,
+                               workflow_item):
         """Assign values that apply for the overall order as opposed to
         individual order items."""
         r.order_number = r.order.reference_number
-        r.original_order_number = self._determineOriginal(order_item)
-        if r.order.partner_id:
-            r.partner = r.order.partner.name
-        else:
-            r.partner = ""
+        r.original_order_number = self._determineOriginal(r.order, order_item)
+        r.partner = r.order.partner or ""
         r.addr = ""
         
-        r.coupon_code, r.promo = self._determineCouponCode(r.order)
-        r.currency = self._determineCurrency(r.order)
+        r.coupon_code, r.promo = self._determineCouponCode(
+            prefetch.discounts.get(r.order.order_id))
+        r.currency = self._determineCurrency(r.order.currency)
         r.assoc = self._determineAssociation(r.order)
         
         r.order_date = Date(r.order.order_date).format("%B %d, %Y")
@@ -860,10 +1153,11 @@ class OrderSearchProc(object):
                      self._determineStateInfo(session, r.order, order_item,
                                               workflow_item)
 
-        r.refunds = self._determineCreditCoupon(session, r.order)
+        r.refunds = self._determineCreditCoupon(prefetch, r.order)
         
         r.batch_id, r.batch_state, r.show_batch_state = \
-                    self._determineBatchInfo(order_item, workflow_item)
+                    self._determineBatchInfo(prefetch, order_item,
+                                             workflow_item)
 
         (r.product_group, r.return_address, r.recipient, r.recipient_email,
          r.gc_code, r.gc_amount, r.gc_amount_redeemed, r.gc_balance) = \
@@ -872,7 +1166,7 @@ class OrderSearchProc(object):
         r.redeemed_orders = self._findOrdersForGiftCert(order_item,
                                                         r.product_group)
 
-        r.gift_certs = self._findGiftCertsForOrder(order_item)
+        r.gift_certs = self._findGiftCertsForOrder(prefetch, order_item)
 
         r.mfg_state = self._determineMfgState(workflow_item)
         r.vip = self._determineVIP(r.order)
@@ -887,10 +1181,10 @@ class OrderSearchProc(object):
          self._determineBillTo(r.order)
 
         r.ship_dates, r.tracking_numbers = \
-                      self._determineMultiFedExShippingInfo(session, r.order)
+                      self._determineMultiFedExShippingInfo(prefetch, r.order)
         
         r.ship_date, r.shipping, r.tracking_number = \
-                     self._determineLatestShippingInfo(session, r.order,
+                     self._determineLatestShippingInfo(prefetch, r.order,
                                                        r.tracking_numbers,
                                                        r.ship_dates)
         if len(r.ship_dates) > 1:
@@ -914,8 +1208,9 @@ class OrderSearchProc(object):
         else:
             r.leather = ""
 
-        r.comments = self._gatherComments(r.order)
-        r.version = r.order.software_version.code\
+        r.comments = self._gatherComments(
+            prefetch.comments.get(r.order.order_id, []))
+        r.version = r.order.software_version\
                     .replace("bmm", "bookmaker-mac")\
                     .replace("bm", "bookmaker")
                              
@@ -927,28 +1222,49 @@ class OrderSearchProc(object):
         return cc_paid
 
     def _getFilters(self, q, session, start_date, end_date, params):
-        q = self._filterByDate(q, start_date, end_date, params)        
-        q = self._filterByShipCountry(q, params)
-        q = self._filterByProduct(q, params)        
-        q = self._filterByWorkflowState(q, params)
-        q = self._filterByIDs(q, params)
-        q = self._filterByStartEnd(q, params)
-        q = self._filterByFirstName(q, params)
-        q = self._filterByLastName(q, params)
-        q = self._filterByZip(q, params)
-        q = self._filterByEmail(q, params)
-        q = self._filterByPromo(q, params)
-        q = self._filterByAssoc(q, params)
-        q = self._filterByUserID(q, params)
-        q = self._filterByCoupons(q, params)
-        q = self._filterByVersions(q, params)
-        q = self._filterByGiftCerts(q, session, params)
-        q = self._filterByTransactionNumbers(q, params)
+        """Apply the filters of the params to q and join the tables those
+        that filter use."""
+        dates = (start_date, end_date, params)
+        filters = [(self._filterByOrderDate, dates),
+                   (self._filterByShipDate, dates),
+                   (self._filterByShipCountry, (params,)),
+                   (self._filterByProduct, (params,)),
+                   (self._filterByWorkflowState, (params,)),
+                   (self._filterByIDs, (params,)),
+                   (self._filterByStartEnd, (params,)),
+                   (self._filterByFirstName, (session, params)),
+                   (self._filterByLastName, (session, params)),
+                   (self._filterByZip, (params,)),
+                   (self._filterByEmail, (params,)),
+                   (self._filterByPromo, (session, params)),
+                   (self._filterByAssoc, (session, params)),
+                   (self._filterByUserID, (params,)),
+                   (self._filterByCoupons, (params,)),
+                   (self._filterByVersions, (session, params)),
+                   (self._filterByGiftCerts, (session, params)),
+                   (self._filterByTransactionNumbers, (params,))]
+        tables = set()
+        for method, args in filters:
+            filtered = method(q, *args)
+            if filtered is not None:
+                tables.update(getattr(method, 'tables', ()))
+                q = filtered
+        return self._join(q, tables)
+
+    def _join(self, q, tables):
+        """Join the tables to q, with those they join through."""
+        tables = set(tables)
+        for table, onclause, through, how in reversed(SEARCH_JOINS):
+            if table in tables:
+                tables.update(through)
+        for table, onclause, through, how in SEARCH_JOINS:
+            if table in tables:
+                q = getattr(q, how)((table, onclause))
         return q
     
-    def _setupNewRptOrder(self, order_item):
+    def _setupNewRptOrder(self, prefetch, order_item):
         r = RptOrder()
-        r.order = order_item.order                
+        r.order = prefetch.orders[order_item.order_id]
         if order_item.invoices:
             # XXX Just using first one!
             r.invoice = order_item.invoices[0].invoice
@@ -973,40 +1289,28 @@ class OrderSearchProc(object):
             r.pages += order_item.product_item.num_pages
         r.order_total += r.net + r.tax + r.fee
         
-    @transactional
-    def getData(self, session, start_date, end_date, params):
-        """Return data on items matching the given date range and params."""
-        q = session.query(OrderItem, WorkflowItem)\
-            .join(Order, Customer)\
-            .outerjoin(WorkflowItem,
-                       (ProductItem, (ProductItem.product_item_id ==
-                                      OrderItem.product_item_id)),
-                       (GiftCertificate, (GiftCertificate.order_item_id ==
-                                          OrderItem.order_item_id)),
-                       (Association, (Association.association_id ==
-                                      Order.association_id)),
-                       (OrderItemFeature, (OrderItemFeature.order_item_id ==
-                                           OrderItem.order_item_id)),
-                       (OrderDiscount, (OrderDiscount.order_id ==
-                                        Order.order_id)),
-                       (Promotion, (Promotion.promotion_id ==
-                                    OrderDiscount.promotion_id)),
-                       (Coupon, (Coupon.coupon_id == OrderDiscount.coupon_id)),
-                       (SoftwareVersion, (SoftwareVersion.software_version_id==
-                                          Order.software_version_id)),
-                       (Invoice2, (Invoice2.order_item_id == 
-                                   OrderItem.order_item_id)),
-                       (Payment, (Payment.invoice_id == Invoice2.invoice_id)),
-                       (PaymentTransaction, (PaymentTransaction.payment_id ==
-                                             Payment.payment_id)),
-                       (BillAddress, (Order.billing_address_id ==
-                                      BillAddress.address_id)),
-                       (ShipAddress, (Order.shipping_address_id ==
-                                      ShipAddress.address_id)),
-                       (Email, (Order.email_id == Email.email_id)))
-        q = self._getFilters(q, session, start_date, end_date, params)
-        q = q.order_by(OrderItem.order_id, OrderItem.order_item_id)
-        res = q.all()
+    def _query(self, session, start_date, end_date, params):
+        """Return the query of the (order_id, order_item_id) of the order
+        items matching the given date range and params, unordered.
+
+        Only the tables the active filters use are joined (see joins), so
+        a lookup by order ids is a join of order items and orders."""
+        q = session.query(OrderItem.order_id, OrderItem.order_item_id)\
+            .join((Order, Order.order_id == OrderItem.order_id))\
+            .filter(Order.customer_id != None)
+        return self._getFilters(q, session, start_date, end_date, params)
+
+    def _resolve(self, q):
+        """Return the (order_id, order_item_id) of the query q, without
+        repeats and in order."""
+        return q.distinct()\
+               .order_by(OrderItem.order_id, OrderItem.order_item_id).all()
+
+    def _buildOrders(self, session, ids):
+        """Return the report dicts of the orders of the (order_id,
+        order_item_id) ids."""
+        # load what the orders need up front rather than order by order
+        prefetch = SearchPrefetch(session, ids)
         
         order_list = []
         prev_order_id = None
@@ -1014,7 +1318,12 @@ class OrderSearchProc(object):
         # Use the first order_item as the basis for the book related data
         # for now (thumbnail, cover type etc).  A subsequent project phase
         # will address display multiple order items properly.
-        for (order_item, workflow_item) in res:
+        prev_item = None
+        for (order_item, workflow_item) in prefetch.items:
+            # an item with several work items is counted once
+            if order_item is prev_item:
+                continue
+            prev_item = order_item
             if prev_order_id != order_item.order_id:
                 if prev_order_id:
                     # Transitioning to another order so finish the calculations
@@ -1022,13 +1331,13 @@ class OrderSearchProc(object):
                     r.cc_paid += self._determineCCPaid(
                         r.order, r.order_total, r.gift_certs)
                     r.assignFields(order_list)
-                r = self._setupNewRptOrder(order_item)
+                r = self._setupNewRptOrder(prefetch, order_item)
                 prev_order_id = order_item.order_id
                 # Figure out all of the order level stuff - this for now 
                 # basing a bunch of it off of the first order item so this will
                 # need to change once we really support multiple order items.
-                self._assignOrderLevelItems(r, session, order_item,
-                                            workflow_item)                
+                self._assignOrderLevelItems(r, session, prefetch, order_item,
+                                            workflow_item)
             self._accumulateOrderItemFinancials(r, order_item)
 
         if prev_order_id:
@@ -1038,3 +1347,142 @@ class OrderSearchProc(object):
             r.assignFields(order_list)
 
         return order_list
+
+    def _page(self, session, q, after, page_size):
+        """Return the page of orders of the search query q following the
+        order id after."""
+        if after is not None:
+            q = q.filter(OrderItem.order_id > after)
+        # the ids of the page's orders and the next one, if any
+        ids = [id for id, in q.order_by(OrderItem.order_id).distinct()
+                              .limit(page_size + 1).values(OrderItem.order_id)]
+        more = len(ids) > page_size
+        ids = ids[:page_size]
+        if not ids:
+            return {'orders': [], 'last': after, 'more': False}
+        # whole orders, so the page's items are those up to its last order
+        ids = self._resolve(q.filter(OrderItem.order_id <= ids[-1]))
+        return {'orders': self._buildOrders(session, ids),
+                'last': ids[-1][0], 'more': more}
+
+    @traced
+    @transactional
+    def getData(self, session, start_date, end_date, params):
+        """Return data on items matching the given date range and params.
+
+        The search runs in two phases: finding the ids of the matching
+        order items, joining only what the filters need, then loading what
+        the results show for those ids in bulk."""
+        q = self._query(session, start_date, end_date, params)
+        return self._buildOrders(session, self._resolve(q))
+
+    @traced
+    @transactional
+    def getPage(self, session, start_date, end_date, params, after=None,
+                page_size=PAGE_SIZE):
+        """Return a page of the orders getData would return, as a dict of
+        the orders, the last order id, to pass as after for the next page,
+        and whether more orders follow.
+
+        Pages hold whole orders, so they're keyed on the order id alone:
+        the next page starts with the first order (and its first item)
+        after the last one seen, and a screen of results costs the same
+        whatever the number of orders matching."""
+        q = self._query(session, start_date, end_date, params)
+        return self._page(session, q, after, page_size)
+
+    @traced
+    def iterData(self, session, start_date, end_date, params,
+                 page_size=PAGE_SIZE):
+        """Generate the orders getData would return a page at a time, for
+        exports.  The session must stay open while iterating."""
+        q = self._query(session, start_date, end_date, params)
+        after = None
+        while True:
+            page = self._page(session, q, after, page_size)
+            for order in page['orders']:
+                yield order
+            if not page['more']:
+                return
+            after = page['last']
+
+    def _plannedRows(self, session, q):
+        """Return the rows MySQL's planner expects the query q to examine,
+        the product of the rows of each table of its plan."""
+        connection = session.connection()
+        compiled = q.statement.compile(bind=connection)
+        parameters = [compiled.params[name] for name in compiled.positiontup]
+        c = connection.connection.cursor()
+        try:
+            c.execute('EXPLAIN ' + str(compiled), parameters)
+            names = [d[0] for d in c.description]
+            rows = 1
+            for row in c.fetchall():
+                rows *= dict(zip(names, row))['rows'] or 1
+            return rows
+        finally:
+            c.close()
+
+    @traced
+    @transactional
+    def count(self, session, start_date, end_date, params):
+        """Return the number of orders getData would return, counted over
+        the same join without loading them."""
+        # the filters change some params, which the search may reuse
+        params = copy.copy(params)
+        q = self._query(session, start_date, end_date, params)
+        return q.value(func.count(distinct(OrderItem.order_id)))
+
+    @traced
+    @transactional
+    def estimate(self, session, start_date, end_date, params):
+        """Return a dict of the order items the planner expects the search
+        to examine ('rows') and the number of orders getData would return
+        ('orders'), for warning before a big search.
+
+        The orders are only counted when the rows are at most COUNT_LIMIT,
+        as past that counting costs nearly what the search does; 'orders'
+        is None then, and 'exact' False."""
+        params = copy.copy(params)
+        q = self._query(session, start_date, end_date, params)
+        rows = self._plannedRows(session, q)
+        if rows > COUNT_LIMIT:
+            return {'rows': rows, 'orders': None, 'exact': False}
+        return {'rows': rows, 'exact': True,
+                'orders': q.value(func.count(distinct(OrderItem.order_id)))}
+
+
+def bench(orders=100000):
+    """Compare the memory taken by search results as SearchRows and as the
+    dicts of formatted fields they replace, counting each order's container
+    and the money values it owns (the other values are the same objects
+    either way).  Python 2 has no tracemalloc, so sizes are summed with
+    sys.getsizeof."""
+    import sys
+    import time
+    amounts = [Decimal("%d.%02d" % (n % 500, n % 100)) for n in range(1000)]
+    for name in ("dict", "SearchRow"):
+        start = time.time()
+        rows = []
+        size = 0
+        for n in xrange(orders):
+            fields = dict((f, n) for f in SEARCH_FIELDS)
+            for f in MONEY_FIELDS:
+                fields[f] = amounts[(n + len(f)) % len(amounts)]
+            if name == "dict":
+                for f in MONEY_FIELDS:
+                    fields[f] = "%0.2f" % fields[f]
+                row = fields
+            else:
+                for f in MONEY_FIELDS:
+                    fields[f] = cents(fields[f])
+                row = SearchRow(**fields)
+            size += sys.getsizeof(row) + sum(sys.getsizeof(fields[f])
+                                             for f in MONEY_FIELDS)
+            rows.append(row)
+        print "%d orders as %-9s %6.1f MB, built in %.2fs" % (
+            orders, name, size / 1048576.0, time.time() - start)
+
+
+if __name__ == '__main__':
+    bench()
@@ -1,15 +1,56 @@
 
 from decimal import Decimal
+from UserDict import DictMixin
 from sqlalchemy import func, desc
 from plant.dbengine import transactional
+from tracing import traced
 from plant.smartdate import Date
 from plant.odict import odict
 from datacube import DataCube
+from pivot import Pivot
 from reporting import formatDollars, until
 
 
 MONEY_FIELDS = ('gross', 'net', 'revenue', 'shipping', 'shipping_cost', 'tax')
 
+
+class DrillDown(DictMixin):
+    '''Detail link parameters of a table row by column, each encrypted the
+    first time it's read.  A large pivot has far more cells than anyone
+    follows links from, and a page only reads those it renders.'''
+
+    def __init__(self, encrypt):
+        self.encrypt = encrypt
+        self.filters = {}
+        self.tokens = {}
+
+    def add(self, key, filter_str):
+        self.filters[key] = filter_str
+        self.tokens.pop(key, None)
+
+    def __getitem__(self, key):
+        try:
+            return self.tokens[key]
+        except KeyError:
+            token = self.tokens[key] = self.encrypt(self.filters[key])
+            return token
+
+    def __setitem__(self, key, token):
+        self.filters[key] = None
+        self.tokens[key] = token
+
+    def __delitem__(self, key):
+        del self.filters[key]
+        self.tokens.pop(key, None)
+
+    def __contains__(self, key):
+        return key in self.filters
+    has_key = __contains__
+
+    def keys(self):
+        return self.filters.keys()
+
+
 class OrderSummaryProc(object):
     '''Provides data for use by order summary reports.'''
     
@@ -32,6 +73,7 @@ class OrderSummaryProc(object):
             return '6 or More Days'
         return data
 
+    @traced
     @transactional
     def getData(self, session, params):
         '''Get the order summary data based on the given parameters.'''
@@ -48,11 +90,15 @@ class OrderSummaryProc(object):
         # ratio data <A>_per_<B> computed from A and B, such that
         # division of B occurs only after all A's are summed up
         extra_facts = [e for e in extra if '_per_' not in e]
+        # all tables come from one pass over the fact rows
+        groupings = [([facts[i]] + extra_facts,
+                      [d.replace('_percent', '') for d in dims])
+                     for i, dims in enumerate(params.dims)]
+        results = cube.getGroupedData(session, groupings, filters[:])
         for i, dims in enumerate(params.dims):
             fact = facts[i]
             percent_dims = [d.endswith('_percent') for d in dims[1:]]
-            percent_cols = []
-            dims = [d.replace('_percent', '') for d in dims]
+            dims = groupings[i][1]
             # main dimension used to title the table
             row_dim = dims[0]
             dim_name = ' '.join(s.title() for s in row_dim.split('_'))
@@ -63,62 +109,56 @@ class OrderSummaryProc(object):
             filter_str = ''
             if filters:
                 filter_str = ';'.join(filters) + ';'
-            for d in sorted(cube.getData(session, [fact] + extra_facts, 
-                                         dims, filters[:])):
-                #print d, '<br/>'
+            pivot = Pivot(len(dims) - 1, extra)
+            # just the numerator part of ratio data
+            extra_sums = [e.split('_per_')[0] for e in extra]
+            for d in sorted(results[i]):
                 row_val = getattr(d, row_dim)
-                if row_val not in data.rows:
-                    if not row_val: continue
-                    data.rows.append(row_val)
-                    data.body.append({row_dim: row_val, 'Total': 0, 
-                                      'detail_params': {}})
-                row_filter_str = filter_str + "dc.%s == '%s'" % \
-                                 (dims[0], row_val)
+                if not row_val: continue
+                r = pivot.row(row_val)
+                val = getattr(d, fact)
                 for g, col_dim in enumerate(dims[1:]):
-                    key = getattr(d, col_dim)
-                    # grouping is to ensure proper column ordering
-                    if len(data.cols) < g + 1:
-                        data.cols.append([])
-                        percent_cols.append([])
-                    if key not in data.cols[g]:
-                        data.cols[g].append(key)
-                        percent_cols[g].append(percent_dims[g])
-                    if key not in data.body[-1]:
-                        data.body[-1][key] = 0
-                    val = getattr(d, fact)
-                    data.body[-1][key] += val
-                    data.body[-1]['Total'] += val
-                    p = row_filter_str + ";dc.%s == '%s'" % (dims[1], key)
-                    data.body[-1]['detail_params'][key] = encrypt(p)
-                for e in extra:
-                    if e not in data.body[-1]:
-                        data.body[-1][e] = 0
-                    if '_per_' in e:
-                        # just numerator part of ratio data
-                        num = e.split('_per_')[0]
-                        data.body[-1][e] += getattr(d, num)
-                    else:
-                        data.body[-1][e] += getattr(d, e)
-                data.body[-1]['detail_params']['Total'] = \
-                    encrypt(row_filter_str)
-            data.cols = [c for g in data.cols for c in g]       # flatten cols
-            percent_cols = [c for g in percent_cols for c in g] # flatten cols
+                    pivot.add(r, g, getattr(d, col_dim), val)
+                for n, e in enumerate(extra_sums):
+                    pivot.addExtra(r, n, getattr(d, e))
+            # grouping is to ensure proper column ordering
+            data.rows = pivot.rows
+            data.cols = pivot.columns()
+            percent_cols = [percent_dims[g]
+                            for g, keys in enumerate(pivot.groups)
+                            for key in keys]
             # only show total column if there are more than 1 col to sum
             if len(data.cols) > 1:
                 data.cols.append('Total')
                 percent_cols.append(percent_cols[-1])
             data.cols += extra
             percent_cols += [False] * len(extra)
-            data.total_row = {'detail_params': {}}
-            # add 0 for missing values, populate total row and detail filters
+            # rows with 0 for missing values, the total row and the detail
+            # filters
+            for r, row_val in enumerate(pivot.rows):
+                row_filter_str = filter_str + "dc.%s == '%s'" % \
+                                 (dims[0], row_val)
+                detail = DrillDown(encrypt)
+                detail.add('Total', row_filter_str)
+                row = {row_dim: row_val, 'Total': pivot.row_totals[r],
+                       'detail_params': detail}
+                for key in pivot.cols:
+                    row[key] = 0
+                for key, val in pivot.items(r):
+                    row[key] = val
+                    detail.add(key, row_filter_str + ";dc.%s == '%s'" %
+                                    (dims[1], key))
+                row.update(zip(extra, pivot.extra_cells[r]))
+                data.body.append(row)
+            data.total_row = {'detail_params': DrillDown(encrypt)}
+            totals = dict(zip(pivot.cols, pivot.col_totals))
+            totals['Total'] = pivot.total
+            totals.update(zip(extra, pivot.extra_totals))
             for col in data.cols:
-                for row in data.body:
-                    if col not in row:
-                        row[col] = 0
-                data.total_row[col] = sum(row[col] for row in data.body)
+                data.total_row[col] = totals[col]
                 if col not in extra:
-                    p = filter_str + "dc.%s == '%s'" % (dims[1], col)
-                    data.total_row['detail_params'][col] = encrypt(p)
+                    data.total_row['detail_params'].add(
+                        col, filter_str + "dc.%s == '%s'" % (dims[1], col))
             # apply special formatting, 
             # divide denominator part of ratio data and percents
             data.col_names = []
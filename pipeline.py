@@ -0,0 +1,114 @@
+#!/usr/local/bin/python
+'''Counts of the work items by product code, activity and workflow state,
+for the pipeline charts.
+
+WorkflowInterface moves items between the counters in the same
+transaction as each transition, so a chart reads the few hundred counter
+rows instead of aggregating the work items.  Work items count as the cube
+does: those whose order item has a product code.  The counters are
+recounted from workflow_items with
+
+    pipeline.py rebuild
+'''
+
+import sys
+from sqlalchemy import func
+from sqlalchemy.sql import text
+from plant.dbengine import transactional
+from plant.model import PipelineCount
+from plant.modelaliases import act, oi, oif, pct, wi
+from datacube import JOINS
+
+# one statement, so concurrent transitions can't lose each other's changes
+BUMP = text('INSERT INTO pipeline_counts '
+            '(product_code, activity_id, state_id, orders, units) '
+            'VALUES (:product_code, :activity_id, :state_id, :orders, '
+            ':units) '
+            'ON DUPLICATE KEY UPDATE orders = orders + VALUES(orders), '
+            'units = units + VALUES(units)')
+
+
+class PipelineCounters(object):
+
+    def snapshot(self, workitems):
+        '''Return the (activity_id, state_id) of the work items by order
+        item, to pass to move() after changing them.'''
+        return dict((w.order_item_id, (w.activity_id, w.state_id))
+                    for w in workitems if w.order_item_id)
+
+    @transactional
+    def move(self, session, before, workitems):
+        '''Move the work items from the counters of their snapshot to those
+        of their current activity and state.  Items missing from the
+        snapshot are new.'''
+        after = self.snapshot(workitems)
+        changed = [id for id in after if before.get(id) != after[id]]
+        if not changed:
+            return
+        q = session.query(oi.order_item_id, pct.code, oi.qty)\
+            .filter(JOINS[oif]).filter(JOINS[pct])\
+            .filter(oi.order_item_id.in_(changed))
+        deltas = {}
+        for id, code, qty in q:
+            moves = [(after[id], 1)]
+            if id in before:
+                moves.append((before[id], -1))
+            for (activity_id, state_id), n in moves:
+                key = (code, activity_id, state_id)
+                orders, units = deltas.get(key, (0, 0))
+                deltas[key] = (orders + n, units + n * (qty or 0))
+        for (code, activity_id, state_id), (orders, units) in \
+                sorted(deltas.items()):
+            if orders or units:
+                session.execute(BUMP, {'product_code': code,
+                                       'activity_id': activity_id,
+                                       'state_id': state_id,
+                                       'orders': orders, 'units': units})
+
+    @transactional
+    def getCounts(self, session):
+        '''Return the counters as rows of product_code, activity (name),
+        state_id, orders and units.'''
+        return session.query(PipelineCount.product_code,
+                             act.name.label('activity'),
+                             PipelineCount.state_id, PipelineCount.orders,
+                             PipelineCount.units)\
+               .filter(PipelineCount.activity_id == act.activity_id).all()
+
+    @transactional
+    def rebuild(self, session):
+        '''Recount the counters from the work items.  Return the number of
+        counters.'''
+        session.query(PipelineCount).delete()
+        groups = [pct.code, wi.activity_id, wi.state_id]
+        q = session.query(*(groups + [func.count(oi.order_item_id),
+                                      func.sum(oi.qty)]))\
+            .filter(JOINS[wi]).filter(JOINS[oif]).filter(JOINS[pct])\
+            .group_by(*groups)
+        n = 0
+        for code, activity_id, state_id, orders, units in q:
+            session.add(PipelineCount(product_code=code,
+                                      activity_id=activity_id,
+                                      state_id=state_id, orders=orders,
+                                      units=units or 0))
+            n += 1
+        return n
+
+
+def syntax(msg=None):
+    if msg:
+        print msg
+        print
+    print "pipeline.py rebuild"
+    sys.exit(1)
+
+if __name__ == '__main__':
+    try:
+        cmd = sys.argv[1]
+    except IndexError:
+        syntax()
+    if cmd != 'rebuild':
+        syntax()
+    from plant.resources import res
+    res.load()
+    print PipelineCounters().rebuild(), 'counters'
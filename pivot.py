@@ -0,0 +1,124 @@
+'''Pivot tables of cube rows, for the summary reports.
+
+Rows and columns are indexed by dicts and each row's cells are a list in
+column order, so adding a value is constant time whatever the size of the
+table, and the row, column and grand totals are kept as the values are
+added rather than summed afterwards.'''
+
+import time
+
+
+class Pivot(object):
+    '''A table of the values of rows by column keys, in the order each row
+    and column was first seen.
+
+    The columns come in groups, one for each column dimension of a
+    summary table, and a key is listed in each group it was added to.  Keys
+    name the same column whatever their group, as the report tables index
+    their cells by key.  Extra columns are summed by position alongside.'''
+
+    def __init__(self, groups=1, extra=()):
+        self.rows = []
+        self.row_index = {}
+        self.groups = [[] for g in range(groups)]
+        self.group_keys = [set() for g in range(groups)]
+        self.cols = []          # distinct keys, in cell order
+        self.col_index = {}
+        self.cells = []         # by row, by column; None when never added
+        self.row_totals = []
+        self.col_totals = []
+        self.total = 0
+        self.extra = list(extra)
+        self.extra_cells = []
+        self.extra_totals = [0] * len(self.extra)
+
+    def row(self, value):
+        ' Return the index of the row, adding it when new '
+        r = self.row_index.get(value)
+        if r is None:
+            r = self.row_index[value] = len(self.rows)
+            self.rows.append(value)
+            self.cells.append([])
+            self.row_totals.append(0)
+            self.extra_cells.append([0] * len(self.extra))
+        return r
+
+    def add(self, r, g, key, value):
+        ' Add the value to the cell of row index r and the key in group g '
+        if key not in self.group_keys[g]:
+            self.group_keys[g].add(key)
+            self.groups[g].append(key)
+        c = self.col_index.get(key)
+        if c is None:
+            c = self.col_index[key] = len(self.cols)
+            self.cols.append(key)
+            self.col_totals.append(0)
+        cells = self.cells[r]
+        if c >= len(cells):
+            cells.extend([None] * (c + 1 - len(cells)))
+        if cells[c] is None:
+            cells[c] = value
+        else:
+            cells[c] += value
+        self.row_totals[r] += value
+        self.col_totals[c] += value
+        self.total += value
+
+    def addExtra(self, r, n, value):
+        ' Add the value to the nth extra column of row index r '
+        self.extra_cells[r][n] += value
+        self.extra_totals[n] += value
+
+    def columns(self):
+        ' Return the keys of each group in turn '
+        return [key for keys in self.groups for key in keys]
+
+    def items(self, r):
+        ' Return (key, value) for the cells added to row index r '
+        cols = self.cols
+        return [(cols[c], v) for c, v in enumerate(self.cells[r])
+                if v is not None]
+
+
+def test():
+    p = Pivot(2, ['units'])
+    for row, day, state, n in [('a', 'mon', 'new', 1), ('b', 'mon', 'old', 2),
+                               ('a', 'tue', 'new', 3), ('a', 'mon', 'new', 4)]:
+        r = p.row(row)
+        p.add(r, 0, day, n)
+        p.add(r, 1, state, n)
+        p.addExtra(r, 0, 10 * n)
+    print p.rows == ['a', 'b']
+    print p.columns() == ['mon', 'tue', 'new', 'old']
+    print p.items(0) == [('mon', 5), ('new', 8), ('tue', 3)]
+    print p.items(1) == [('mon', 2), ('old', 2)]
+    print p.row_totals == [16, 4], p.col_totals == [7, 8, 2, 3]
+    print p.total == 20, p.extra_totals == [100]
+
+
+def bench(rows=10000, cols=500, density=0.2):
+    '''Time building a rows x cols pivot from rows in the order a cube
+    query returns them, with the given fraction of cells filled.'''
+    import random
+    random.seed(1)
+    data = [(r, c, random.randint(1, 100))
+            for r in xrange(rows) for c in xrange(cols)
+            if random.random() < density]
+    start = time.time()
+    p = Pivot(1, ['units'])
+    for row, col, value in data:
+        r = p.row(row)
+        p.add(r, 0, col, value)
+        p.addExtra(r, 0, value)
+    built = time.time()
+    n = 0
+    for r in xrange(len(p.rows)):
+        n += len(p.items(r))
+    print '%d x %d pivot, %d cells: built in %.2fs, read in %.2fs' % (
+        len(p.rows), len(p.cols), n, built - start, time.time() - built)
+
+
+if __name__ == '__main__':
+    test()
+    bench(1000, 50)
+    bench()
@@ -0,0 +1,276 @@
+'''Cache of report results with a time to live and invalidation by tags.
+
+Results are kept in an in-process LRU and, when a path is configured, in a
+directory of pickles shared by the CGI workers.  Configured with
+
+    reports:
+        cache:
+            enabled: true   # off unless set
+            size: 500       # results kept in process
+            ttl: 60         # seconds
+            path: /var/cache/reports   # optional shared store
+
+Each result is stored with the generation of each of its tags, and is
+stale once any of them has been bumped by invalidate().  Tags name the
+slices of the order items a result covers, as a workflow state and an
+order month, either of which may be '*' for any:
+
+    state:100|month:2009-11     error items ordered in November 2009
+    state:100|month:*           error items ordered any time
+    state:*|month:*             anything
+
+A workflow change to an item bumps the four tags matching its states and
+order month, so it only reaches results covering that item.'''
+
+import os
+import time
+import fcntl
+import pickle
+import tempfile
+from datetime import date, datetime
+from hashlib import md5
+from lrucache import LRUCache
+from plant.modelaliases import can, wi
+from cubefilter import Compare, In, Literal, Ref, And, parseFilter
+
+ANY = '*'
+# tables changed by workflow transitions
+WORKFLOW_TABLES = set([wi.__table__, can.__table__])
+STATE_COLUMN = 'wi.state_id'
+DATE_COLUMN = 'o.order_date'
+# date ranges spanning more months than this are tagged with any month
+MAX_MONTHS = 24
+
+
+def tag(state, month):
+    return 'state:%s|month:%s' % (state, month)
+
+
+def months(start, end):
+    ' Return the YYYY-MM months from start to end, both included '
+    y, m = start.year, start.month
+    result = []
+    while (y, m) <= (end.year, end.month):
+        result.append('%04d-%02d' % (y, m))
+        y, m = m == 12 and (y + 1, 1) or (y, m + 1)
+    return result
+
+
+def parse_date(value):
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    try:
+        return datetime.strptime(str(value)[:10], '%Y-%m-%d').date()
+    except ValueError:
+        return None
+
+
+def requestTags(filters):
+    '''Return the tags of the slices a request with the given filters can
+    cover.  Only filters on the workflow state and order date narrow it;
+    anything not understood is taken to cover every slice.'''
+    states = None
+    start = end = None
+    nodes = []
+    for f in filters:
+        if isinstance(f, (str, unicode)) and f.strip():
+            nodes.append(parseFilter(f).node)
+    while nodes:
+        node = nodes.pop()
+        if isinstance(node, And):
+            nodes.extend(node.children)
+        elif isinstance(node, In) and str(node.ref) == STATE_COLUMN:
+            values = set(node.values)
+            if states is None:
+                states = values
+            else:
+                states &= values
+        elif isinstance(node, Compare) and isinstance(node.left, Ref) and \
+             isinstance(node.right, Literal):
+            ref, op, value = str(node.left), node.op, node.right.value
+            if ref == STATE_COLUMN and op == '==':
+                values = set([value])
+                if states is None:
+                    states = values
+                else:
+                    states &= values
+            elif ref == DATE_COLUMN and op in ('>', '>='):
+                day = parse_date(value)
+                if day:
+                    start = max(start or day, day)
+            elif ref == DATE_COLUMN and op in ('<', '<='):
+                day = parse_date(value)
+                if day:
+                    end = min(end or day, day)
+    if start and end and start <= end:
+        slices = months(start, end)
+        if len(slices) > MAX_MONTHS:
+            slices = [ANY]
+    else:
+        slices = [ANY]
+    if states is None:
+        states = [ANY]
+    return [tag(s, m) for s in sorted(states) for m in slices]
+
+
+def changeTags(states, months):
+    '''Return the tags to bump for a change to order items in the given
+    workflow states and order months.'''
+    tags = set()
+    for s in list(states) + [ANY]:
+        for m in list(months) + [ANY]:
+            tags.add(tag(s, m))
+    return sorted(tags)
+
+
+class ResultCache(object):
+
+    def __init__(self, size=500, ttl=60, path=None):
+        self.ttl = ttl
+        self.path = path
+        self.memory = LRUCache(size)
+        self.generations = {}
+        self._gen_mtime = None
+        if path and not os.path.isdir(path):
+            os.makedirs(path)
+
+    def _genFile(self):
+        return os.path.join(self.path, 'generations')
+
+    def _loadGenerations(self):
+        ' Reread the shared generations when another worker changed them '
+        if not self.path:
+            return self.generations
+        try:
+            st = os.stat(self._genFile())
+        except OSError:
+            return self.generations
+        # the file is replaced on each change, so a new inode means new data
+        mtime = (st.st_ino, st.st_mtime)
+        if mtime != self._gen_mtime:
+            try:
+                f = open(self._genFile(), 'rb')
+                try:
+                    self.generations = pickle.load(f)
+                finally:
+                    f.close()
+                self._gen_mtime = mtime
+            except (IOError, EOFError, pickle.UnpicklingError):
+                pass
+        return self.generations
+
+    def _write(self, filename, obj):
+        ' Write a pickle atomically so readers never see a partial file '
+        fd, tmp = tempfile.mkstemp(dir=self.path)
+        f = os.fdopen(fd, 'wb')
+        try:
+            pickle.dump(obj, f, pickle.HIGHEST_PROTOCOL)
+        finally:
+            f.close()
+        os.rename(tmp, filename)
+
+    def _entryFile(self, key):
+        return os.path.join(self.path, md5(repr(key)).hexdigest())
+
+    def snapshot(self, tags):
+        gens = self._loadGenerations()
+        return dict((t, gens.get(t, 0)) for t in tags)
+
+    def lookup(self, key):
+        '''Return the cached value for the key, or None if it's missing,
+        expired or invalidated.'''
+        entry = self.memory.get(key)
+        if entry is None and self.path:
+            try:
+                f = open(self._entryFile(key), 'rb')
+                try:
+                    entry = pickle.load(f)
+                finally:
+                    f.close()
+            except (IOError, EOFError, pickle.UnpicklingError):
+                entry = None
+            if entry is not None and entry[0] != key:   # hash collision
+                entry = None
+        if entry is None:
+            return None
+        stored_key, expires, gens, value = entry
+        if expires < time.time() or self.snapshot(gens) != gens:
+            self.memory.pop(key)
+            return None
+        self.memory[key] = entry
+        return value
+
+    def store(self, key, gens, value):
+        '''Cache the value with the tag generations snapshotted before it
+        was computed, so a change made meanwhile leaves it stale.'''
+        entry = (key, time.time() + self.ttl, gens, value)
+        self.memory[key] = entry
+        if self.path:
+            self._write(self._entryFile(key), entry)
+
+    def get(self, key, tags, compute):
+        '''Return the value for the key, calling compute() and caching its
+        result on a miss.'''
+        value = self.lookup(key)
+        if value is None:
+            gens = self.snapshot(tags)
+            value = compute()
+            self.store(key, gens, value)
+        return value
+
+    def invalidate(self, tags):
+        '''Bump the generations of the tags, making the results stored
+        with them stale here and in the other workers.'''
+        if not self.path:
+            for t in tags:
+                self.generations[t] = self.generations.get(t, 0) + 1
+            return
+        lock = open(os.path.join(self.path, 'generations.lock'), 'a')
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self._gen_mtime = None
+            gens = dict(self._loadGenerations())
+            for t in tags:
+                gens[t] = gens.get(t, 0) + 1
+            self._write(self._genFile(), gens)
+            self.generations = gens
+        finally:
+            lock.close()
+
+    def prune(self):
+        '''Remove the expired results from the shared store.'''
+        if not self.path:
+            return
+        now = time.time()
+        for name in os.listdir(self.path):
+            if len(name) != 32:     # not an entry
+                continue
+            filename = os.path.join(self.path, name)
+            try:
+                f = open(filename, 'rb')
+                try:
+                    expires = pickle.load(f)[1]
+                finally:
+                    f.close()
+                if expires < now:
+                    os.remove(filename)
+            except (IOError, OSError, EOFError, pickle.UnpicklingError):
+                pass
+
+
+_cache = None
+
+def getCache():
+    '''Return the configured shared cache, or None when it's disabled.'''
+    global _cache
+    if _cache is None:
+        from plant.resources import res
+        conf = res.conf.reports.get('cache') or {}
+        if not conf.get('enabled'):
+            _cache = False
+        else:
+            _cache = ResultCache(conf.get('size', 500), conf.get('ttl', 60),
+                                 conf.get('path'))
+    return _cache or None
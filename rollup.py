@@ -0,0 +1,335 @@
+#!/usr/local/bin/python
+
+import sys
+from datetime import datetime, date, timedelta
+from sqlalchemy import func
+from sqlalchemy.sql import and_, literal_column
+from plant.dbengine import transactional
+from plant.resources import res
+from plant.model import Address, CubeRollup, CubeRollupPartition, \
+                        CubeRollupRefresh, ExchangeRate, Order, OrderItem, \
+                        OrderItemFeature, ProductItem
+from cubefilter import OPERATORS, Compare, In, Literal, Ref, parseFilter
+from hyperloglog import HyperLogLog
+
+# Additive facts and low cardinality dimensions kept in the daily partitions.
+# Partitions are keyed on the order date, so only reports grouping or
+# filtering on order_date can be answered from them.
+ROLLUP_FACTS = ['gross', 'net', 'orders', 'pages', 'revenue', 'shipping',
+                'tax', 'units']
+# HyperLogLog sketches of the distinct count facts, merged in Python when
+# answering rather than summed.  Every row refreshed since they were added
+# has them, empty for none, so a NULL one is of a partition refreshed
+# before and the request is answered live.
+ROLLUP_SKETCHES = ['books_approx', 'customers_approx', 'emails_approx']
+ROLLUP_DIMENSIONS = ['client', 'cover_color', 'cover_material', 'currency',
+                     'partner', 'product', 'product_code', 'product_name',
+                     'product_type', 'ship_country', 'ship_method']
+
+# The live cube inner joins every table a column needs, so asking for a fact
+# or dimension drops the order items that can't be joined to its table.  The
+# partitions are built with outer joins instead and keep enough to apply the
+# same restriction when answering: a non-null test for each dimension and
+# these flags for the facts.
+FACT_FLAGS = {'gross': 'has_rate', 'net': 'has_rate', 'revenue': 'has_rate',
+              'shipping': 'has_rate', 'tax': 'has_rate',
+              'pages': 'has_product_item',
+              'books_approx': 'has_product_item'}
+
+# Table columns (besides the order date and state) whose equality filters,
+# as built by OrderSummaryProc.getFilters, can be answered from a rollup
+# dimension.
+NAMED_FILTERS = {'par.name': 'partner'}
+
+# last_updated isn't mapped in the model (see note there) so refer to it
+# directly when looking for changed orders.
+OI_UPDATED = literal_column('order_items.last_updated')
+O_UPDATED = literal_column('orders.last_updated')
+# The tables the partitions take dimensions or rates from, besides orders and
+# order items: each with its last_updated and the condition finding the
+# order items whose days a change to it affects.  Exchange rates are by day
+# and found on their own (see getChangedDays).
+SOURCE_UPDATED = [
+    (literal_column('addresses.last_updated'),
+     Address.address_id == Order.shipping_address_id),
+    (literal_column('product_items.last_updated'),
+     ProductItem.product_item_id == OrderItem.product_item_id),
+    (literal_column('order_item_features.last_updated'),
+     OrderItemFeature.order_item_id == OrderItem.order_item_id)]
+ER_UPDATED = literal_column('exchange_rates.last_updated')
+
+
+def parse_day(s):
+    ' Return the date for a midnight timestamp string, otherwise None '
+    s = s.strip()
+    for fmt in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d'):
+        try:
+            dt = datetime.strptime(s, fmt)
+        except ValueError:
+            continue
+        if dt.time() == datetime.min.time():
+            return dt.date()
+        return None
+    return None
+
+
+class RollupStore(object):
+    '''Materialized daily rollups of the additive cube facts.
+
+    DataCube.getData asks the store first and falls back to the live join
+    whenever the requested facts, dimensions and filters can't be rebuilt
+    from the stored partitions.'''
+
+    def _translateFilters(self, filters):
+        '''Translate filter strings into conditions on the rollup table.
+        Return (start, end, conds) or None if any filter can't be
+        translated.'''
+        start = end = None
+        conds = []
+        for f in filters:
+            if not isinstance(f, (str, unicode)):
+                return None
+            if not f.strip():
+                continue
+            node = parseFilter(f).node
+            if isinstance(node, In) and str(node.ref) == 'o.state_id':
+                conds.append(CubeRollup.order_state_id.in_(node.values))
+                continue
+            if not isinstance(node, Compare) or \
+               not isinstance(node.left, Ref) or \
+               not isinstance(node.right, Literal):
+                return None
+            ref, op, value = node.left, node.op, node.right.value
+            if str(ref) == 'o.order_date' and op in ('>=', '<') and \
+               isinstance(value, str):
+                day = parse_day(value)
+                if day is None:
+                    return None
+                if op == '>=':
+                    start = max(start or day, day)
+                else:
+                    end = min(end or day, day)
+            elif str(ref) == 'o.state_id' and isinstance(value, (int, long)):
+                conds.append(OPERATORS[op](CubeRollup.order_state_id, value))
+            elif op == '==' and ref.alias == 'dc' and \
+                 ref.name in ROLLUP_DIMENSIONS:
+                conds.append(getattr(CubeRollup, ref.name) == value)
+            elif op == '==' and str(ref) in NAMED_FILTERS:
+                col = getattr(CubeRollup, NAMED_FILTERS[str(ref)])
+                conds.append(col == value)
+            else:
+                return None
+        if start is None or end is None:
+            return None
+        return start, end, conds
+
+    def canAnswer(self, facts, dimensions):
+        if not facts:   # detail rows aren't kept
+            return False
+        for f in facts:
+            if f not in ROLLUP_FACTS and f not in ROLLUP_SKETCHES:
+                return False
+        for d in dimensions:
+            if d != 'order_date' and d not in ROLLUP_DIMENSIONS:
+                return False
+        return True
+
+    def isCovered(self, session, start, end):
+        '''Return whether every day in [start, end) has been refreshed.'''
+        n = session.query(func.count(CubeRollupPartition.rollup_date))\
+            .filter((CubeRollupPartition.rollup_date >= start) &
+                    (CubeRollupPartition.rollup_date < end))\
+            .scalar()
+        return n == (end - start).days
+
+    @transactional
+    def getData(self, session, facts, dimensions, filters=[]):
+        '''Answer a cube request from the rollups.  Return None when the
+        request can't be answered from the stored partitions.'''
+        if not self.canAnswer(facts, dimensions):
+            return None
+        translated = self._translateFilters(filters)
+        if translated is None:
+            return None
+        start, end, conds = translated
+        if end <= start or not self.isCovered(session, start, end):
+            return None
+        dims = []
+        for d in dimensions:
+            if d == 'order_date':
+                dims.append(CubeRollup.rollup_date.label(d))
+            else:
+                dims.append(getattr(CubeRollup, d).label(d))
+        conds += [CubeRollup.rollup_date >= start,
+                  CubeRollup.rollup_date < end]
+        for d in dimensions:
+            if d != 'order_date':
+                conds.append(getattr(CubeRollup, d) != None)
+        for flag in set(FACT_FLAGS.get(f) for f in facts):
+            if flag:
+                conds.append(getattr(CubeRollup, flag) == 1)
+        if [f for f in facts if f in ROLLUP_SKETCHES]:
+            return self._mergeSketches(session, facts, dimensions, dims,
+                                       conds)
+        cols = dims + [func.sum(getattr(CubeRollup, f)).label(f)
+                       for f in facts]
+        q = session.query(*cols).filter(and_(*conds))
+        if dims:
+            q = q.group_by(*dims)
+        return q.all()
+
+    def _mergeSketches(self, session, facts, dimensions, dims, conds):
+        '''Sum the partition rows up to the dimensions in Python, merging
+        the sketches.  Return None if a partition has no sketches yet.'''
+        from datacube import regroup, rowClass
+        cols = dims + [getattr(CubeRollup, f).label(f) for f in facts]
+        Row = rowClass(list(dimensions) + list(facts))
+        rows = []
+        for row in session.query(*cols).filter(and_(*conds)):
+            values = list(row)
+            for n, f in enumerate(facts):
+                v = values[len(dims) + n]
+                if f in ROLLUP_SKETCHES:
+                    if v is None:
+                        return None
+                    values[len(dims) + n] = HyperLogLog.fromBytes(v)
+            rows.append(Row(*values))
+        return regroup(rows, dimensions, facts)
+
+    @transactional
+    def getChangedDays(self, session, since):
+        '''Return the order dates of order items created or changed since
+        the given time, or whose addresses, product items or features
+        changed, and the days of exchange rates set since then.
+
+        Deleted order items leave nothing changed, so their days keep them
+        until refreshed again: refresh a range of days periodically (see
+        syntax) to drop them.'''
+        q = session.query(func.date(Order.order_date).label('day'))\
+            .filter(Order.order_id == OrderItem.order_id)
+        queries = [q.filter((OI_UPDATED >= since) | (O_UPDATED >= since))]
+        for updated, onclause in SOURCE_UPDATED:
+            queries.append(q.filter(onclause).filter(updated >= since))
+        queries.append(session.query(ExchangeRate.rate_date.label('day'))
+                       .filter(ER_UPDATED >= since))
+        days = set()
+        for (day,) in queries[0].union(*queries[1:]):
+            if isinstance(day, (str, unicode)):
+                day = parse_day(day)
+            elif isinstance(day, datetime):
+                day = day.date()
+            if day:
+                days.add(day)
+        return sorted(days)
+
+    @transactional
+    def refresh(self, session, start_date=None, end_date=None):
+        '''Rebuild the partitions for the days in [start_date, end_date) or,
+        when no range is given, for the days with new or changed order items
+        since the last refresh without one.  Return the list of days
+        refreshed.
+
+        Only refreshes without a range move on the time changes are looked
+        for since (CubeRollupRefresh), so refreshing a range of days
+        doesn't skip the changes made meanwhile to the others.  Until one
+        has run, changes are looked for since the oldest partition.'''
+        now = datetime.now()
+        if start_date:
+            end_date = end_date or date.today() + timedelta(1)
+            days = [start_date + timedelta(n)
+                    for n in range((end_date - start_date).days)]
+        else:
+            since = session.query(CubeRollupRefresh.refreshed).scalar()
+            if since is None:
+                since = session.query(
+                    func.min(CubeRollupPartition.refreshed)).scalar()
+            if since is None:
+                raise ValueError('No partitions yet - a start date is '
+                                 'required for the initial refresh.')
+            days = self.getChangedDays(session, since)
+        for day in days:
+            self.refreshDay(session, day, now)
+        if not start_date:
+            session.merge(CubeRollupRefresh(cube_rollup_refresh_id=1,
+                                            refreshed=now))
+        return days
+
+    @transactional
+    def refreshDay(self, session, day, now=None):
+        '''Replace the partition for the given day.'''
+        from sqlalchemy.sql import case
+        from datacube import DIMENSIONS, FACTS, JOINS, SKETCHES, \
+                             sketchColumns
+        from plant.modelaliases import a, c, cc, cm, cur, er, o, oi, oif, \
+                                       p, par, pct, pi, pt, sc, sm, sv
+        now = now or datetime.now()
+        session.query(CubeRollup).filter(CubeRollup.rollup_date == day)\
+               .delete()
+        # each table is joined after the tables its join condition refers to
+        j = oi.__table__.join(o.__table__, JOINS[o])
+        for cls in (er, cur, par, sv, sc, a, c, sm, p, pt, pi, oif, cc, cm,
+                    pct):
+            j = j.outerjoin(cls.__table__, JOINS[cls])
+        groups = [o.state_id.label('order_state_id'),
+                  case([(er.rate == None, 0)], else_=1).label('has_rate'),
+                  case([(pi.product_item_id == None, 0)],
+                       else_=1).label('has_product_item')]
+        groups += [DIMENSIONS[d] for d in ROLLUP_DIMENSIONS]
+        in_day = (o.order_date >= day) & (o.order_date < day + timedelta(1))
+        # the registers of each sketch, by group
+        sketches = {}
+        for f in ROLLUP_SKETCHES:
+            index, rank = sketchColumns(SKETCHES[f])
+            q = session.query(*(groups + [index, func.max(rank)]))\
+                .select_from(j).filter(in_day).group_by(*(groups + [index]))
+            for row in q:
+                row = tuple(row)
+                if row[-2] is None:
+                    continue
+                key = (row[:-2], f)
+                if key not in sketches:
+                    sketches[key] = HyperLogLog()
+                sketches[key].setRegister(row[-2], row[-1])
+        q = session.query(*(groups + [FACTS[f] for f in ROLLUP_FACTS]))\
+            .select_from(j).filter(in_day).group_by(*groups)
+        names = ['order_state_id', 'has_rate', 'has_product_item'] + \
+                ROLLUP_DIMENSIONS + ROLLUP_FACTS
+        n = 0
+        for row in q:
+            values = dict(zip(names, row))
+            key = tuple(row)[:len(groups)]
+            for f in ROLLUP_SKETCHES:
+                sketch = sketches.get((key, f))
+                values[f] = (sketch or HyperLogLog()).toBytes()
+            session.add(CubeRollup(rollup_date=day, **values))
+            n += 1
+        session.merge(CubeRollupPartition(rollup_date=day, num_rows=n,
+                                          refreshed=now))
+
+
+def syntax(msg=None):
+    if msg:
+        print msg
+        print
+    print "rollup.py refresh [<start YYYY-MM-DD> [<end YYYY-MM-DD>]]"
+    print
+    print "Without dates the days changed since the last refresh are"
+    print "refreshed.  Deleted order items don't show as changes, so also"
+    print "refresh the recent months with dates from time to time (weekly)."
+    sys.exit(1)
+
+if __name__ == '__main__':
+    try:
+        cmd = sys.argv[1]
+    except:
+        syntax()
+    if cmd != 'refresh':
+        syntax()
+    try:
+        dates = [datetime.strptime(a, '%Y-%m-%d').date()
+                 for a in sys.argv[2:4]]
+    except ValueError, e:
+        syntax(str(e))
+    res.load()
+    for day in RollupStore().refresh(*dates):
+        print day
@@ -0,0 +1,266 @@
+#!/usr/local/bin/python
+'''Trigram index of the names and codes the order search matches substrings
+of, so the search finds the few customers, promotions, associations and
+software versions containing a term by index rather than scanning the
+tables with LIKE '%term%'.
+
+The index keeps, for each field, every three character substring of each
+row's value with the row's id, folded as MySQL's utf8_general_ci compares
+them: lowercased and without accents, so 'jose' finds 'José' as the LIKE
+does.  A row whose value
+contains the term contains all the term's trigrams, so the rows having all
+of them are a superset of the matches, which the search narrows its LIKE
+to.  Terms shorter than three characters, or with LIKE wildcards, can't be
+looked up and are searched as before.  The index is only as fresh as its
+last refresh, so the rows added or updated since are candidates too.
+
+The index is refreshed incrementally: rows added (by id) or updated (by
+last_updated) since the last refresh are reindexed.  Run from cron with
+
+    searchindex.py refresh [<field> ...]
+    searchindex.py rebuild [<field> ...]
+'''
+
+import sys
+import time
+import unicodedata
+from datetime import datetime
+from sqlalchemy import func
+from sqlalchemy.sql import literal_column
+from plant.dbengine import transactional
+from plant.model import Association, Customer, Promotion, \
+                        SearchTrigram, SearchTrigramRefresh, SoftwareVersion
+
+N = 3
+# rows read per query when indexing
+CHUNK = 5000
+# more candidates than this and the index doesn't narrow the search enough
+# to be worth an IN list
+MAX_CANDIDATES = 5000
+
+# the indexed fields: the id and value columns and, as last_updated isn't
+# mapped in the model, the table's last_updated column
+FIELDS = {
+    'first_name': (Customer.customer_id, Customer.first_name,
+                   literal_column('customers.last_updated')),
+    'last_name': (Customer.customer_id, Customer.last_name,
+                  literal_column('customers.last_updated')),
+    'promo': (Promotion.promotion_id, Promotion.code,
+              literal_column('promotions.last_updated')),
+    'assoc': (Association.association_id, Association.code,
+              literal_column('associations.last_updated')),
+    'version': (SoftwareVersion.software_version_id, SoftwareVersion.code,
+                literal_column('software_versions.last_updated'))}
+
+
+def fold(value):
+    ' Return the value lowercased and with the accents taken off its letters '
+    if isinstance(value, str):
+        value = value.decode('utf-8', 'replace')
+    value = unicodedata.normalize('NFKD', value)
+    return u''.join(c for c in value if not unicodedata.combining(c)).lower()
+
+
+def trigrams(value):
+    ' Return the set of folded trigrams of the value '
+    if value is None:
+        return set()
+    value = fold(value)
+    return set(value[i:i + N] for i in range(len(value) - N + 1))
+
+
+class SearchIndex(object):
+
+    @transactional
+    def criterion(self, session, field, term, column):
+        '''Return the criterion that column, holding ids of the field's
+        rows, is of a row whose field may contain the term: one the index
+        finds or one added or updated since it was refreshed.  Return None
+        when the index can't narrow the search.'''
+        changed = self._changed(session, field)
+        if changed is None:
+            return None     # never indexed
+        ids = self.candidates(session, field, term)
+        if ids is None:
+            return None
+        # no id is 0, for when there are no candidates
+        return column.in_(ids or [0]) | changed
+
+    @transactional
+    def candidates(self, session, field, term):
+        '''Return the ids of the rows whose field the index finds may
+        contain the term, or None when it can't narrow the search.  Rows
+        changed since the last refresh aren't found (see criterion).'''
+        if '%' in term or '_' in term:
+            return None
+        grams = trigrams(term.strip())
+        if not grams:
+            return None
+        q = session.query(SearchTrigram.id)\
+            .filter(SearchTrigram.field == field)\
+            .filter(SearchTrigram.trigram.in_(grams))\
+            .group_by(SearchTrigram.id)\
+            .having(func.count(SearchTrigram.trigram) == len(grams))\
+            .limit(MAX_CANDIDATES + 1)
+        ids = [id for id, in q]
+        if len(ids) > MAX_CANDIDATES:
+            return None
+        return ids
+
+    @transactional
+    def refresh(self, session, fields=None):
+        '''Reindex the rows of the fields (by default all) added or updated
+        since their last refresh, or all rows of a field never refreshed.
+        Return the number of rows reindexed by field.'''
+        now = datetime.now()
+        counts = {}
+        for field in fields or sorted(FIELDS):
+            key, column, updated = FIELDS[field]
+            q = session.query(key, column)
+            changed = self._changed(session, field)
+            if changed is not None:
+                q = q.filter(changed)
+            counts[field] = self._index(session, field, q, key)
+            session.merge(SearchTrigramRefresh(field=field, refreshed=now))
+        return counts
+
+    def _changed(self, session, field):
+        '''Return the criterion of the field's rows added (by id) or
+        updated (by last_updated) since its last refresh, or None if it
+        has never been refreshed.'''
+        key, column, updated = FIELDS[field]
+        since = session.query(SearchTrigramRefresh.refreshed)\
+                .filter(SearchTrigramRefresh.field == field).scalar()
+        if since is None:
+            return None
+        last = session.query(func.max(SearchTrigram.id))\
+               .filter(SearchTrigram.field == field).scalar() or 0
+        return (key > last) | (updated >= since)
+
+    @transactional
+    def rebuild(self, session, fields=None):
+        '''Drop and reindex the fields (by default all).'''
+        fields = fields or sorted(FIELDS)
+        for field in fields:
+            session.query(SearchTrigram)\
+                   .filter(SearchTrigram.field == field).delete()
+            session.query(SearchTrigramRefresh)\
+                   .filter(SearchTrigramRefresh.field == field).delete()
+        return self.refresh(session, fields)
+
+    def _index(self, session, field, q, key):
+        ' Replace the trigrams of the rows of q, a CHUNK at a time by key '
+        table = SearchTrigram.__table__
+        n = 0
+        last = None
+        while True:
+            page = q
+            if last is not None:
+                page = page.filter(key > last)
+            rows = page.order_by(key).limit(CHUNK).all()
+            if not rows:
+                return n
+            ids = [id for id, value in rows]
+            session.execute(table.delete().where(
+                (table.c.field == field) & table.c.id.in_(ids)))
+            grams = [{'field': field, 'trigram': gram, 'id': id}
+                     for id, value in rows for gram in trigrams(value)]
+            if grams:
+                session.execute(table.insert(), grams)
+            n += len(rows)
+            last = ids[-1]
+
+
+def test(customers=1000000, terms=('ann', 'smith', 'li', 'ohn', 'zzz',
+                                 'anders', 'a_b')):
+    '''Check the candidates against LIKE scans of synthetic customers in
+    SQLite, and time both.  The default is about the number of customers
+    the order search runs against; pass a smaller one for a quick check.'''
+    import random
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+    engine = create_engine('sqlite://')
+    for cls in (Customer, SearchTrigram, SearchTrigramRefresh):
+        cls.__table__.create(engine)
+    engine.execute('ALTER TABLE customers ADD COLUMN last_updated DATETIME')
+    session = sessionmaker(bind=engine)()
+    random.seed(1)
+    syllables = ['an', 'ders', 'son', 'smi', 'th', 'jo', 'hn', 'li', 'ne',
+                 'mar', 'ie', 'o', 'ka', 'ty', 'ber', 'g', 'ann', 'el']
+    def name():
+        return ''.join(random.sample(syllables, random.randint(1, 4)))\
+               .title()
+    for n in xrange(1, customers + 1, CHUNK):
+        session.execute(Customer.__table__.insert(),
+                        [{'customer_id': i, 'username': 'user%d' % i,
+                          'first_name': name(), 'last_name': name()}
+                         for i in xrange(n, min(n + CHUNK, customers + 1))])
+    start = time.time()
+    index = SearchIndex()
+    # only the customers' tables are created
+    counts = index.refresh(session, ['first_name', 'last_name'])
+    print 'indexed %d customers in %.1fs' % (counts['first_name'],
+                                             time.time() - start)
+    for field, column in (('first_name', Customer.first_name),
+                          ('last_name', Customer.last_name)):
+        for term in terms:
+            start = time.time()
+            like = set(id for id, in session.query(Customer.customer_id)
+                       .filter(column.like('%' + term + '%')))
+            scanned = time.time() - start
+            start = time.time()
+            ids = index.candidates(session, field, term)
+            if ids is not None:
+                found = set(id for id, in session.query(Customer.customer_id)
+                            .filter(Customer.customer_id.in_(ids or [0]))
+                            .filter(column.like('%' + term + '%')))
+            looked_up = time.time() - start
+            if ids is None:
+                print '%-10s %-7s %6d matches: not indexed' % (field, term,
+                                                               len(like))
+            else:
+                print '%-10s %-7s %6d matches %6d candidates %s ' \
+                      'scan %.3fs index %.3fs' % (
+                          field, term, len(like), len(ids),
+                          found == like and 'ok' or 'WRONG', scanned,
+                          looked_up)
+    print 'accents', trigrams('Jos\xc3\xa9') == trigrams('JOSE') and \
+          trigrams(u'\xc5ngstr\xf6m') == trigrams('angstrom')
+    # an update and a new customer are picked up by the next refresh
+    session.execute("UPDATE customers SET first_name = 'Zzzed', "
+                    "last_updated = '2100-01-01' WHERE customer_id = 1")
+    session.execute(Customer.__table__.insert(),
+                    {'customer_id': customers + 1, 'username': 'new',
+                     'first_name': 'Zzzara', 'last_name': 'Smith'})
+    # and are candidates before it
+    criterion = index.criterion(session, 'first_name', 'zzz',
+                                Customer.customer_id)
+    print 'changed', sorted(id for id, in session.query(Customer.customer_id)
+                            .filter(criterion)
+                            .filter(Customer.first_name.like('%zzz%'))) == \
+          [1, customers + 1]
+    counts = index.refresh(session, ['first_name'])
+    print 'refreshed', counts['first_name'], \
+          sorted(index.candidates(session, 'first_name', 'zzz')) == \
+          [1, customers + 1]
+
+
+if __name__ == '__main__':
+    try:
+        cmd = sys.argv[1]
+    except IndexError:
+        cmd = None
+    if cmd == 'test':
+        test(*map(int, sys.argv[2:3]))
+        sys.exit()
+    if cmd not in ('refresh', 'rebuild') or \
+       [f for f in sys.argv[2:] if f not in FIELDS]:
+        print "searchindex.py refresh|rebuild [%s ...]" % \
+              '|'.join(sorted(FIELDS))
+        print "searchindex.py test [<customers>]"
+        sys.exit(1)
+    from plant.resources import res
+    res.load()
+    index = SearchIndex()
+    for field, n in sorted(getattr(index, cmd)(sys.argv[2:]).items()):
+        print field, n
@@ -0,0 +1,303 @@
+'''Order searches refined within their results.
+
+Staff run a broad order search (a date range, a country) and then narrow
+it by zip, promo or email.  SearchSessions keeps the rows of a search by a
+key (the staff member's session) for a while, and runs a refinement of it
+against them: the filters whose criteria are on fields of the rows are
+applied to the rows in memory, and SQL is only run for filters on columns
+the rows don't have.  A refinement filtering whole orders then reuses the
+cached rows of the orders it finds; one filtering their items (work item
+state, product, ship date) rebuilds the rows, as the items matching change
+the totals.  Anything but a narrowing of the search is searched afresh.
+
+Configured with
+
+    reports:
+        search_sessions:
+            ttl: 600            # seconds
+            max_orders: 100000  # rows kept by the process, all sessions
+
+Searches finding more orders than max_orders aren't kept, and the least
+recently used sessions are dropped to keep the rows kept under it.'''
+
+import copy
+import threading
+import time
+from datetime import timedelta
+from lrucache import LRUCache
+from resultcache import parse_date
+from plant.dbengine import transactional
+from plant.model import OrderItem
+from tracing import traced
+from ordersearchproc import OrderSearchProc
+
+TTL = 600
+MAX_ORDERS = 100000
+
+# The params of each filter of the search besides the dates (see
+# _narrowDates), the method matching the rows a refinement by the filter
+# leaves (or None if the rows can't show), and the SQL run when they can't:
+# 'order' when the filter keeps or drops whole orders and 'item' when it
+# can drop some of an order's items.
+DATE_PARAMS = ('date_type', 'start_date', 'end_date')
+REFINEMENTS = [
+    (('ship_country',), '_matchShipCountry', 'order'),
+    (('skus',), None, 'item'),
+    (('order_state',), None, 'item'),
+    (('foids', 'order_ids', 'book_ids', 'order_numbers'), '_matchIDs',
+     'item'),
+    (('startfoid', 'endfoid'), '_matchStartEnd', 'order'),
+    (('first_name',), None, 'order'),
+    (('last_name',), None, 'order'),
+    (('zip',), '_matchZip', 'order'),
+    (('email',), '_matchEmail', 'order'),
+    (('promo',), '_matchPromo', 'order'),
+    (('assoc',), None, 'order'),
+    (('user_id',), '_matchUserID', 'order'),
+    (('coupon_codes',), None, 'order'),
+    (('client',), None, 'order'),
+    (('gc_codes',), None, 'item'),
+    (('dc_transaction_numbers',), None, 'item')]
+
+
+def fold(value):
+    ' Return the value as MySQL compares it, ignoring case and end spaces '
+    return (value or '').rstrip().lower()
+
+
+def paramValues(start_date, end_date, params):
+    '''Return the values of the params the filters use, by name, before
+    the search changes any of them.'''
+    values = {'start_date': start_date, 'end_date': end_date,
+              'date_type': getattr(params, 'date_type', None)}
+    for names, match, kind in REFINEMENTS:
+        for name in names:
+            value = getattr(params, name, None)
+            if hasattr(value, '__iter__'):
+                value = tuple(value)
+            values[name] = value
+    return values
+
+
+def dateBounds(start_date, end_date):
+    '''Return the first day and the day after the last of the range
+    OrderSearchProc._filterByDate filters on, either None for no bound,
+    or None if a date can't be read.'''
+    start = end = None
+    if start_date:
+        start = parse_date(start_date)
+        if start is None:
+            return None
+    if end_date:
+        end = parse_date(end_date)
+        if end is None:
+            return None
+        if start_date:
+            # the last day is included with a first one
+            end += timedelta(1)
+    return start, end
+
+
+class SearchSessions(object):
+
+    def __init__(self, ttl=TTL, max_orders=MAX_ORDERS):
+        self.ttl = ttl
+        self.max_orders = max_orders
+        self.proc = OrderSearchProc()
+        # each session is at least one order, so the LRU itself never
+        # drops any: _store does, by the orders kept
+        self.sessions = LRUCache(max_orders + 1)
+        self.orders = 0
+        self._lock = threading.Lock()
+
+    def _lookup(self, key):
+        ' Return the (expires, values, rows) of the key, or None '
+        entry = self.sessions.get(key)
+        if entry is not None and entry[0] < time.time():
+            self.drop(key)
+            return None
+        return entry
+
+    def _store(self, key, values, rows):
+        self._lock.acquire()
+        try:
+            self._drop(key)
+            if len(rows) > self.max_orders:
+                return
+            self.sessions[key] = (time.time() + self.ttl, values, rows)
+            self.orders += max(1, len(rows))
+            for old in self.sessions.keys():    # least recently used first
+                if self.orders <= self.max_orders:
+                    break
+                self._drop(old)
+        finally:
+            self._lock.release()
+
+    def _drop(self, key):
+        entry = self.sessions.pop(key)
+        if entry is not None:
+            self.orders -= max(1, len(entry[2]))
+
+    def drop(self, key):
+        ' Forget the search of the key '
+        self._lock.acquire()
+        try:
+            self._drop(key)
+        finally:
+            self._lock.release()
+
+    @traced
+    @transactional
+    def search(self, session, key, start_date, end_date, params):
+        '''Return the orders OrderSearchProc.getData finds, keeping them as
+        the search of the key.'''
+        values = paramValues(start_date, end_date, params)
+        rows = self.proc.getData(session, start_date, end_date, params)
+        self._store(key, values, rows)
+        return rows
+
+    @traced
+    @transactional
+    def refine(self, session, key, start_date, end_date, params):
+        '''Return the orders OrderSearchProc.getData finds, from the search
+        of the key where the params narrow it, or else searching afresh.
+        The search of the key is kept as it was, so it can be refined
+        another way.'''
+        entry = self._lookup(key)
+        if entry is None:
+            return self.search(session, key, start_date, end_date, params)
+        expires, base, rows = entry
+        values = paramValues(start_date, end_date, params)
+        matchers = []
+        sql = self._narrowDates(base, values)
+        if sql is False:
+            return self.search(session, key, start_date, end_date, params)
+        for names, match, kind in REFINEMENTS:
+            old = [base[name] for name in names]
+            if old == [values[name] for name in names]:
+                continue
+            if [value for value in old if value]:
+                # changing or dropping a filter of the search widens it
+                return self.search(session, key, start_date, end_date,
+                                   params)
+            matcher = match and getattr(self, match)(params)
+            if matcher:
+                matchers.append(matcher)
+            elif sql != 'item':
+                sql = kind
+        if sql == 'item':
+            return self.proc.getData(session, start_date, end_date, params)
+        if sql == 'order':
+            q = self.proc._query(session, start_date, end_date, params)
+            ids = set(id for id, in q.distinct().values(OrderItem.order_id))
+            return [row for row in rows if row.foid in ids]
+        return [row for row in rows if all(m(row) for m in matchers)]
+
+    def _narrowDates(self, base, values):
+        '''Return None if the date range of the values is that of the
+        search's, the SQL a narrower range needs, as in REFINEMENTS, or
+        False if it isn't narrower.  The date type only matters with a
+        range.'''
+        old = [base[name] for name in DATE_PARAMS]
+        new = [values[name] for name in DATE_PARAMS]
+        if old[1:] == new[1:] and (old == new or not [v for v in new[1:]
+                                                       if v]):
+            return None
+        if [v for v in old[1:] if v] and old[0] != new[0]:
+            return False
+        old, new = dateBounds(*old[1:]), dateBounds(*new[1:])
+        if None in (old, new):
+            return False
+        for n, narrower in ((0, max), (1, min)):
+            if old[n] and not new[n]:
+                return False
+            if old[n] and narrower(old[n], new[n]) != new[n]:
+                return False
+        # the order date is the same for all an order's items
+        return values['date_type'] == 'order_date' and 'order' or 'item'
+
+    # The matchers return a test of whether a row is of an order the
+    # filter of the same name in OrderSearchProc keeps, comparing as MySQL
+    # does, or None when the row can't tell.
+
+    def _matchShipCountry(self, params):
+        countries = params.ship_country
+        if not hasattr(countries, '__iter__'):
+            countries = [countries]
+        wanted = set(fold(c) for c in countries if c <> "*")
+        others = "*" in params.ship_country
+        def match(row):
+            # without a shipping address (no ship_to) the country is NULL
+            if not row.ship_to or row.ship_country is None:
+                return False
+            country = fold(row.ship_country)
+            return country in wanted or \
+                   (others and country not in ('us', 'ca'))
+        return match
+
+    def _matchIDs(self, params):
+        # _getOrderIDs adds the order_ids to the foids of the params
+        params = copy.copy(params)
+        if self.proc._getProductItemIDs(params):
+            return None     # of the items
+        order_ids = set(self.proc._getOrderIDs(params))
+        numbers = set(fold(n) for n in self.proc._getRefNums(params))
+        if not (order_ids or numbers):
+            return lambda row: True
+        return lambda row: row.foid in order_ids or \
+                           fold(row.order_number) in numbers
+
+    def _matchStartEnd(self, params):
+        try:
+            start = params.startfoid and int(params.startfoid)
+            end = params.endfoid and int(params.endfoid)
+        except (ValueError, TypeError):
+            return None
+        if params.startfoid and params.endfoid:
+            return lambda row: start <= row.foid <= end
+        elif params.startfoid:
+            return lambda row: row.foid > start
+        elif params.endfoid:
+            return lambda row: row.foid < end
+        return lambda row: True
+
+    def _matchZip(self, params):
+        zip_codes = [fold(x.strip()) for x in params.zip.split(",")
+                     if x.strip()]
+        def match(row):
+            found = (fold(row.ship_zip), fold(row.bill_zip))
+            return all(zip_code in found for zip_code in zip_codes)
+        return match
+
+    def _matchEmail(self, params):
+        email = fold(params.email.strip())
+        if not email:
+            return None
+        return lambda row: fold(row.bill_email) == email
+
+    def _matchPromo(self, params):
+        promo = params.promo.strip().lower()
+        if not promo or [c for c in '%_\\' if c in promo]:
+            return None     # a LIKE pattern
+        # the row's promo is the codes of its promotions joined by ", "
+        return lambda row: [code for code in (row.promo or '').split(', ')
+                            if promo in code.lower()] != []
+
+    def _matchUserID(self, params):
+        user_id = fold(params.user_id.strip())
+        if not user_id:
+            return None
+        return lambda row: fold(row.user_id) == user_id
+
+
+_sessions = None
+
+def getSearchSessions():
+    '''Return the configured search sessions of the process.'''
+    global _sessions
+    if _sessions is None:
+        from plant.resources import res
+        conf = res.conf.reports.get('search_sessions') or {}
+        _sessions = SearchSessions(conf.get('ttl', TTL),
+                                   conf.get('max_orders', MAX_ORDERS))
+    return _sessions
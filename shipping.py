@@ -0,0 +1,68 @@
+'''Shipments of order items, from the carriers' tables.
+
+FedEx shipments are in shipping_fedex, keyed by the order item id as the
+reference number (a string column).  USPS shipments made through Endicia
+are in shipping_endicia, and older ones in shipping_endicia_history, keyed
+by order item id.  ShippingResolver reads all of them for a set of order
+items in one query per carrier, the Endicia tables as a UNION, and
+returns them by order item id, so reports don't query the tables per
+order.'''
+
+from collections import namedtuple
+from sqlalchemy.sql import literal_column
+from plant.dbengine import transactional
+from plant.model import ShippingEndicia, ShippingEndiciaHistory, \
+                        ShippingFedex
+
+# order item ids per query
+CHUNK = 500
+
+# source is the table, 'fedex', 'endicia' or 'endicia_history', method the
+# carrier's service or mail class and charge what the carrier charged:
+# FedEx's net charge or Endicia's postage
+Shipment = namedtuple('Shipment', 'order_item_id source method ship_date '
+                                  'tracking_number charge')
+
+
+class ShippingResolver(object):
+
+    @transactional
+    def getShipments(self, session, order_item_ids):
+        '''Return the shipments of the order items as {order_item_id:
+        [Shipment, ...]} in ship date order (undated first).  Voided FedEx
+        shipments are left out.'''
+        ids = sorted(set(int(id) for id in order_item_ids))
+        shipments = {}
+        for n in range(0, len(ids), CHUNK):
+            chunk = ids[n:n + CHUNK]
+            for row in self._fedex(session, chunk) + \
+                       self._endicia(session, chunk):
+                shipments.setdefault(row.order_item_id, []).append(row)
+        for rows in shipments.values():
+            rows.sort(key=lambda s: s.ship_date)
+        return shipments
+
+    def _fedex(self, session, ids):
+        # reference_number is a string, so compare with strings for the
+        # index and turn it back into an order item id
+        q = session.query(ShippingFedex.reference_number,
+                          ShippingFedex.service_type,
+                          ShippingFedex.ship_date,
+                          ShippingFedex.tracking_number,
+                          ShippingFedex.net_charge)\
+            .filter(ShippingFedex.reference_number.in_(map(str, ids)))\
+            .filter(ShippingFedex.void_date == None)
+        return [Shipment(int(ref), 'fedex', method, date, tracking, charge)
+                for ref, method, date, tracking, charge in q]
+
+    def _endicia(self, session, ids):
+        queries = []
+        for cls, source in ((ShippingEndicia, 'endicia'),
+                            (ShippingEndiciaHistory, 'endicia_history')):
+            queries.append(session.query(
+                cls.order_item_id,
+                literal_column("'%s'" % source).label('source'),
+                cls.orig_mail_class, cls.postmark_date, cls.tracking_number,
+                cls.postage_amount).filter(cls.order_item_id.in_(ids)))
+        return [Shipment(*row)
+                for row in queries[0].union_all(queries[1]).all()]
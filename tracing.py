@@ -0,0 +1,406 @@
+#!/usr/local/bin/python
+'''Per call tracing of the report procs' database work.
+
+Put @traced above @transactional on a proc method.  While it runs, every
+SQL statement executed by the thread is counted and timed, and each call
+is written as a JSON line to a rotating log with
+
+    name        Class.method
+    wall        seconds
+    statements  number of SQL statements
+    rows        rows fetched
+    objects     ORM objects hydrated
+    calls       traced methods called within, by name
+    slowest     the slowest statements, with EXPLAIN output for SELECTs
+    repeated    statements run more than REPEATED times - an N+1 pattern
+                shows up here as one SELECT with a count near the rows of
+                the query that drives it
+
+Statements are seen through the engines, which getLogger installs the
+tracing on when it's enabled.  Work a traced call hands to other threads
+is counted in its record when run through inTrace.  Tracing is configured
+with
+
+    reports:
+        trace:
+            enabled: true
+            path: /var/log/plant/reports-trace.log
+            max_bytes: 10000000
+            backups: 5
+
+and a log is summarized with
+
+    tracing.py summary [<log>]
+    tracing.py show [<log> [<count>]]
+'''
+
+import sys
+import time
+import heapq
+import threading
+import logging
+from logging.handlers import RotatingFileHandler
+from datetime import datetime
+from functools import wraps
+from types import GeneratorType
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+DEFAULT_PATH = 'reports-trace.log'
+SLOWEST = 5         # statements kept per call
+REPEATED = 10       # statement repeats reported per call
+EXPLAIN_OVER = 0.05 # seconds; faster statements aren't explained
+
+_local = threading.local()
+_logger = None
+
+
+class Trace(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.start = time.time()
+        self.statements = 0
+        self.rows = 0
+        self.objects = 0
+        self.calls = {}
+        self.slowest = []       # heap of (seconds, sql, explain)
+        self.counts = {}
+        # the threads of inTrace add to the trace at once
+        self._lock = threading.Lock()
+
+    def addStatement(self, sql, seconds, rows, explain=None):
+        self._lock.acquire()
+        try:
+            self.statements += 1
+            if rows > 0:
+                self.rows += rows
+            self.counts[sql] = self.counts.get(sql, 0) + 1
+            item = (seconds, sql, explain)
+            if len(self.slowest) < SLOWEST:
+                heapq.heappush(self.slowest, item)
+            elif seconds > self.slowest[0][0]:
+                heapq.heapreplace(self.slowest, item)
+        finally:
+            self._lock.release()
+
+    def addCall(self, name):
+        self._lock.acquire()
+        try:
+            self.calls[name] = self.calls.get(name, 0) + 1
+        finally:
+            self._lock.release()
+
+    def addObjects(self, n):
+        self._lock.acquire()
+        try:
+            self.objects += n
+        finally:
+            self._lock.release()
+
+    def isSlow(self, seconds):
+        ' Whether a statement this slow would be kept '
+        return seconds >= EXPLAIN_OVER and (len(self.slowest) < SLOWEST or
+                                            seconds > self.slowest[0][0])
+
+    def record(self):
+        repeated = sorted([(n, sql) for sql, n in self.counts.items()
+                           if n > REPEATED], reverse=True)
+        return {'time': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                'name': self.name,
+                'wall': round(time.time() - self.start, 4),
+                'statements': self.statements,
+                'rows': self.rows,
+                'objects': self.objects,
+                'calls': self.calls,
+                'slowest': [{'seconds': round(s, 4), 'sql': sql,
+                             'explain': explain}
+                            for s, sql, explain in sorted(self.slowest,
+                                                          reverse=True)],
+                'repeated': [{'count': n, 'sql': sql}
+                             for n, sql in repeated]}
+
+
+def current():
+    ' Return the outermost trace running in this thread, if any '
+    stack = getattr(_local, 'stack', None)
+    return stack and stack[0] or None
+
+
+def getLogger():
+    '''Return the trace logger, or None when tracing is disabled.'''
+    global _logger
+    if _logger is None:
+        from plant.resources import res
+        conf = res.conf.reports.get('trace') or {}
+        if not conf.get('enabled'):
+            _logger = False
+        else:
+            _logger = logging.getLogger('plant.reports.trace')
+            _logger.propagate = False
+            handler = RotatingFileHandler(conf.get('path', DEFAULT_PATH),
+                                          maxBytes=conf.get('max_bytes',
+                                                            10000000),
+                                          backupCount=conf.get('backups', 5))
+            handler.setFormatter(logging.Formatter('%(message)s'))
+            _logger.addHandler(handler)
+            _logger.setLevel(logging.INFO)
+            install()
+    return _logger or None
+
+
+def _begin(name, count=True):
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    if stack and count:
+        stack[0].addCall(name)
+    stack.append(Trace(name))
+
+def _end(log=True):
+    trace = _local.stack.pop()
+    if log and not _local.stack:
+        logger = getLogger()
+        if logger:
+            logger.info(json.dumps(trace.record()))
+
+def _tracedIter(name, gen):
+    ' Trace a generator over the whole of its iteration '
+    _begin(name, count=False)
+    try:
+        for item in gen:
+            yield item
+    finally:
+        _end()
+
+
+def traced(fn):
+    '''Decorator tracing each call of a proc method.  Calls made while
+    another traced call is running are counted in the outer call's record
+    rather than logged on their own.'''
+    @wraps(fn)
+    def wrapper(self, *args, **kw):
+        if not getLogger():
+            return fn(self, *args, **kw)
+        name = '%s.%s' % (self.__class__.__name__, fn.__name__)
+        _begin(name)
+        try:
+            result = fn(self, *args, **kw)
+        except:
+            _end()
+            raise
+        if isinstance(result, GeneratorType):
+            # the work happens as it's iterated
+            _end(log=False)
+            return _tracedIter(name, result)
+        _end()
+        return result
+    return wrapper
+
+
+def inTrace(fn):
+    '''Return fn to be called in another thread as part of the traced call
+    running in this one, if any, so its statements and the traced calls it
+    makes are counted in the call's record rather than logged apart.'''
+    trace = current()
+    if trace is None:
+        return fn
+    @wraps(fn)
+    def wrapper(*args, **kw):
+        stack = getattr(_local, 'stack', None)
+        _local.stack = [trace]
+        try:
+            return fn(*args, **kw)
+        finally:
+            _local.stack = stack
+    return wrapper
+
+
+def _explain(cursor, statement, parameters):
+    if not statement.lstrip().upper().startswith('SELECT'):
+        return None
+    try:
+        c = cursor.connection.cursor()
+        try:
+            c.execute('EXPLAIN ' + statement, parameters)
+            names = [d[0] for d in c.description]
+            return [dict(zip(names, [str(v) for v in row]))
+                    for row in c.fetchall()]
+        finally:
+            c.close()
+    except Exception, e:
+        return [{'error': str(e)}]
+
+
+def _afterExecute(cursor, statement, parameters, seconds):
+    trace = current()
+    if trace is None:
+        return
+    explain = None
+    if trace.isSlow(seconds):
+        explain = _explain(cursor, statement, parameters)
+    rows = getattr(cursor, 'rowcount', 0)
+    if not (cursor.description and rows):
+        rows = 0
+    trace.addStatement(statement, seconds, rows or 0, explain)
+
+
+def _countObjects(rows):
+    ' Count the mapped instances in query results as they are fetched '
+    trace = current()
+    for row in rows:
+        if trace is not None:
+            if isinstance(row, tuple):
+                trace.addObjects(len([x for x in row
+                                      if hasattr(x, '_sa_instance_state')]))
+            elif hasattr(row, '_sa_instance_state'):
+                trace.addObjects(1)
+        yield row
+
+
+_installed = set()
+
+def install(engine=None):
+    '''Start timing the statements run through the engine, by default
+    through every engine, and counting the objects queries hydrate.'''
+    if engine in _installed or None in _installed:
+        return
+    _installed.add(engine)
+    try:
+        from sqlalchemy import event
+    except ImportError:     # sqlalchemy < 0.7
+        from sqlalchemy.engine.base import Connection
+        if engine is None:
+            # every engine's connections execute through the class
+            execute = Connection._cursor_execute
+            def _cursor_execute(self, cursor, statement, parameters,
+                                context=None):
+                start = time.time()
+                try:
+                    return execute(self, cursor, statement, parameters,
+                                   context)
+                finally:
+                    _afterExecute(cursor, statement, parameters,
+                                  time.time() - start)
+            Connection._cursor_execute = _cursor_execute
+        else:
+            from sqlalchemy.interfaces import ConnectionProxy
+            from sqlalchemy.engine.base import _proxy_connection_cls
+
+            class TracingProxy(ConnectionProxy):
+                def cursor_execute(self, execute, cursor, statement,
+                                   parameters, context, executemany):
+                    start = time.time()
+                    try:
+                        return execute(cursor, statement, parameters,
+                                       context)
+                    finally:
+                        _afterExecute(cursor, statement, parameters,
+                                      time.time() - start)
+            engine.Connection = _proxy_connection_cls(Connection,
+                                                      TracingProxy())
+    else:
+        if engine is None:
+            from sqlalchemy.engine import Engine
+            engine = Engine
+        def before(conn, cursor, statement, parameters, context, many):
+            _local.started = time.time()
+        def after(conn, cursor, statement, parameters, context, many):
+            _afterExecute(cursor, statement, parameters,
+                          time.time() - getattr(_local, 'started',
+                                                time.time()))
+        event.listen(engine, 'before_cursor_execute', before)
+        event.listen(engine, 'after_cursor_execute', after)
+
+    from sqlalchemy.orm.query import Query
+    if not hasattr(Query, '_untraced_iter'):
+        Query._untraced_iter = Query.__iter__
+        def __iter__(self):
+            rows = self._untraced_iter()
+            if current() is None:
+                return rows
+            return _countObjects(rows)
+        Query.__iter__ = __iter__
+
+
+def readLog(path):
+    records = []
+    for line in open(path):
+        try:
+            records.append(json.loads(line))
+        except ValueError:
+            pass
+    return records
+
+
+def summary(records):
+    by_name = {}
+    for r in records:
+        by_name.setdefault(r['name'], []).append(r)
+    print '%-40s %6s %8s %8s %6s %8s %8s %6s' % (
+        'name', 'calls', 'avg s', 'max s', 'stmts', 'rows', 'objects',
+        'n+1')
+    for name in sorted(by_name, key=lambda n: -sum(r['wall']
+                                                   for r in by_name[n])):
+        rs = by_name[name]
+        n = len(rs)
+        worst = max([x['count'] for r in rs for x in r['repeated']] or [0])
+        print '%-40s %6d %8.3f %8.3f %6d %8d %8d %6s' % (
+            name[:40], n, sum(r['wall'] for r in rs) / n,
+            max(r['wall'] for r in rs),
+            sum(r['statements'] for r in rs) / n,
+            sum(r['rows'] for r in rs) / n,
+            sum(r['objects'] for r in rs) / n,
+            worst and '%d!' % worst or '')
+
+
+def show(records):
+    for r in records:
+        print '%s %s %.3fs %d statements %d rows %d objects' % (
+            r['time'], r['name'], r['wall'], r['statements'], r['rows'],
+            r['objects'])
+        for name, n in sorted(r['calls'].items()):
+            print '    calls %s x%d' % (name, n)
+        for x in r['repeated']:
+            print '    N+1? x%d %s' % (x['count'], x['sql'][:100])
+        for x in r['slowest']:
+            print '    %.3fs %s' % (x['seconds'], x['sql'][:100])
+            for row in x['explain'] or []:
+                print '        %s' % ', '.join('%s=%s' % kv
+                                               for kv in sorted(row.items()))
+
+
+def syntax(msg=None):
+    if msg:
+        print msg
+        print
+    print "tracing.py summary [<log>]"
+    print "tracing.py show [<log> [<count>]]"
+    sys.exit(1)
+
+if __name__ == '__main__':
+    try:
+        cmd = sys.argv[1]
+    except IndexError:
+        syntax()
+    path = len(sys.argv) > 2 and sys.argv[2] or None
+    if path is None:
+        from plant.resources import res
+        res.load()
+        path = (res.conf.reports.get('trace') or {}).get('path',
+                                                         DEFAULT_PATH)
+    records = readLog(path)
+    if cmd == 'summary':
+        summary(records)
+    elif cmd == 'show':
+        try:
+            count = int(sys.argv[3])
+        except IndexError:
+            count = 20
+        except ValueError, e:
+            syntax(str(e))
+        show(records[-count:])
+    else:
+        syntax()